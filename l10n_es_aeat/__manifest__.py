@@ -9,7 +9,7 @@
 {
     'name': "AEAT Base",
     'summary': "Modulo base para declaraciones de la AEAT",
-    'version': "12.0.1.1.1",
+    'version': "12.0.1.2.0",
     'author': "Pexego,"
               "Acysos,"
               "AvanzOSC,"
@@ -0,0 +1,28 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+
+def migrate(cr, version):
+    """The journal items of the tax lines were stored on each calculation in
+    the relation table now used for the audited ones. Only the ones of the
+    confirmed reports are kept, so the rest are searched again on demand.
+    """
+    if not version:
+        return
+    cr.execute("SELECT DISTINCT model FROM l10n_es_aeat_tax_line")
+    for model, in cr.fetchall():
+        table = model.replace('.', '_')
+        cr.execute("""
+            SELECT 1 FROM information_schema.columns
+            WHERE table_name = %s AND column_name = 'state'""", (table, ))
+        if not cr.fetchone():
+            continue
+        cr.execute("""
+            DELETE FROM account_move_line_l10n_es_aeat_tax_line_rel rel
+            USING l10n_es_aeat_tax_line tl
+            WHERE tl.id = rel.l10n_es_aeat_tax_line_id
+                AND tl.model = %%s
+                AND NOT EXISTS (
+                    SELECT 1 FROM %s report
+                    WHERE report.id = tl.res_id
+                        AND report.state IN ('done', 'posted')
+                )""" % table, (model, ))
@@ -2,7 +2,42 @@
 # Copyright 2019 Tecnativa - Pedro M. Baeza
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl
 
-from odoo import models, fields
+import re
+from collections import namedtuple
+
+from odoo import api, models, fields, tools
+from odoo.tools.safe_eval import _SAFE_OPCODES, test_expr
+
+EXPRESSION_PATTERN = re.compile(r'(\$\{.+?\})')
+
+# Compiled expressions of an export configuration line
+ExportLine = namedtuple('ExportLine', [
+    'id', 'conditional_code', 'repeat_code', 'expression_parts',
+])
+
+
+def _compile_expression(expr):
+    """Validate an expression with the same restrictions than ``safe_eval``
+    and compile it.
+
+    :return: Tuple (expression, code object).
+    """
+    expr = expr.strip()
+    return expr, test_expr(expr, _SAFE_OPCODES, mode='eval')
+
+
+def _compile_template(template):
+    """Split a template with ``${...}`` placeholders in its parts.
+
+    :return: Tuple of literal strings and compiled expressions.
+    """
+    parts = []
+    for part in EXPRESSION_PATTERN.split(template):
+        if EXPRESSION_PATTERN.match(part):
+            parts.append(_compile_expression(part[2:-1]))
+        elif part:
+            parts.append(part)
+    return tuple(parts)
 
 
 class AeatModelExportConfig(models.Model):
@@ -20,3 +55,43 @@ class AeatModelExportConfig(models.Model):
     config_line_ids = fields.One2many(
         comodel_name='aeat.model.export.config.line', oldname='config_lines',
         inverse_name='export_config_id', string='Lines')
+
+    @api.model
+    @tools.ormcache('config_id')
+    def _get_compiled_lines(self, config_id):
+        """Compiled expressions of the lines of an export configuration,
+        already validated and kept on the ORM cache until a configuration is
+        modified.
+
+        :param config_id: ID of the export configuration.
+        :return: Tuple of ``ExportLine``, in the order of the lines.
+        """
+        res = []
+        for line in self.browse(config_id).config_line_ids:
+            res.append(ExportLine(
+                id=line.id,
+                conditional_code=(
+                    line.conditional_expression and
+                    _compile_expression(line.conditional_expression)
+                ),
+                repeat_code=(
+                    line.repeat_expression and
+                    _compile_expression(line.repeat_expression)
+                ),
+                expression_parts=(
+                    line.expression and _compile_template(line.expression)
+                ),
+            ))
+        return tuple(res)
+
+    @api.multi
+    def write(self, vals):
+        # The lines created or modified clear the cache by themselves
+        if 'config_line_ids' in vals:
+            self._get_compiled_lines.clear_cache(self)
+        return super(AeatModelExportConfig, self).write(vals)
+
+    @api.multi
+    def unlink(self):
+        self._get_compiled_lines.clear_cache(self)
+        return super(AeatModelExportConfig, self).unlink()
@@ -54,6 +54,26 @@ class AeatModelExportConfigLine(models.Model):
     position = fields.Integer(compute='_compute_position')
     value = fields.Char(compute='_compute_value', store=True)
 
+    @api.model
+    def _clear_compiled_lines_cache(self):
+        config_obj = self.env['aeat.model.export.config']
+        config_obj._get_compiled_lines.clear_cache(config_obj)
+
+    @api.model
+    def create(self, vals):
+        self._clear_compiled_lines_cache()
+        return super(AeatModelExportConfigLine, self).create(vals)
+
+    @api.multi
+    def write(self, vals):
+        self._clear_compiled_lines_cache()
+        return super(AeatModelExportConfigLine, self).write(vals)
+
+    @api.multi
+    def unlink(self):
+        self._clear_compiled_lines_cache()
+        return super(AeatModelExportConfigLine, self).unlink()
+
     @api.multi
     @api.depends('repeat_expression')
     def _compute_repeat(self):
@@ -2,7 +2,16 @@
 # Copyright 2016-2017 Tecnativa - Pedro M. Baeza <pedro.baeza@tecnativa.com>
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 
+from collections import defaultdict
+
 from odoo import _, api, exceptions, fields, models
+from odoo.tools import str2bool
+
+# Values of the move type of the journal entries for each map line move type
+MOVE_TYPES = {
+    'regular': ('receivable', 'payable', 'liquidity'),
+    'refund': ('receivable_refund', 'payable_refund'),
+}
 
 
 class L10nEsAeatReportTaxMapping(models.AbstractModel):
@@ -15,6 +24,10 @@ class L10nEsAeatReportTaxMapping(models.AbstractModel):
         comodel_name='l10n.es.aeat.tax.line', inverse_name='res_id',
         domain=lambda self: [("model", "=", self._name)], auto_join=True,
         readonly=True, oldname='tax_lines', string="Tax lines")
+    # Compute the tax lines from a single scan of the journal items of the
+    # period, grouped in SQL, instead of a search per map line. Reports that
+    # override `_get_move_line_domain` or `_get_tax_lines` always use them.
+    _aggregate_tax_lines = False
 
     @api.multi
     def calculate(self):
@@ -33,40 +46,83 @@ class L10nEsAeatReportTaxMapping(models.AbstractModel):
                  ('date_to', '=', False)], limit=1)
             if tax_code_map:
                 tax_lines = []
+                aggregates = None
+                if report._use_tax_line_aggregates():
+                    aggregates = report._init_tax_line_aggregates(
+                        tax_code_map.map_line_ids)
                 for map_line in tax_code_map.map_line_ids:
-                    tax_lines.append(report._prepare_tax_line_vals(map_line))
-                # Due to a bug in ORM that unlinks other tables' records, we
-                # have to avoid (0, 0, x) syntax
-                # Reference: https://github.com/odoo/odoo/issues/18438
+                    tax_lines.append(
+                        report._prepare_tax_line_vals(map_line, aggregates))
                 for tax_line_vals in tax_lines:
                     tax_line_vals.update({
                         'model': report._name,
                         'res_id': report.id,
                     })
-                    tax_line_obj.create(tax_line_vals)
+                tax_line_obj._create_tax_lines(tax_lines)
+                report.invalidate_cache(['tax_line_ids'], [report.id])
                 report.modified(['tax_line_ids'])
                 report.recompute()
         return res
 
+    @api.multi
+    def button_confirm(self):
+        """Store the journal items of the tax lines to regularize, so the
+        regularization move is built from the same journal items than the
+        amounts of the report. The journal items of the rest of the tax lines
+        are also stored when the system parameter
+        'l10n_es_aeat.audit_move_lines' is set. Otherwise, they keep being
+        searched again when they are read.
+        """
+        res = super(L10nEsAeatReportTaxMapping, self).button_confirm()
+        tax_lines = self.mapped('tax_line_ids')
+        if not str2bool(self.env['ir.config_parameter'].sudo().get_param(
+                'l10n_es_aeat.audit_move_lines', 'False'), False):
+            tax_lines = tax_lines.filtered('to_regularize')
+        tax_lines._store_audit_move_lines()
+        return res
+
     @api.multi
     def unlink(self):
         self.mapped('tax_line_ids').unlink()
         return super(L10nEsAeatReportTaxMapping, self).unlink()
 
     @api.multi
-    def _prepare_tax_line_vals(self, map_line):
+    def _prepare_tax_line_vals(self, map_line, aggregates=None):
+        """Values of the tax line of a map line. Only the amount and the
+        dates it's computed for are stored, as the journal items are
+        resolved on demand.
+
+        :param map_line: Mapping line record.
+        :param aggregates: Dictionary returned by
+          ``_init_tax_line_aggregates``. If not given, the journal items are
+          summed through the ORM.
+        :return: Dictionary of values for creating the tax line.
+        """
         self.ensure_one()
-        move_lines = self._get_tax_lines(
-            map_line.mapped('tax_ids.description'),
-            self.date_start, self.date_end, map_line,
-        )
+        date_start, date_end = self._get_tax_line_dates(map_line)
+        codes = map_line.mapped('tax_ids.description')
+        if aggregates is not None:
+            rows = self._get_aggregated_tax_lines(map_line, aggregates)
+        elif self._is_tax_mapping_method_overridden('_get_tax_lines'):
+            rows = self._get_tax_lines(
+                codes, date_start, date_end, map_line,
+            ).read(['debit', 'credit'])
+        elif self._is_map_line_skipped(map_line):
+            rows = []
+        else:
+            rows = self.env['account.move.line'].read_group(
+                self._get_move_line_domain(
+                    codes, date_start, date_end, map_line),
+                ['debit', 'credit'], [],
+            )
+        credit = sum(x['credit'] or 0.0 for x in rows)
+        debit = sum(x['debit'] or 0.0 for x in rows)
         if map_line.sum_type == 'credit':
-            amount = sum(move_lines.mapped('credit'))
+            amount = credit
         elif map_line.sum_type == 'debit':
-            amount = sum(move_lines.mapped('debit'))
+            amount = debit
         else:  # map_line.sum_type == 'both'
-            amount = (sum(move_lines.mapped('credit')) -
-                      sum(move_lines.mapped('debit')))
+            amount = credit - debit
         if map_line.inverse:
             amount = (-1.0) * amount
         return {
@@ -74,9 +130,178 @@ class L10nEsAeatReportTaxMapping(models.AbstractModel):
             'res_id': self.id,
             'map_line_id': map_line.id,
             'amount': amount,
-            'move_line_ids': [(6, 0, move_lines.ids)],
+            'date_start': date_start,
+            'date_end': date_end,
         }
 
+    @api.multi
+    def _get_tax_line_dates(self, map_line):
+        """Dates of the journal items to compute for a map line.
+
+        :param map_line: Mapping line record.
+        :return: Tuple (start date, end date).
+        """
+        self.ensure_one()
+        return self.date_start, self.date_end
+
+    @api.multi
+    def _is_map_line_skipped(self, map_line):
+        """Tell if the map line doesn't get any journal item on this report.
+
+        :param map_line: Mapping line record.
+        """
+        return False
+
+    @api.model
+    def _is_tax_mapping_method_overridden(self, method):
+        """Tell if a method of this abstract model is overridden by the
+        report.
+
+        :param method: Method name.
+        """
+        return (getattr(type(self), method) is not
+                getattr(L10nEsAeatReportTaxMapping, method))
+
+    @api.multi
+    def _use_tax_line_aggregates(self):
+        """Tell if the tax lines can be computed from the aggregates
+        (see ``_aggregate_tax_lines``)."""
+        self.ensure_one()
+        return (
+            self._aggregate_tax_lines and not self._get_partner_domain() and
+            not self._is_tax_mapping_method_overridden(
+                '_get_move_line_domain') and
+            not self._is_tax_mapping_method_overridden('_get_tax_lines')
+        )
+
+    @api.multi
+    def _get_tax_codes_ids(self, codes):
+        """IDs of the taxes of the company and its children for each code.
+
+        :param codes: List of strings for the tax codes.
+        :return: Dictionary {code: set of tax IDs}.
+        """
+        self.ensure_one()
+        taxes = self.env['account.tax'].search([
+            ('description', 'in', list(codes)),
+            ('company_id', 'child_of', self.company_id.id),
+        ])
+        res = defaultdict(set)
+        for tax in taxes:
+            res[tax.description].add(tax.id)
+        return res
+
+    @api.multi
+    def _init_tax_line_aggregates(self, map_lines):
+        """Data shared by the tax lines computed from the aggregates: the
+        taxes of each map line and the aggregates of each pair of dates,
+        which are loaded on first use.
+
+        :param map_lines: Mapping lines recordset.
+        :return: Dictionary with the keys 'taxes' ({map line ID: set of tax
+          IDs}) and 'rows' ({(start date, end date): list of aggregates}).
+        """
+        self.ensure_one()
+        codes_ids = self._get_tax_codes_ids(
+            set(map_lines.mapped('tax_ids.description')))
+        taxes = {}
+        for map_line in map_lines:
+            taxes[map_line.id] = set()
+            for code in map_line.mapped('tax_ids.description'):
+                taxes[map_line.id] |= codes_ids[code]
+        return {'taxes': taxes, 'rows': {}}
+
+    @api.multi
+    def _get_tax_line_aggregates(self, date_start, date_end):
+        """Scan once the tax-bearing journal items of the company and its
+        children between the dates, grouped by every criteria that a map
+        line can filter by. The record rules of the journal items are
+        applied as on a search.
+
+        :param date_start: Start date of the period.
+        :param date_end: End date of the period.
+        :return: List of dictionaries with the keys 'tax_line_id',
+          'tax_ids' (list of the base taxes), 'move_type', 'tax_exigible',
+          'is_debit', 'is_credit', 'debit' and 'credit'.
+        """
+        self.ensure_one()
+        move_line_obj = self.env['account.move.line']
+        query = move_line_obj._where_calc([
+            ('company_id', 'child_of', self.company_id.id),
+            ('date', '>=', date_start),
+            ('date', '<=', date_end),
+        ])
+        move_line_obj._apply_ir_rules(query, 'read')
+        from_clause, where_clause, where_params = query.get_sql()
+        self.env.cr.execute("""
+            SELECT aml.tax_line_id, base.tax_ids, am.move_type,
+                aml.tax_exigible,
+                aml.debit > 0 AS is_debit,
+                aml.credit > 0 AS is_credit,
+                SUM(aml.debit) AS debit,
+                SUM(aml.credit) AS credit
+            FROM account_move_line aml
+            JOIN account_move am ON am.id = aml.move_id
+            LEFT JOIN LATERAL (
+                SELECT ARRAY_AGG(
+                    rel.account_tax_id ORDER BY rel.account_tax_id
+                ) AS tax_ids
+                FROM account_move_line_account_tax_rel rel
+                WHERE rel.account_move_line_id = aml.id
+            ) base ON TRUE
+            WHERE aml.id IN (
+                    SELECT "account_move_line".id FROM %s WHERE %s
+                )
+                AND (aml.tax_line_id IS NOT NULL OR
+                     base.tax_ids IS NOT NULL)
+            GROUP BY aml.tax_line_id, base.tax_ids, am.move_type,
+                aml.tax_exigible, aml.debit > 0, aml.credit > 0""" % (
+            from_clause, where_clause,
+        ), where_params)
+        return self.env.cr.dictfetchall()
+
+    @api.multi
+    def _get_aggregated_tax_lines(self, map_line, aggregates):
+        """Aggregates of the journal items of a map line, with the same
+        criteria than ``_get_move_line_domain``.
+
+        :param map_line: Mapping line record.
+        :param aggregates: Dictionary returned by
+          ``_init_tax_line_aggregates``.
+        :return: List of the matching aggregates.
+        """
+        self.ensure_one()
+        if self._is_map_line_skipped(map_line):
+            return []
+        dates = self._get_tax_line_dates(map_line)
+        if dates not in aggregates['rows']:
+            aggregates['rows'][dates] = self._get_tax_line_aggregates(*dates)
+        tax_ids = aggregates['taxes'][map_line.id]
+        move_types = MOVE_TYPES.get(map_line.move_type)
+        res = []
+        for row in aggregates['rows'][dates]:
+            if move_types and row['move_type'] not in move_types:
+                continue
+            amount_match = row['tax_line_id'] in tax_ids
+            base_match = bool(tax_ids.intersection(row['tax_ids'] or []))
+            if map_line.field_type == 'base' and not base_match:
+                continue
+            if map_line.field_type == 'amount' and not amount_match:
+                continue
+            if not (amount_match or base_match):
+                continue
+            if map_line.sum_type == 'debit' and not row['is_debit']:
+                continue
+            if map_line.sum_type == 'credit' and not row['is_credit']:
+                continue
+            if (map_line.exigible_type == 'yes' and
+                    not row['tax_exigible']):
+                continue
+            if map_line.exigible_type == 'no' and row['tax_exigible']:
+                continue
+            res.append(row)
+        return res
+
     @api.multi
     def _get_partner_domain(self):
         return []
@@ -132,6 +357,8 @@ class L10nEsAeatReportTaxMapping(models.AbstractModel):
         :param map_line: Mapping line record
         :return: Move lines recordset that matches the criteria.
         """
+        if self._is_map_line_skipped(map_line):
+            return self.env['account.move.line']
         domain = self._get_move_line_domain(
             codes, date_start, date_end, map_line,
         )
@@ -149,6 +376,9 @@ class L10nEsAeatReportTaxMapping(models.AbstractModel):
     @api.multi
     def _process_tax_line_regularization(self, tax_lines):
         self.ensure_one()
+        # Freeze the journal items if the report wasn't confirmed before
+        tax_lines.filtered(
+            lambda x: not x.audit_move_line_ids)._store_audit_move_lines()
         groups = self.env['account.move.line'].read_group(
             [('id', 'in', tax_lines.mapped('move_line_ids').ids)],
             ['debit', 'credit', 'account_id'],
@@ -24,9 +24,25 @@ class L10nEsAeatTaxLine(models.Model):
     map_line_id = fields.Many2one(
         comodel_name='l10n.es.aeat.map.tax.line', string="Map line",
         required=True, ondelete='cascade', oldname='map_line')
+    date_start = fields.Date(string="Start date", readonly=True)
+    date_end = fields.Date(string="End date", readonly=True)
     move_line_ids = fields.Many2many(
         comodel_name='account.move.line', string='Journal items',
-        oldname='move_lines')
+        compute='_compute_move_line_ids',
+        help="Journal items the amount has been computed from. Unless they "
+             "have been stored when confirming the report, they are searched "
+             "again on each read, so they reflect the current journal items. "
+             "As they are not stored, this field can't be used as dependency "
+             "of stored computed fields.",
+    )
+    audit_move_line_ids = fields.Many2many(
+        comodel_name='account.move.line',
+        relation='account_move_line_l10n_es_aeat_tax_line_rel',
+        column1='l10n_es_aeat_tax_line_id',
+        column2='account_move_line_id',
+        string='Audited journal items', readonly=True,
+        help="Journal items stored when the report was confirmed.",
+    )
     to_regularize = fields.Boolean(
         related='map_line_id.to_regularize', readonly=True,
     )
@@ -43,6 +59,52 @@ class L10nEsAeatTaxLine(models.Model):
         for s in self:
             s.model_id = self.env["ir.model"].search([("model", "=", s.model)])
 
+    @api.model
+    def _create_tax_lines(self, vals_list):
+        """Create the tax lines of a report in a single batch. The map lines
+        are read at once before, so their related values aren't fetched on
+        each creation.
+
+        :param vals_list: List of dictionaries of values, as returned by
+          ``_prepare_tax_line_vals`` of the report.
+        :return: Created records.
+        """
+        if not vals_list:
+            return self.browse()
+        map_lines = self.env['l10n.es.aeat.map.tax.line'].browse(
+            [x['map_line_id'] for x in vals_list])
+        map_lines.read(['field_number', 'name'])
+        return self.create(vals_list)
+
+    @api.multi
+    def _get_move_lines(self):
+        """Search the journal items the amount has been computed from.
+
+        :return: Move lines recordset.
+        """
+        self.ensure_one()
+        report = self.env[self.model].browse(self.res_id)
+        map_line = self.map_line_id
+        date_start, date_end = report._get_tax_line_dates(map_line)
+        return report._get_tax_lines(
+            map_line.mapped('tax_ids.description'),
+            self.date_start or date_start, self.date_end or date_end,
+            map_line,
+        )
+
+    @api.multi
+    def _compute_move_line_ids(self):
+        for line in self:
+            if line.audit_move_line_ids:
+                line.move_line_ids = line.audit_move_line_ids
+            else:
+                line.move_line_ids = line._get_move_lines()
+
+    @api.multi
+    def _store_audit_move_lines(self):
+        for line in self:
+            line.audit_move_line_ids = [(6, 0, line._get_move_lines().ids)]
+
     @api.multi
     def get_calculated_move_lines(self):
         res = self.env.ref('account.action_account_moves_all_a').read()[0]
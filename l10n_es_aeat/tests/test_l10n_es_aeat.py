@@ -14,3 +14,20 @@ class TestL10nEsAeat(common.TransactionCase):
         self.assertEqual(
             self.export_model._format_string(text, len(text)),
             " &'(),-./01:;ABAB_ÇÑAEIOUAEIOU   ".encode('iso-8859-1'))
+
+    def test_format_alphabetic_string(self):
+        self.assertEqual(
+            self.export_model._format_alphabetic_string('Año-2019 ñ', 8),
+            "AÑO Ñ   ".encode('iso-8859-1'))
+
+    def test_format_number(self):
+        self.assertEqual(
+            self.export_model._format_number(55.23, 3, 2), '05523')
+        self.assertEqual(
+            self.export_model._format_number(-0.5, 2, 2, True), 'N0050')
+        self.assertEqual(
+            self.export_model._format_number(7.9, 3, include_sign=True),
+            ' 007')
+        self.assertEqual(self.export_model._format_number('', 2, 1), '000')
+        with self.assertRaises(AssertionError):
+            self.export_model._format_number(1000, 3)
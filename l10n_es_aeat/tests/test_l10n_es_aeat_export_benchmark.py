@@ -0,0 +1,100 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import logging
+import os
+import tempfile
+import time
+
+from odoo.tests import common, tagged
+
+from . import test_l10n_es_aeat_export_config as export_config_tests
+
+_logger = logging.getLogger(__name__)
+
+BENCHMARK_SIZES = [
+    int(x) for x in os.environ.get(
+        'AEAT_BENCHMARK_SIZES', '1000,10000').split(',')
+]
+
+
+@tagged('-standard', 'aeat_benchmark')
+class TestL10nEsAeatExportBenchmark(common.TransactionCase):
+    """Benchmarks of the BOE export. They are not executed by default:
+    launch them with ``--test-tags aeat_benchmark``. The number of records
+    can be changed with the environment variable ``AEAT_BENCHMARK_SIZES``
+    (comma separated)."""
+
+    def setUp(self):
+        super(TestL10nEsAeatExportBenchmark, self).setUp()
+        self.export_to_boe = self.env[
+            'l10n.es.aeat.report.export_to_boe'].create({
+                'name': 'test_export_to_boe.txt',
+            })
+        self.report = self.env['l10n.es.aeat.report'].new({'name': 'Test'})
+
+    def _repeat_config(self, export_config, size):
+        """Configuration that exports the given one once per record."""
+        return self.env['aeat.model.export.config'].create({
+            'name': 'Test Export Benchmark',
+            'model_number': '000',
+            'config_line_ids': [(0, 0, {
+                'sequence': 1,
+                'name': 'Records',
+                'export_type': 'subconfig',
+                'subconfig_id': export_config.id,
+                'repeat_expression': '[object] * %s' % size,
+            })],
+        })
+
+    def _measure(self, func):
+        start = time.time()
+        res = func()
+        return time.time() - start, res
+
+    def _benchmark_config(self, name, export_config, expected):
+        for size in BENCHMARK_SIZES:
+            config = self._repeat_config(export_config, size)
+            with tempfile.SpooledTemporaryFile() as stream:
+                elapsed, res = self._measure(
+                    lambda: self.export_to_boe._export_config(
+                        self.report, config, stream),
+                )
+                stream.seek(0)
+                self.assertEqual(stream.read(), expected * size)
+            _logger.info(
+                "BOE export of %s records of the %s configuration: %.2fs, "
+                "%.1f records/s",
+                size, name, elapsed, size / (elapsed or 1),
+            )
+
+    def test_benchmark_export_config_file(self):
+        self._benchmark_config(
+            'file',
+            export_config_tests.TestL10nEsAeatExportConfig.
+            _create_export_config_file(self),
+            b'<T           001001500X >',
+        )
+
+    def test_benchmark_export_config_compiled(self):
+        self._benchmark_config(
+            'compiled',
+            export_config_tests.TestL10nEsAeatExportConfig.
+            _create_export_config_compiled(self),
+            b'<TEST>  0404',
+        )
+
+    def test_benchmark_format(self):
+        text = "Compañía de Ávila, S.L. - Çedilla 123"
+        for size in BENCHMARK_SIZES:
+            string_time, res = self._measure(lambda: [
+                self.export_to_boe._format_string(text, 40)
+                for x in range(size)
+            ])
+            number_time, res = self._measure(lambda: [
+                self.export_to_boe._format_number(x / 7.0, 15, 2, True)
+                for x in range(-size // 2, size // 2)
+            ])
+            _logger.info(
+                "BOE format of %s fields: strings %.2fs, numbers %.2fs",
+                size, string_time, number_time,
+            )
@@ -1,5 +1,9 @@
 # © 2017 FactorLibre - Hugo Santos <hugo.santos@factorlibre.com>
 # License AGPL-3 - See http://www.gnu.org/licenses/agpl-3.0
+import base64
+import io
+from unittest import mock
+
 from odoo.tests import common
 
 
@@ -33,7 +37,7 @@ class TestL10nEsAeatExportConfig(common.TransactionCase):
             self.assertFalse(export_line_subtype.apply_sign,
                              'Apply sign must be False for a subtype line')
 
-    def test_export_config_file(self):
+    def _create_export_config_file(self):
         export_subconfig = self.env['aeat.model.export.config'].create({
             'name': 'Test Export Sub Config',
             'model_number': '000',
@@ -47,7 +51,7 @@ class TestL10nEsAeatExportConfig(common.TransactionCase):
                     'alignment': 'left'
                 })]
         })
-        export_config = self.env['aeat.model.export.config'].create({
+        return self.env['aeat.model.export.config'].create({
             'name': 'Test Export Config',
             'model_number': '000',
             'config_line_ids': [
@@ -118,6 +122,9 @@ class TestL10nEsAeatExportConfig(common.TransactionCase):
                 })
             ]
         })
+
+    def test_export_config_file(self):
+        export_config = self._create_export_config_file()
         new_report = self.env['l10n.es.aeat.report'].new({
             'name': 'Test Report'
         })
@@ -127,3 +134,88 @@ class TestL10nEsAeatExportConfig(common.TransactionCase):
         export_file = export_to_boe._export_config(
             new_report, export_config)
         self.assertEqual(b'<T           001001500X >', export_file)
+
+    def _create_export_config_compiled(self):
+        return self.env['aeat.model.export.config'].create({
+            'name': 'Test Export Config',
+            'model_number': '000',
+            'config_line_ids': [
+                (0, 0, {
+                    'sequence': 1,
+                    'name': 'Name',
+                    'expression': '<${object.name}>',
+                    'export_type': 'string',
+                    'size': 8,
+                    'alignment': 'left'
+                }),
+                (0, 0, {
+                    'sequence': 2,
+                    'name': 'Repeated',
+                    'repeat_expression': '[object, object]',
+                    'conditional_expression': 'object.name',
+                    'expression': '${len(object.name)}',
+                    'export_type': 'integer',
+                    'size': 2,
+                    'alignment': 'right'
+                }),
+            ]
+        })
+
+    def test_export_config_compiled(self):
+        export_config = self._create_export_config_compiled()
+        new_report = self.env['l10n.es.aeat.report'].new({
+            'name': 'Test'
+        })
+        export_to_boe = self.env['l10n.es.aeat.report.export_to_boe'].create({
+            'name': 'test_export_to_boe.txt'
+        })
+        self.assertEqual(
+            export_to_boe._export_config(new_report, export_config),
+            b'<TEST>  0404',
+        )
+        # The compiled configuration is refreshed when it's modified
+        export_config.config_line_ids[:1].expression = '${object.name}'
+        self.assertEqual(
+            export_to_boe._export_config(new_report, export_config),
+            b'TEST    0404',
+        )
+        export_config.config_line_ids[1:].expression = '${object.id(}'
+        with self.assertRaises(SyntaxError):
+            export_to_boe._export_config(new_report, export_config)
+        # Records are appended to the given stream
+        export_config.config_line_ids[1:].expression = '${len(object.name)}'
+        stream = io.BytesIO(b'>')
+        stream.seek(1)
+        export_to_boe._export_config(new_report, export_config, stream)
+        self.assertEqual(stream.getvalue(), b'>TEST    0404')
+        # Same errors than safe_eval
+        export_config.config_line_ids[1:].expression = '${1 / 0}'
+        with self.assertRaises(ZeroDivisionError):
+            export_to_boe._export_config(new_report, export_config)
+        export_config.config_line_ids[1:].expression = '${undefined}'
+        with self.assertRaises(ValueError):
+            export_to_boe._export_config(new_report, export_config)
+        # A line is exported from its record, with a new copy of the context
+        # on each evaluation
+        line = export_config.config_line_ids[:1]
+        line.expression = (
+            "${context.update(key='X') or ''}${context.get('key', '-')}"
+        )
+        self.assertEqual(
+            export_to_boe._export_line_process(new_report, line),
+            b'-       ',
+        )
+
+    def test_encode_stream(self):
+        export_to_boe = self.env['l10n.es.aeat.report.export_to_boe'].create({
+            'name': 'test_export_to_boe.txt'
+        })
+        content = bytes(range(256)) * 4
+        with mock.patch(
+            'odoo.addons.l10n_es_aeat.wizard.export_to_boe.ENCODE_CHUNK_SIZE',
+            9,
+        ):
+            self.assertEqual(
+                export_to_boe._encode_stream(io.BytesIO(content)),
+                base64.b64encode(content),
+            )
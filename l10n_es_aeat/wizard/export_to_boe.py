@@ -6,11 +6,52 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
 import base64
+import io
+import logging
 import re
-from odoo.tools.safe_eval import safe_eval
+import tempfile
+import werkzeug.exceptions
+from psycopg2 import OperationalError
+from odoo.http import AuthenticationError
+from odoo.tools.safe_eval import _BUILTINS, unsafe_eval
 from odoo import _, api, fields, exceptions, models, tools
 
-EXPRESSION_PATTERN = re.compile(r'(\$\{.+?\})')
+_logger = logging.getLogger(__name__)
+
+try:
+    from unidecode import unidecode
+except (ImportError, IOError) as err:
+    _logger.debug(err)
+
+# Exported files bigger than this are written on a temporary file
+SPOOL_MAX_SIZE = 16 * 1024 * 1024
+# Bytes encoded at once, multiple of 3 so the encoded chunks can be joined
+ENCODE_CHUNK_SIZE = 3 * 1024 * 1024
+# Characters not allowed on the alphanumeric fields
+STRING_INVALID_PATTERN = re.compile(r"[^A-Z0-9\s\.,-_&'´\\:;/\(\)ÑÇ]")
+# Characters removed from the alphabetic fields
+ALPHABETIC_INVALID_PATTERN = re.compile(r"[\d-]")
+
+
+class BoeTranslationTable(dict):
+    """Translation table for ``str.translate`` that replaces each character
+    by its ASCII transliteration, except 'Ñ' and 'Ç'. The ASCII characters
+    are mapped to themselves, and the rest are transliterated on first use
+    and kept for the next ones."""
+
+    def __init__(self):
+        super(BoeTranslationTable, self).__init__(
+            (x, chr(x)) for x in range(128)
+        )
+
+    def __missing__(self, key):
+        char = chr(key)
+        value = char if char in ('Ñ', 'Ç') else unidecode(char)
+        self[key] = value
+        return value
+
+
+boe_translation_table = BoeTranslationTable()
 
 
 class L10nEsAeatReportExportToBoe(models.TransientModel):
@@ -18,7 +59,12 @@ class L10nEsAeatReportExportToBoe(models.TransientModel):
     _description = "Export Report to BOE Format"
 
     name = fields.Char(string="File name", readonly=True)
-    data = fields.Binary(string="File", readonly=True)
+    attachment_id = fields.Many2one(
+        comodel_name='ir.attachment', string="Attachment", readonly=True,
+    )
+    data = fields.Binary(
+        string="File", related='attachment_id.datas', readonly=True,
+    )
     state = fields.Selection(
         selection=[
             ('open', 'open'),
@@ -40,12 +86,8 @@ class L10nEsAeatReportExportToBoe(models.TransientModel):
         if not text:
             return fill * length
         # Replace accents and convert to upper
-        from unidecode import unidecode
-        text = text.upper()
-        text = ''.join([unidecode(x) if x not in ('Ñ', 'Ç') else x
-                        for x in text])
-        text = re.sub(
-            r"[^A-Z0-9\s\.,-_&'´\\:;/\(\)ÑÇ]", '', text, re.UNICODE | re.X)
+        text = text.upper().translate(boe_translation_table)
+        text = STRING_INVALID_PATTERN.sub('', text)
         ascii_string = text.encode('iso-8859-1')
         # Cut the string if it is too long
         if len(ascii_string) > length:
@@ -71,7 +113,7 @@ class L10nEsAeatReportExportToBoe(models.TransientModel):
         if not text:
             return fill * length
         # Replace numbers
-        name = re.sub(r"[\d-]", '', text, re.UNICODE | re.X)
+        name = ALPHABETIC_INVALID_PATTERN.sub('', text)
         return self._format_string(name, length, fill=fill, align=align)
 
     def _format_number(self, number, int_length, dec_length=0,
@@ -84,31 +126,28 @@ class L10nEsAeatReportExportToBoe(models.TransientModel):
             y rellenos a ceros por la izquierda sin signos y sin empaquetar.'
             (http://www.boe.es/boe/dias/2008/10/23/pdfs/A42154-42190.pdf)
         """
-        #
-        # Separate the number parts (-55.23 => int_part=55,
-        # dec_part=0.23, sign='N')
-        #
         if number == '':
             number = 0.0
         number = float(number)
         sign = number >= 0 and positive_sign or negative_sign
         number = abs(number)
-        int_part = int(number)
-        # Format the string
-        ascii_string = ''
-        if include_sign:
-            ascii_string += sign
+        # Format the string in a single operation, without the decimal
+        # separator
         if dec_length > 0:
-            ascii_string += '%0*.*f' % (int_length + dec_length + 1,
-                                        dec_length, number)
-            ascii_string = ascii_string.replace('.', '')
+            ascii_string = '%0*.*f' % (
+                int_length + dec_length + 1, dec_length, number)
+            ascii_string = (
+                ascii_string[:-dec_length - 1] + ascii_string[-dec_length:])
         elif int_length > 0:
-            ascii_string += '%.*d' % (int_length, int_part)
+            ascii_string = '%0*d' % (int_length, int(number))
+        else:
+            ascii_string = ''
+        if include_sign:
+            ascii_string = sign + ascii_string
         # Sanity-check
         assert len(ascii_string) == (include_sign and 1 or 0) + int_length + \
             dec_length, _("The formated string must match the given length")
-        # Return the string assuring that is not unicode
-        return str(ascii_string)
+        return ascii_string
 
     def _format_boolean(self, value, yes='X', no=' '):
         """Format a boolean value into a fixed length ASCII (iso-8859-1) record.
@@ -132,13 +171,8 @@ class L10nEsAeatReportExportToBoe(models.TransientModel):
         if not active_id or not active_model:
             return False
         report = self.env[active_model].browse(active_id)
-        contents = b''
-        if report.export_config_id:
-            contents += self.action_get_file_from_config(report)
-        else:
+        if not report.export_config_id:
             raise exceptions.UserError(_('No export configuration selected.'))
-        # Generate the file and save as attachment
-        file = base64.encodestring(contents)
         file_name = _("%s_report_%s.txt") % (report.number,
                                              fields.Date.today())
         # Delete old files
@@ -147,13 +181,22 @@ class L10nEsAeatReportExportToBoe(models.TransientModel):
             [('name', '=', file_name),
              ('res_model', '=', report._name)])
         attachment_ids.unlink()
-        attachment_obj.create({"name": file_name,
-                               "datas": file,
-                               "datas_fname": file_name,
-                               "res_model": report._name,
-                               "res_id": report.id,
-                               })
-        self.write({'state': 'get', 'data': file, 'name': file_name})
+        # Generate the file and save as attachment
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as stream:
+            self.action_get_file_from_config(report, stream)
+            datas = self._encode_stream(stream)
+        attachment = attachment_obj.create({
+            "name": file_name,
+            "datas": datas,
+            "datas_fname": file_name,
+            "res_model": report._name,
+            "res_id": report.id,
+        })
+        self.write({
+            'state': 'get',
+            'attachment_id': attachment.id,
+            'name': file_name,
+        })
         # Force view to be the parent one
         data_obj = self.env.ref('l10n_es_aeat.wizard_aeat_export')
         # TODO: Permitir si se quiere heredar la vista padre
@@ -167,58 +210,125 @@ class L10nEsAeatReportExportToBoe(models.TransientModel):
             'target': 'new',
         }
 
+    @api.model
+    def _encode_stream(self, stream):
+        """Encode in base64 the content of a binary file object by chunks, so
+        the exported file isn't held in memory together with its encoded
+        copy.
+
+        :param stream: Binary file object with the exported records.
+        :return: Encoded bytes.
+        """
+        stream.seek(0)
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as out:
+            for chunk in iter(lambda: stream.read(ENCODE_CHUNK_SIZE), b''):
+                out.write(base64.b64encode(chunk))
+            out.seek(0)
+            return out.read()
+
     @api.multi
-    def action_get_file_from_config(self, report):
+    def action_get_file_from_config(self, report, stream=None):
         self.ensure_one()
-        return self._export_config(report, report.export_config_id)
+        return self._export_config(report, report.export_config_id, stream)
 
     @api.multi
-    def _export_config(self, obj, export_config):
+    def _export_config(self, obj, export_config, stream=None):
+        """Export a record with an export configuration.
+
+        :param obj: Record to export.
+        :param export_config: Export configuration record.
+        :param stream: Binary file object where the records are appended. If
+          not given, the exported bytes are returned.
+        """
         self.ensure_one()
-        contents = b''
-        for line in export_config.config_line_ids:
-            contents += self._export_line_process(obj, line)
-        return contents
+        if stream is None:
+            stream = io.BytesIO()
+            self._export_config(obj, export_config, stream)
+            return stream.getvalue()
+        compiled_lines = export_config._get_compiled_lines(export_config.id)
+        lines = self.env['aeat.model.export.config.line'].browse(
+            [x.id for x in compiled_lines])
+        for line, compiled in zip(lines, compiled_lines):
+            self._export_line_process(obj, line, stream, compiled=compiled)
+
+    @api.model
+    def _merge_eval(self, compiled, values):
+        """Evaluate a compiled expression, with the same restrictions and
+        errors than ``safe_eval``.
+
+        :param compiled: Tuple (expression, code object).
+        :param values: Dictionary with the evaluation context. A copy of the
+          environment context is added on each evaluation.
+        """
+        expr, code = compiled
+        eval_context = dict(
+            values, __builtins__=_BUILTINS,
+            # copy context to prevent side-effects of eval
+            context=self.env.context.copy(),
+        )
+        try:
+            return unsafe_eval(code, eval_context)
+        except (exceptions.except_orm, exceptions.Warning,
+                exceptions.RedirectWarning, exceptions.AccessDenied,
+                werkzeug.exceptions.HTTPException, AuthenticationError,
+                OperationalError, ZeroDivisionError):
+            raise
+        except Exception as e:
+            raise ValueError(
+                '%s: "%s" while evaluating\n%r' % (type(e), e, expr))
 
     @api.multi
-    def _export_line_process(self, obj, line):
-        # usar esta variable para resolver las expresiones
-        obj_merge = obj
-
-        def merge_eval(exp):
-            return safe_eval(exp, {
-                'user': self.env.user,
-                'object': obj_merge,
-                # copy context to prevent side-effects of eval
-                'context': self.env.context.copy(),
-            })
-
-        def merge(match):
-            exp = str(match.group()[2:-1]).strip()
-            result = merge_eval(exp)
-            return result and tools.ustr(result) or ''
-
-        val = b''
-        if line.conditional_expression:
-            if not merge_eval(line.conditional_expression):
-                return val
-        if line.repeat_expression:
-            obj_list = merge_eval(line.repeat_expression)
+    def _export_line_process(self, obj, line, stream=None, compiled=None):
+        """Export a line of an export configuration.
+
+        :param obj: Record to export.
+        :param line: Export configuration line record.
+        :param stream: Binary file object where the records are appended. If
+          not given, the exported bytes are returned.
+        :param compiled: ``ExportLine`` with the compiled expressions of the
+          line, as returned by ``_get_compiled_lines`` of the export
+          configuration. If not given, it's taken from there.
+        """
+        if stream is None:
+            stream = io.BytesIO()
+            self._export_line_process(obj, line, stream, compiled=compiled)
+            return stream.getvalue()
+        if compiled is None:
+            config = line.export_config_id
+            compiled = next(
+                x for x in config._get_compiled_lines(config.id)
+                if x.id == line.id
+            )
+        values = {
+            'user': self.env.user,
+            'object': obj,
+        }
+        if compiled.conditional_code:
+            if not self._merge_eval(compiled.conditional_code, values):
+                return
+        if compiled.repeat_code:
+            obj_list = self._merge_eval(compiled.repeat_code, values)
         else:
             obj_list = [obj]
         for obj_merge in obj_list:
             if line.export_type == 'subconfig':
-                val += self._export_config(obj_merge, line.subconfig_id)
+                self._export_config(obj_merge, line.subconfig_id, stream)
+                continue
+            if compiled.expression_parts:
+                values['object'] = obj_merge
+                field_val = ''
+                for part in compiled.expression_parts:
+                    if isinstance(part, str):
+                        field_val += part
+                        continue
+                    result = self._merge_eval(part, values)
+                    field_val += result and tools.ustr(result) or ''
             else:
-                if line.expression:
-                    field_val = EXPRESSION_PATTERN.sub(merge, line.expression)
-                else:
-                    field_val = line.fixed_value
-                record = self._export_simple_record(line, field_val)
-                if isinstance(record, str):
-                    record = record.encode('iso-8859-1')
-                val += record
-        return val
+                field_val = line.fixed_value
+            record = self._export_simple_record(line, field_val)
+            if isinstance(record, str):
+                record = record.encode('iso-8859-1')
+            stream.write(record)
 
     @api.multi
     def _export_simple_record(self, line, val):
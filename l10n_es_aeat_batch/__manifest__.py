@@ -0,0 +1,24 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+
+{
+    'name': 'AEAT - Cálculo por lotes',
+    'summary': "Cálculo en paralelo de declaraciones AEAT de varias "
+               "compañías y periodos",
+    'version': '12.0.1.1.0',
+    'category': "Localisation/Accounting",
+    'author': "Spanish Localization Team, "
+              "Odoo Community Association (OCA)",
+    'website': "https://github.com/OCA/l10n-spain",
+    'license': 'AGPL-3',
+    'depends': [
+        'l10n_es_aeat',
+        'queue_job',
+    ],
+    'data': [
+        'security/ir.model.access.csv',
+        'data/queue_job_data.xml',
+        'data/ir_cron.xml',
+        'views/l10n_es_aeat_report_batch_view.xml',
+    ],
+    'installable': True,
+}
@@ -0,0 +1,245 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+
+import logging
+import time
+
+from psycopg2 import OperationalError
+
+from odoo import _, api, exceptions, fields, models
+
+_logger = logging.getLogger(__name__)
+
+try:
+    from odoo.addons.queue_job.job import job
+except ImportError:
+    _logger.debug('Can not `import queue_job`.')
+    import functools
+
+    def empty_decorator_factory(*argv, **kwargs):
+        return functools.partial
+    job = empty_decorator_factory
+
+# States of the queue jobs that can still calculate their report
+JOB_RUNNING_STATES = ('pending', 'enqueued', 'started')
+
+
+class L10nEsAeatReportBatch(models.Model):
+    _name = 'l10n.es.aeat.report.batch'
+    _description = 'AEAT reports batch calculation'
+    _order = 'id desc'
+
+    name = fields.Char(string="Name", required=True)
+    model_ids = fields.Many2many(
+        comodel_name='ir.model', string="Models", required=True,
+        domain=[('model', '=like', 'l10n.es.aeat.%.report')],
+    )
+    company_ids = fields.Many2many(
+        comodel_name='res.company', string="Companies", required=True,
+    )
+    year = fields.Integer(
+        string="Year", required=True,
+        default=lambda self: fields.Date.today().year,
+    )
+    period_types = fields.Char(
+        string="Period types",
+        help="Period types of the reports to calculate, separated by commas "
+             "(for example, 1T,2T). Leave it empty for all the periods.",
+    )
+    scheduled = fields.Boolean(
+        string="Scheduled",
+        help="Calculate the reports again on each execution of the "
+             "scheduled action.",
+    )
+    line_ids = fields.One2many(
+        comodel_name='l10n.es.aeat.report.batch.line',
+        inverse_name='batch_id', string="Reports", readonly=True,
+    )
+    state = fields.Selection(
+        selection=[
+            ('draft', 'Draft'),
+            ('running', 'Running'),
+            ('done', 'Done'),
+        ], string="State", compute='_compute_progress',
+    )
+    progress = fields.Float(string="Progress", compute='_compute_progress')
+    failed_count = fields.Integer(
+        string="Failed", compute='_compute_progress',
+    )
+
+    @api.multi
+    @api.depends('line_ids.state')
+    def _compute_progress(self):
+        for batch in self:
+            lines = batch.line_ids
+            # Lines whose job has ended without calculating the report (for
+            # example, cancelled or failed outside it) are failed too
+            pending = lines.filtered(
+                lambda x: x.state == 'pending' and
+                x.job_state in JOB_RUNNING_STATES)
+            batch.failed_count = len(
+                lines.filtered(lambda x: x.state != 'done') - pending)
+            if not lines:
+                batch.state = 'draft'
+                batch.progress = 0.0
+                continue
+            batch.state = 'running' if pending else 'done'
+            batch.progress = 100.0 * (len(lines) - len(pending)) / len(lines)
+
+    @api.multi
+    def _get_reports(self):
+        """Reports of the batch that can be calculated.
+
+        :return: List of report records.
+        """
+        self.ensure_one()
+        domain = [
+            ('company_id', 'in', self.company_ids.ids),
+            ('year', '=', self.year),
+            ('state', 'in', ['draft', 'calculated']),
+        ]
+        if self.period_types:
+            domain.append(('period_type', 'in', [
+                x.strip() for x in self.period_types.split(',') if x.strip()
+            ]))
+        reports = []
+        for model in self.model_ids:
+            if model.model not in self.env:
+                continue
+            reports += list(self.env[model.model].search(
+                domain, order='company_id, date_start, id',
+            ))
+        return reports
+
+    @api.multi
+    def action_calculate(self):
+        """Queue a job for calculating each report of the batch. Each job is
+        executed with its own transaction, so the reports are calculated in
+        parallel up to the capacity of the channel 'root.aeat_report'.
+        """
+        for batch in self:
+            if batch.state == 'running':
+                raise exceptions.UserError(
+                    _("The batch %s is still running.") % batch.name)
+        self._enqueue_reports()
+
+    @api.multi
+    def action_restart(self):
+        """Calculate again a running batch, when some of its jobs are not
+        going to end (for example, started by a worker that has been
+        killed). The jobs not started yet are cancelled.
+        """
+        uuids = [x for x in self.mapped('line_ids.job_uuid') if x]
+        self.env['queue.job'].sudo().search([
+            ('uuid', 'in', uuids),
+            ('state', 'in', ['pending', 'enqueued']),
+        ]).button_done()
+        self._enqueue_reports()
+
+    @api.multi
+    def _enqueue_reports(self):
+        line_obj = self.env['l10n.es.aeat.report.batch.line']
+        for batch in self:
+            batch.line_ids.unlink()
+            lines = line_obj.create([{
+                'batch_id': batch.id,
+                'model': report._name,
+                'res_id': report.id,
+                'company_id': report.company_id.id,
+                'period_type': report.period_type,
+                'name': report.name,
+            } for report in batch._get_reports()])
+            for line in lines:
+                job = line.with_delay(
+                    description=_("Calculate AEAT report %s") % line.name,
+                ).calculate_report()
+                line.job_uuid = job.uuid
+
+    @api.model
+    def _cron_calculate_batches(self):
+        batches = self.search([('scheduled', '=', True)])
+        batches.filtered(lambda x: x.state != 'running').action_calculate()
+
+
+class L10nEsAeatReportBatchLine(models.Model):
+    _name = 'l10n.es.aeat.report.batch.line'
+    _description = 'AEAT reports batch calculation line'
+    _order = 'batch_id, id'
+
+    batch_id = fields.Many2one(
+        comodel_name='l10n.es.aeat.report.batch', required=True,
+        ondelete='cascade', index=True,
+    )
+    name = fields.Char(string="Report", readonly=True)
+    model = fields.Char(string="Model name", required=True, readonly=True)
+    res_id = fields.Integer(
+        string="Report ID", required=True, readonly=True,
+    )
+    company_id = fields.Many2one(
+        comodel_name='res.company', string="Company", readonly=True,
+    )
+    period_type = fields.Char(string="Period type", readonly=True)
+    state = fields.Selection(
+        selection=[
+            ('pending', 'Pending'),
+            ('done', 'Done'),
+            ('failed', 'Failed'),
+        ], string="State", default='pending', required=True, readonly=True,
+    )
+    date_done = fields.Datetime(string="Calculation date", readonly=True)
+    duration = fields.Float(
+        string="Duration (s)", readonly=True, digits=(16, 3),
+    )
+    error = fields.Text(string="Error", readonly=True)
+    job_uuid = fields.Char(string="Job UUID", readonly=True, copy=False)
+    job_state = fields.Selection(
+        selection=[
+            ('pending', 'Pending'),
+            ('enqueued', 'Enqueued'),
+            ('started', 'Started'),
+            ('done', 'Done'),
+            ('failed', 'Failed'),
+        ], string="Job state", compute='_compute_job_state',
+    )
+
+    @api.multi
+    def _compute_job_state(self):
+        jobs = self.env['queue.job'].sudo().search_read([
+            ('uuid', 'in', [x for x in self.mapped('job_uuid') if x]),
+        ], ['uuid', 'state'])
+        states = {x['uuid']: x['state'] for x in jobs}
+        for line in self:
+            line.job_state = states.get(line.job_uuid, False)
+
+    @job(default_channel='root.aeat_report')
+    @api.multi
+    def calculate_report(self):
+        """Calculate the report of the line, recording the result and the
+        time spent on it. A failed calculation is rolled back and recorded
+        on the line, without affecting the rest of the batch."""
+        self.ensure_one()
+        report = self.env[self.model].browse(self.res_id).exists()
+        start = time.time()
+        error = False
+        try:
+            if not report:
+                raise exceptions.UserError(_("The report doesn't exist."))
+            with self.env.cr.savepoint():
+                report.with_context(
+                    force_company=report.company_id.id,
+                ).button_calculate()
+        except OperationalError:
+            # Let queue_job retry the concurrency errors
+            raise
+        except Exception as e:
+            _logger.exception("Error calculating AEAT report %s", self.name)
+            error = str(e)
+        duration = time.time() - start
+        _logger.info(
+            "AEAT report %s calculated in %.3f seconds", self.name, duration,
+        )
+        self.write({
+            'state': 'failed' if error else 'done',
+            'date_done': fields.Datetime.now(),
+            'duration': duration,
+            'error': error,
+        })
@@ -0,0 +1,104 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from unittest import mock
+
+from psycopg2 import OperationalError
+
+from odoo.tests import common, tagged
+from odoo.addons.l10n_es_aeat.tests import test_l10n_es_aeat_report
+
+
+@tagged('post_install', '-at_install')
+class TestL10nEsAeatBatch(common.SavepointCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        test_l10n_es_aeat_report.TestL10nEsAeatReport._init_test_model(
+            cls, test_l10n_es_aeat_report.L10nEsAeatTestReport)
+        cls.company = cls.env.user.company_id
+        cls.reports = cls.env[test_l10n_es_aeat_report.TEST_MODEL_NAME]
+        for period_type in ['1T', '2T']:
+            cls.reports |= cls.reports.create({
+                'name': 'TEST%s' % period_type,
+                'company_id': cls.company.id,
+                'company_vat': '12345678Z',
+                'contact_name': 'Test owner',
+                'contact_phone': '911234455',
+                'year': 2016,
+                'period_type': period_type,
+                'date_start': '2016-01-01',
+                'date_end': '2016-12-31',
+            })
+        cls.batch = cls.env['l10n.es.aeat.report.batch'].create({
+            'name': 'Test batch',
+            'model_ids': [(6, 0, cls.env['ir.model'].search([
+                ('model', '=', test_l10n_es_aeat_report.TEST_MODEL_NAME),
+            ]).ids)],
+            'company_ids': [(6, 0, cls.company.ids)],
+            'year': 2016,
+        })
+
+    def test_batch_calculate(self):
+        self.batch.period_types = '1T'
+        self.batch.action_calculate()
+        self.assertEqual(len(self.batch.line_ids), 1)
+        self.assertEqual(self.batch.state, 'running')
+        self.batch.line_ids.calculate_report()
+        self.assertEqual(self.batch.state, 'done')
+        self.assertEqual(self.batch.progress, 100.0)
+        self.assertTrue(self.batch.line_ids.date_done)
+        self.assertEqual(
+            self.reports.mapped('state'), ['calculated', 'draft'],
+        )
+
+    def test_batch_calculate_failed(self):
+        self.batch.action_calculate()
+        self.assertEqual(len(self.batch.line_ids), 2)
+        with mock.patch.object(
+            type(self.reports), 'calculate', side_effect=Exception('Error'),
+        ):
+            self.batch.line_ids[:1].calculate_report()
+        self.batch.line_ids[1:].calculate_report()
+        self.assertEqual(self.batch.failed_count, 1)
+        self.assertEqual(self.batch.line_ids[:1].error, 'Error')
+        self.assertEqual(
+            self.reports.mapped('state'), ['draft', 'calculated'],
+        )
+
+    def test_batch_calculate_job_lost(self):
+        self.batch.period_types = '1T'
+        self.batch.action_calculate()
+        line = self.batch.line_ids
+        self.assertTrue(line.job_uuid)
+        self.assertEqual(line.job_state, 'pending')
+        self.assertEqual(self.batch.state, 'running')
+        # The job is cancelled without calculating the report
+        self.env['queue.job'].search([
+            ('uuid', '=', line.job_uuid),
+        ]).button_done()
+        self.batch.invalidate_cache()
+        self.assertEqual(self.batch.state, 'done')
+        self.assertEqual(self.batch.failed_count, 1)
+        self.batch.action_calculate()
+        self.assertNotEqual(self.batch.line_ids, line)
+
+    def test_batch_restart(self):
+        self.batch.period_types = '1T'
+        self.batch.action_calculate()
+        uuid = self.batch.line_ids.job_uuid
+        self.batch.action_restart()
+        self.assertEqual(
+            self.env['queue.job'].search([('uuid', '=', uuid)]).state, 'done',
+        )
+        self.assertEqual(self.batch.line_ids.job_state, 'pending')
+
+    def test_batch_calculate_concurrency_error(self):
+        self.batch.period_types = '1T'
+        self.batch.action_calculate()
+        with mock.patch.object(
+            type(self.reports), 'calculate',
+            side_effect=OperationalError('could not serialize access'),
+        ):
+            with self.assertRaises(OperationalError):
+                self.batch.line_ids.calculate_report()
+        self.assertEqual(self.batch.line_ids.state, 'pending')
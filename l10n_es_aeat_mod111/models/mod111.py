@@ -147,7 +147,7 @@ class L10nEsAeatMod111Report(models.Model):
         states={'draft': [('readonly', False)]}, default=False)
 
     @api.multi
-    @api.depends('tax_line_ids', 'tax_line_ids.move_line_ids.partner_id')
+    @api.depends('tax_line_ids')
     def _compute_casilla_01(self):
         casillas = (2, 3)
         for report in self:
@@ -157,7 +157,7 @@ class L10nEsAeatMod111Report(models.Model):
                 tax_lines.mapped('move_line_ids').mapped('partner_id'))
 
     @api.multi
-    @api.depends('tax_line_ids', 'tax_line_ids.move_line_ids.partner_id')
+    @api.depends('tax_line_ids')
     def _compute_casilla_04(self):
         casillas = (5, 6)
         for report in self:
@@ -167,7 +167,7 @@ class L10nEsAeatMod111Report(models.Model):
                 tax_lines.mapped('move_line_ids').mapped('partner_id'))
 
     @api.multi
-    @api.depends('tax_line_ids', 'tax_line_ids.move_line_ids.partner_id')
+    @api.depends('tax_line_ids')
     def _compute_casilla_07(self):
         casillas = (8, 9)
         for report in self:
@@ -90,7 +90,7 @@ class L10nEsAeatMod115Report(models.Model):
                     'You should select another Result type'))
 
     @api.multi
-    @api.depends('tax_line_ids', 'tax_line_ids.move_line_ids')
+    @api.depends('tax_line_ids')
     def _compute_casilla_01(self):
         casillas = (2, 3)
         for report in self:
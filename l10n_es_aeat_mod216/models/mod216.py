@@ -49,7 +49,7 @@ class L10nEsAeatMod216Report(models.Model):
         states={'draft': [('readonly', False)]}, required=True)
 
     @api.multi
-    @api.depends('tax_line_ids', 'tax_line_ids.move_line_ids.partner_id')
+    @api.depends('tax_line_ids')
     def _compute_casilla_01(self):
         casillas = (2, 3)
         for report in self:
@@ -21,6 +21,7 @@ class L10nEsAeatMod303Report(models.Model):
     _name = "l10n.es.aeat.mod303.report"
     _description = "AEAT 303 Report"
     _aeat_number = '303'
+    _aggregate_tax_lines = True
 
     def _default_counterpart_303(self):
         return self.env['account.account'].search([
@@ -375,30 +376,28 @@ class L10nEsAeatMod303Report(models.Model):
                 'The fee to compensate must be indicated as a positive number.'
             ))
 
-    def _get_tax_lines(self, codes, date_start, date_end, map_line):
+    def _is_map_line_skipped(self, map_line):
         """Don't populate results for fields 79-99 for reports different from
         last of the year one or when not exonerated of presenting model 390.
         """
-        if 79 <= map_line.field_number <= 99:
-            if (self.exonerated_390 == '2' or not self.has_operation_volume
-                    or self.period_type not in ('4T', '12')):
-                return self.env['account.move.line']
-        return super(L10nEsAeatMod303Report, self)._get_tax_lines(
-            codes, date_start, date_end, map_line,
+        return 79 <= map_line.field_number <= 99 and (
+            self.exonerated_390 == '2' or not self.has_operation_volume or
+            self.period_type not in ('4T', '12')
         )
 
-    def _get_move_line_domain(self, codes, date_start, date_end, map_line):
+    def _get_tax_line_dates(self, map_line):
         """Changes dates to full year when the summary on last report of the
         year for the corresponding fields. Only field number is checked as
         the complete check for not bringing results is done on
-        `_get_tax_lines`.
+        `_is_map_line_skipped`.
         """
+        date_start, date_end = super(
+            L10nEsAeatMod303Report, self,
+        )._get_tax_line_dates(map_line)
         if 79 <= map_line.field_number <= 99:
             date_start = date_start.replace(day=1, month=1)
             date_end = date_end.replace(day=31, month=12)
-        return super(L10nEsAeatMod303Report, self)._get_move_line_domain(
-            codes, date_start, date_end, map_line,
-        )
+        return date_start, date_end
 
 
 class L10nEsAeatMod303ReportActivityCode(models.Model):
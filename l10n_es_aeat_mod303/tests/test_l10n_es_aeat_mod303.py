@@ -1,7 +1,9 @@
 # Copyright 2016-2019 Tecnativa - Pedro M. Baeza
 # License AGPL-3 - See http://www.gnu.org/licenses/agpl-3.0
 
+import base64
 import logging
+from unittest import mock
 from odoo.addons.l10n_es_aeat.tests.test_l10n_es_aeat_mod_base import \
     TestL10nEsAeatModBase
 from odoo import exceptions
@@ -300,6 +302,59 @@ class TestL10nEsAeatMod303(TestL10nEsAeatMod303Base):
         sale = self._invoice_sale_create('2017-01-13')
         self._invoice_refund(sale, '2017-01-14')
 
+    def test_model_303_aggregates(self):
+        self.assertTrue(self.model303_4t._use_tax_line_aggregates())
+        # Overridden hooks are not applied by the aggregates
+        with mock.patch.object(
+            type(self.model303_4t), '_get_move_line_domain',
+        ):
+            self.assertFalse(self.model303_4t._use_tax_line_aggregates())
+        self.model303_4t.exonerated_390 = '1'
+        self.model303_4t.button_calculate()
+        self.assertTrue(self.model303_4t.tax_line_ids)
+        model = self.env['ir.model']._get('l10n.es.aeat.mod303.report')
+        for tax_line in self.model303_4t.tax_line_ids:
+            # Stored related values are filled on the batch creation
+            self.assertEqual(
+                tax_line.field_number, tax_line.map_line_id.field_number)
+            self.assertEqual(tax_line.name, tax_line.map_line_id.name)
+            self.assertEqual(tax_line.model_id, model)
+            # Same result than searching the journal items of each map line
+            vals = self.model303_4t._prepare_tax_line_vals(
+                tax_line.map_line_id)
+            self.assertAlmostEqual(
+                tax_line.amount, vals['amount'], 2,
+                "Incorrect result in field %s" % tax_line.field_number,
+            )
+            # The journal items are resolved on demand for the drill-down
+            map_line = tax_line.map_line_id
+            move_lines = tax_line.move_line_ids
+            credit = sum(move_lines.mapped('credit'))
+            debit = sum(move_lines.mapped('debit'))
+            amount = {
+                'credit': credit, 'debit': debit, 'both': credit - debit,
+            }[map_line.sum_type]
+            self.assertAlmostEqual(
+                tax_line.amount, -amount if map_line.inverse else amount, 2,
+            )
+        self.env['ir.config_parameter'].sudo().set_param(
+            'l10n_es_aeat.audit_move_lines', 'False')
+        self.model303_4t.button_confirm()
+        self.assertFalse(
+            self.model303_4t.tax_line_ids.filtered(
+                lambda x: not x.to_regularize).mapped('audit_move_line_ids'),
+        )
+        self.model303_4t.state = 'calculated'
+        self.env['ir.config_parameter'].sudo().set_param(
+            'l10n_es_aeat.audit_move_lines', 'True')
+        self.model303_4t.button_confirm()
+        tax_line = self.model303_4t.tax_line_ids.filtered(
+            lambda x: x.field_number == 80)
+        self.assertTrue(tax_line.audit_move_line_ids)
+        self.assertEqual(
+            tax_line.move_line_ids, tax_line.audit_move_line_ids,
+        )
+
     def test_model_303(self):
         # Test default counterpart
         self.assertEqual(self.model303._default_counterpart_303().id,
@@ -359,10 +414,27 @@ class TestL10nEsAeatMod303(TestL10nEsAeatMod303Base):
             self.assertTrue(
                 export_to_boe._export_config(self.model303, export_config)
             )
+        export_to_boe.with_context(
+            active_id=self.model303.id, active_model=self.model303._name,
+        ).action_get_file()
+        self.assertEqual(export_to_boe.state, 'get')
+        self.assertEqual(export_to_boe.attachment_id.res_id, self.model303.id)
+        self.assertEqual(
+            base64.b64decode(export_to_boe.data),
+            export_to_boe._export_config(
+                self.model303, self.model303.export_config_id),
+        )
         with self.assertRaises(exceptions.ValidationError):
             self.model303.cuota_compensar = -250
         self.model303.button_post()
         self.assertTrue(self.model303.move_id)
+        # Journal items of the regularization are kept with the tax lines
+        tax_lines = self.model303.tax_line_ids.filtered('to_regularize')
+        self.assertTrue(tax_lines.mapped('audit_move_line_ids'))
+        self.assertFalse(
+            (self.model303.tax_line_ids - tax_lines).mapped(
+                'audit_move_line_ids'),
+        )
         self.assertEqual(self.model303.move_id.ref, self.model303.name)
         self.assertEqual(
             self.model303.move_id.journal_id, self.model303.journal_id,
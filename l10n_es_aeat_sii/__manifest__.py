@@ -12,7 +12,7 @@
 
 {
     "name": "Suministro Inmediato de Información en el IVA",
-    "version": "12.0.1.0.0",
+    "version": "12.0.1.11.0",
     "category": "Accounting & Finance",
     "website": "https://odoospain.odoo.com",
     "author": "Acysos S.L.,"
@@ -48,6 +48,7 @@
     "data": [
         "data/ir_config_parameter.xml",
         "data/aeat_sii_tax_agency_data.xml",
+        "data/ir_cron.xml",
         "views/res_company_view.xml",
         "views/account_invoice_view.xml",
         "views/aeat_sii_view.xml",
@@ -64,6 +65,9 @@
         "views/account_fiscal_position_view.xml",
         "views/res_partner_views.xml",
         "views/aeat_sii_tax_agency_view.xml",
+        "views/aeat_sii_reconciliation_view.xml",
+        "views/aeat_sii_payment_view.xml",
+        "views/aeat_sii_submission_view.xml",
     ],
     "post_init_hook": "add_key_to_existing_invoices",
 }
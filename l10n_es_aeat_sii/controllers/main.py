@@ -0,0 +1,15 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from odoo import http
+from odoo.http import request
+
+
+class SiiStatsController(http.Controller):
+
+    @http.route('/l10n_es_aeat_sii/stats', type='json', auth='user')
+    def sii_stats(self, hours=24):
+        """SII latency, throughput, error rate and queue lag statistics of
+        the last hours, per company and tax agency."""
+        submission_obj = request.env['aeat.sii.submission']
+        submission_obj.check_access_rights('read')
+        return submission_obj.get_sii_stats(hours=int(hours))
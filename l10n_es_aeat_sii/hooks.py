@@ -1,16 +1,55 @@
 # Copyright 2017 Oihane Crucelaegui - AvanzOSC
 # License AGPL-3 - See http://www.gnu.org/licenses/agpl-3.0.html
 
+import logging
+
 from odoo import api, SUPERUSER_ID
 
+_logger = logging.getLogger(__name__)
+
+# Range of invoice IDs updated on each statement
+KEY_UPDATE_CHUNK = 50000
+
+
+def _update_invoices_key(cr, key_id, purchase):
+    """Set the registration key on the invoices that don't have one, in
+    chunks of consecutive IDs, so each statement only touches a bounded
+    number of rows. Everything is done in the transaction of the module
+    installation, and as only the invoices without key are updated, running
+    it again has no effect on the ones already updated.
+
+    :param key_id: ID of the registration key to set.
+    :param purchase: It indicates if the purchase or sale invoices are
+      updated.
+    """
+    type_op = 'IN' if purchase else 'NOT IN'
+    cr.execute("SELECT MIN(id), MAX(id) FROM account_invoice")
+    min_id, max_id = cr.fetchone()
+    if min_id is None:
+        return
+    done = 0
+    for start in range(min_id, max_id + 1, KEY_UPDATE_CHUNK):
+        cr.execute("""
+            UPDATE account_invoice
+            SET sii_registration_key = %%s
+            WHERE id >= %%s AND id < %%s
+                AND sii_registration_key IS NULL
+                AND type %s ('in_invoice', 'in_refund')""" % type_op, (
+            key_id, start, start + KEY_UPDATE_CHUNK,
+        ))
+        done += cr.rowcount
+    _logger.info(
+        "SII registration key set on %s %s invoices",
+        done, 'purchase' if purchase else 'sale',
+    )
+
 
 def add_key_to_existing_invoices(cr, registry):
     """This post-init-hook will update all existing invoices"""
     with api.Environment.manage():
         env = api.Environment(cr, SUPERUSER_ID, {})
-        invoice_obj = env['account.invoice']
-        invoices = invoice_obj.search([])
-        if invoices:
+        cr.execute("SELECT EXISTS (SELECT 1 FROM account_invoice)")
+        if cr.fetchone()[0]:
             sii_key_obj = env['aeat.sii.mapping.registration.keys']
             sale_key = sii_key_obj.search(
                 [('code', '=', '01'), ('type', '=', 'sale')],
@@ -19,14 +58,6 @@ def add_key_to_existing_invoices(cr, registry):
                 [('code', '=', '01'), ('type', '=', 'purchase')],
                 limit=1)
             if purchase_key:
-                cr.execute("""
-                    UPDATE account_invoice
-                    SET sii_registration_key = %s
-                    WHERE type IN ('in_invoice', 'in_refund');""",
-                           (purchase_key[0].id,))
+                _update_invoices_key(cr, purchase_key.id, True)
             if sale_key:
-                cr.execute("""
-                    UPDATE account_invoice
-                    SET sii_registration_key = %s
-                    WHERE type NOT IN ('in_invoice', 'in_refund');""",
-                           (sale_key[0].id,))
+                _update_invoices_key(cr, sale_key.id, False)
@@ -11,5 +11,10 @@ from . import product_product
 from . import queue_job
 from . import account_fiscal_position
 from . import account_invoice_tax
+from . import account_tax
+from . import account_tax_template
 from . import account_invoice
 from . import res_partner
+from . import aeat_sii_reconciliation
+from . import aeat_sii_payment
+from . import aeat_sii_submission
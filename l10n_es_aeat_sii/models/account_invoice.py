@@ -5,8 +5,15 @@
 # Copyright 2018 PESOL - Angel Moya <angel.moya@pesol.es>
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
+import base64
+import gzip
+import hashlib
 import logging
 import json
+import threading
+from collections import OrderedDict, defaultdict
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from odoo import _, api, fields, exceptions, models
 from odoo.tools.float_utils import float_compare
@@ -14,12 +21,20 @@ from requests import Session
 
 from odoo.modules.registry import Registry
 
+from ..sii_client import (
+    SII_BATCH_LIMIT, SII_DEFAULT_CONCURRENCY, SII_RETRY_BASE_DELAY,
+    SII_RETRY_MAX_ATTEMPTS, SII_RETRY_MAX_DELAY, SiiCertificateKey,
+    SiiServiceKey, SiiSslAdapter, SiiTransport, SiiWaitRequired,
+    get_sii_backoff_delay, is_sii_throttling_error, sii_rate_limiter,
+    sii_service_cache, sii_ssl_context_cache, sii_stage_timer,
+)
+
 _logger = logging.getLogger(__name__)
 
 try:
     from zeep import Client
-    from zeep.transports import Transport
     from zeep.plugins import HistoryPlugin
+    from zeep.cache import SqliteCache
 except (ImportError, IOError) as err:
     _logger.debug(err)
 
@@ -49,6 +64,60 @@ SII_COUNTRY_CODE_MAPPING = {
     'GF': 'FR',
 }
 SII_MACRODATA_LIMIT = 100000000.0
+SII_DESCRIPTION_LIMIT = 500
+SII_BATCH_JOB_METHODS = ('confirm_invoice_batch', 'cancel_invoice_batch')
+
+
+def _get_sii_value(obj, key):
+    """Get a value either from a dictionary or from a zeep object, returning
+    None if the key doesn't exist."""
+    try:
+        return obj[key]
+    except (KeyError, AttributeError, TypeError):
+        return None
+
+
+def _get_sii_content_digest(inv_dict):
+    """Canonical digest of an SII dictionary, independent of the order of
+    the keys and of the formatting.
+
+    :param inv_dict: SII dictionary of the invoice.
+    :return: SHA-256 hexadecimal digest.
+    """
+    content = json.dumps(
+        inv_dict, sort_keys=True, separators=(',', ':'), default=str,
+    )
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def _get_sii_id_factura_key(id_factura):
+    """Hashable key that identifies an invoice inside an SII communication.
+
+    It works both for the sent dictionaries and for the zeep response objects,
+    so each 'RespuestaLinea' can be matched with its invoice.
+
+    :param id_factura: 'IDFactura' block of the record.
+    :return: Tuple (issuer identifier, invoice number, invoice date).
+    """
+    issuer = _get_sii_value(id_factura, 'IDEmisorFactura') or {}
+    ident = _get_sii_value(issuer, 'NIF') or _get_sii_value(
+        _get_sii_value(issuer, 'IDOtro') or {}, 'ID')
+    return (
+        (ident or '').upper(),
+        _get_sii_value(id_factura, 'NumSerieFacturaEmisor') or '',
+        _get_sii_value(id_factura, 'FechaExpedicionFacturaEmisor') or '',
+    )
+
+
+def _dispatch_sii_company_batches(dbname, uid, context, invoice_ids):
+    """Thread target that sends the SII batches of a company on a new
+    cursor."""
+    with api.Environment.manage():
+        with Registry(dbname).cursor() as cr:
+            env = api.Environment(cr, uid, context)
+            env['account.invoice'].browse(
+                invoice_ids,
+            )._send_sii_company_batches(commit=True)
 
 
 class AccountInvoice(models.Model):
@@ -59,14 +128,38 @@ class AccountInvoice(models.Model):
         'out_refund': 'l10n_es_aeat_sii.wsdl_out',
         'in_invoice': 'l10n_es_aeat_sii.wsdl_in',
         'in_refund': 'l10n_es_aeat_sii.wsdl_in',
+        'out_payment': 'l10n_es_aeat_sii.wsdl_pr',
+        'in_payment': 'l10n_es_aeat_sii.wsdl_ps',
     }
     SII_PORT_NAME_MAPPING = {
         'out_invoice': 'SuministroFactEmitidas',
         'out_refund': 'SuministroFactEmitidas',
         'in_invoice': 'SuministroFactRecibidas',
         'in_refund': 'SuministroFactRecibidas',
+        'out_payment': 'SuministroCobrosEmitidas',
+        'in_payment': 'SuministroPagosRecibidas',
     }
 
+    @api.model_cr
+    def init(self):
+        super(AccountInvoice, self).init()
+        # Partial indexes, as these invoices are a tiny part of the history
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS account_invoice_sii_send_failed_index
+            ON account_invoice (company_id)
+            WHERE sii_send_failed
+        """)
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS account_invoice_sii_modified_index
+            ON account_invoice (company_id, sii_state)
+            WHERE sii_state IN ('sent_modified', 'cancelled_modified')
+        """)
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS account_invoice_sii_next_retry_index
+            ON account_invoice (sii_next_retry_date)
+            WHERE sii_next_retry_date IS NOT NULL
+        """)
+
     def _default_sii_refund_type(self):
         inv_type = self.env.context.get('type')
         return 'I' if inv_type in ['out_refund', 'in_refund'] else False
@@ -106,6 +199,20 @@ class AccountInvoice(models.Model):
     sii_content_sent = fields.Text(
         string="SII last content sent", copy=False, readonly=True,
     )
+    sii_content_hash = fields.Char(
+        string="SII last content digest", copy=False, readonly=True,
+    )
+    sii_submission_ids = fields.One2many(
+        comodel_name='aeat.sii.submission', inverse_name='invoice_id',
+        string="SII submissions", readonly=True, copy=False,
+    )
+    sii_payload_attachment_id = fields.Many2one(
+        comodel_name='ir.attachment', string="SII last payloads",
+        copy=False, readonly=True, ondelete='set null',
+        help="Compressed file with the last header, content and return "
+             "communicated to the SII, when the company stores them as "
+             "attachments.",
+    )
     sii_send_error = fields.Text(
         string='SII Send Error', readonly=True, copy=False,
     )
@@ -181,6 +288,21 @@ class AccountInvoice(models.Model):
              "greater o equal to 100 000 000,00 euros.",
         compute='_compute_macrodata',
     )
+    sii_send_date = fields.Datetime(
+        string="SII scheduled send date", copy=False, readonly=True,
+        index=True,
+        help="Date when the invoice will be queued for sending to the SII "
+             "together with the rest of due invoices of the company.",
+    )
+    sii_send_attempts = fields.Integer(
+        string="SII failed attempts", copy=False, readonly=True,
+        help="Number of consecutive failed communications with the SII.",
+    )
+    sii_next_retry_date = fields.Datetime(
+        string="SII next retry date", copy=False, readonly=True,
+        help="Date when the failed communication will be retried "
+             "automatically.",
+    )
     invoice_jobs_ids = fields.Many2many(
         comodel_name='queue.job', column1='invoice_id', column2='job_id',
         string="Connector Jobs", copy=False,
@@ -278,57 +400,40 @@ class AccountInvoice(models.Model):
         """Adds a tax template -> tax id to the mapping.
         Adapted from account_chart_update module.
 
+        The result is cached per company on the SII tax index (see
+        ``aeat.sii.map._get_sii_tax_index``), so it can only depend on the
+        company of the invoice.
+
         :param self: Single invoice record.
         :param tax_template: Tax template record.
         :param mapping_taxes: Dictionary with all the tax templates mapping.
         :return: Tax template current mapping
         """
         self.ensure_one()
-        if not tax_template:
-            return self.env['account.tax']
-        if mapping_taxes.get(tax_template):
-            return mapping_taxes[tax_template]
-        # search inactive taxes too, to avoid re-creating
-        # taxes that have been deactivated before
-        tax_obj = self.env['account.tax'].with_context(active_test=False)
-        criteria = ['|',
-                    ('name', '=', tax_template.name),
-                    ('description', '=', tax_template.name)]
-        if tax_template.description:
-            criteria = ['|'] + criteria
-            criteria += [
-                '|',
-                ('description', '=', tax_template.description),
-                ('name', '=', tax_template.description),
-            ]
-        criteria += [('company_id', '=', self.company_id.id)]
-        mapping_taxes[tax_template] = tax_obj.search(criteria)
-        return mapping_taxes[tax_template]
+        return self.env['aeat.sii.map']._map_sii_tax_template(
+            tax_template, self.company_id, mapping_taxes,
+        )
 
     @api.multi
     def _get_sii_taxes_map(self, codes):
         """Return the codes that correspond to that sii map line codes.
 
+        The taxes are taken from the cached index of the SII map, so no
+        query is done once it's computed for the company.
+
         :param self: Single invoice record.
         :param codes: List of code strings to get the mapping.
         :return: Recordset with the corresponding codes
         """
         self.ensure_one()
-        taxes = self.env['account.tax']
-        sii_map = self.env['aeat.sii.map'].search(
-            ['|',
-             ('date_from', '<=', self.date),
-             ('date_from', '=', False),
-             '|',
-             ('date_to', '>=', self.date),
-             ('date_to', '=', False)], limit=1)
-        mapping_taxes = {}
-        tax_templates = sii_map.sudo().map_lines.filtered(
-            lambda x: x.code in codes
-        ).taxes
-        for tax_template in tax_templates:
-            taxes += self.map_sii_tax_template(tax_template, mapping_taxes)
-        return taxes
+        map_obj = self.env['aeat.sii.map']
+        index = map_obj._get_sii_tax_index(
+            self.company_id.id, map_obj._get_sii_map_id(self.date),
+        )
+        tax_ids = set()
+        for code in codes:
+            tax_ids |= index.get(code, frozenset())
+        return self.env['account.tax'].browse(sorted(tax_ids))
 
     @api.multi
     def _change_date_format(self, date):
@@ -677,6 +782,33 @@ class AccountInvoice(models.Model):
         self.ensure_one()
         return self.sii_account_registration_date or fields.Date.today()
 
+    @api.multi
+    def _get_sii_id_factura(self):
+        """Build the 'IDFactura' block that identifies the invoice at the SII.
+
+        :param self: Single invoice record.
+        :return: Dictionary with the issuer, number and date of the invoice.
+        """
+        self.ensure_one()
+        invoice_date = self._change_date_format(self.date_invoice)
+        if self.type in ['out_invoice', 'out_refund']:
+            return {
+                "IDEmisorFactura": {
+                    "NIF": self.company_id.vat[2:],
+                },
+                # On cancelled invoices, number is not filled
+                "NumSerieFacturaEmisor": (
+                    self.number or self.move_name or ''
+                )[0:60],
+                "FechaExpedicionFacturaEmisor": invoice_date,
+            }
+        # Uso condicional de IDOtro/NIF
+        return {
+            "IDEmisorFactura": self._get_sii_identifier(),
+            "NumSerieFacturaEmisor": (self.reference or '')[:60],
+            "FechaExpedicionFacturaEmisor": invoice_date,
+        }
+
     @api.multi
     def _get_sii_invoice_dict_out(self, cancel=False):
         """Build dict with data to send to AEAT WS for invoice types:
@@ -687,22 +819,11 @@ class AccountInvoice(models.Model):
         :return: invoices (dict) : Dict XML with data for this invoice.
         """
         self.ensure_one()
-        invoice_date = self._change_date_format(self.date_invoice)
         partner = self.partner_id.commercial_partner_id
-        company = self.company_id
         ejercicio = fields.Date.from_string(self.date).year
         periodo = '%02d' % fields.Date.from_string(self.date).month
         inv_dict = {
-            "IDFactura": {
-                "IDEmisorFactura": {
-                    "NIF": company.vat[2:],
-                },
-                # On cancelled invoices, number is not filled
-                "NumSerieFacturaEmisor": (
-                    self.number or self.move_name or ''
-                )[0:60],
-                "FechaExpedicionFacturaEmisor": invoice_date,
-            },
+            "IDFactura": self._get_sii_id_factura(),
             "PeriodoLiquidacion": {
                 "Ejercicio": ejercicio,
                 "Periodo": periodo,
@@ -783,19 +904,13 @@ class AccountInvoice(models.Model):
         :return: invoices (dict) : Dict XML with data for this invoice.
         """
         self.ensure_one()
-        invoice_date = self._change_date_format(self.date_invoice)
         reg_date = self._change_date_format(
             self._get_account_registration_date())
         ejercicio = fields.Date.from_string(self.date).year
         periodo = '%02d' % fields.Date.from_string(self.date).month
         desglose_factura, tax_amount = self._get_sii_in_taxes()
         inv_dict = {
-            "IDFactura": {
-                "IDEmisorFactura": {},
-                "NumSerieFacturaEmisor": (
-                    (self.reference or '')[:60]
-                ),
-                "FechaExpedicionFacturaEmisor": invoice_date},
+            "IDFactura": self._get_sii_id_factura(),
             "PeriodoLiquidacion": {
                 "Ejercicio": ejercicio,
                 "Periodo": periodo
@@ -803,7 +918,6 @@ class AccountInvoice(models.Model):
         }
         # Uso condicional de IDOtro/NIF
         ident = self._get_sii_identifier()
-        inv_dict['IDFactura']['IDEmisorFactura'].update(ident)
         if cancel:
             inv_dict['IDFactura']['IDEmisorFactura'].update(
                 {'NombreRazon': (
@@ -869,6 +983,46 @@ class AccountInvoice(models.Model):
             return self._get_sii_invoice_dict_in()
         return {}
 
+    @api.multi
+    def _prefetch_sii_invoice_data(self):
+        """Load in a few queries all the data used for building the SII
+        dictionaries of the invoices, instead of one query per invoice and
+        relation when they are processed one by one."""
+        self.mapped('company_id.chart_template_id')
+        self.mapped('partner_id.commercial_partner_id.country_id')
+        self.mapped('fiscal_position_id')
+        self.mapped('refund_invoice_id.tax_line_ids')
+        self.mapped('sii_registration_key')
+        self.mapped('sii_registration_key_additional1')
+        self.mapped('sii_registration_key_additional2')
+        self.mapped('tax_line_ids.tax_id.children_tax_ids')
+        self.mapped('tax_line_ids.amount_company')
+        self.mapped('invoice_line_ids.invoice_line_tax_ids')
+        self.mapped('invoice_line_ids.product_id.sii_exempt_cause')
+
+    @api.multi
+    def _get_sii_invoice_dicts(self, cancel=False):
+        """Build the SII dictionaries of several invoices at once, prefetching
+        all the related data for the whole recordset.
+
+        :param cancel: It indicates if the dictionaries are for sending a
+          cancellation of the invoices.
+        :return: Tuple with 2 dictionaries: {invoice: SII dict} for the valid
+          invoices and {invoice: error message} for the wrong ones.
+        """
+        self._prefetch_sii_invoice_data()
+        inv_dicts = OrderedDict()
+        errors = OrderedDict()
+        for invoice in self:
+            try:
+                if cancel:
+                    inv_dicts[invoice] = invoice._get_cancel_sii_invoice_dict()
+                else:
+                    inv_dicts[invoice] = invoice._get_sii_invoice_dict()
+            except exceptions.UserError as error:
+                errors[invoice] = error.name
+        return inv_dicts, errors
+
     @api.multi
     def _get_cancel_sii_invoice_dict(self):
         self.ensure_one()
@@ -893,43 +1047,139 @@ class AccountInvoice(models.Model):
         if agency:
             params.update(agency._connect_params_sii(
                 mapping_key, self.company_id))
+        if not params['wsdl']:
+            raise exceptions.UserError(_(
+                "The WSDL of the SII service %s is not configured. Set it on "
+                "the tax agency of the company or on the system parameter "
+                "'%s'.") % (params['port_name'],
+                            self.SII_WDSL_MAPPING[mapping_key]))
         if not params['address'] and self.company_id.sii_test:
             params['port_name'] += 'Pruebas'
         return params
 
     @api.multi
     def _connect_sii(self, mapping_key):
+        """Get the SII service for the given mapping key. Services are cached
+        per company, WSDL, port, environment and certificate, and their
+        sessions share the SSL context with the loaded certificate.
+        """
         self.ensure_one()
         params = self._connect_params_sii(mapping_key)
-        today = fields.Date.today()
-        sii_config = self.env['l10n.es.aeat.sii'].search([
-            ('company_id', '=', self.company_id.id),
-            ('public_key', '!=', False),
-            ('private_key', '!=', False),
-            '|',
-            ('date_start', '=', False),
-            ('date_start', '<=', today),
-            '|',
-            ('date_end', '=', False),
-            ('date_end', '>=', today),
-            ('state', '=', 'active'),
-        ], limit=1)
-        if sii_config:
-            public_crt = sii_config.public_key
-            private_key = sii_config.private_key
+        certificate = self.env['l10n.es.aeat.sii']._get_sii_certificate(
+            self.company_id.id, fields.Date.to_string(fields.Date.today()),
+        )
+        key = SiiServiceKey(
+            dbname=self.env.cr.dbname,
+            company_id=self.company_id.id,
+            wsdl=params['wsdl'],
+            port_name=params['port_name'],
+            address=params['address'],
+            test=self.company_id.sii_test,
+            certificate=certificate,
+        )
+
+        def _build_service():
+            session = Session()
+            if certificate[2] and certificate[3]:
+                ssl_context = sii_ssl_context_cache.get(SiiCertificateKey(
+                    self.env.cr.dbname, *certificate
+                ))
+                session.mount('https://', SiiSslAdapter(ssl_context))
+            transport = self._get_sii_transport(session)
+            history = HistoryPlugin()
+            client = Client(
+                wsdl=params['wsdl'], transport=transport, plugins=[history],
+            )
+            return self._bind_sii(
+                client, params['port_name'], params['address'],
+            )
+
+        return sii_service_cache.get(key, _build_service)
+
+    @api.multi
+    def _call_sii_service(self, operation, header, records, send=True):
+        """Call an operation of the SII service within the concurrency limit
+        of the tax agency of the company.
+
+        The call never waits for the time requested by the AEAT on the
+        previous response ('TiempoEsperaEnvio'): ``SiiWaitRequired`` is
+        raised instead, so the caller reschedules the communication. Calls
+        rejected because the server is overloaded aren't retried either, but
+        they delay the next calls of the company with an exponential backoff.
+
+        :param self: Single invoice record.
+        :param operation: Operation of the service proxy.
+        :param header: Header of the communication.
+        :param records: Records to communicate.
+        :param send: False for the calls that don't send records, as the
+          consultations, which don't have to respect the waiting time.
+        :return: Response of the operation.
+        """
+        self.ensure_one()
+        company = self.company_id
+        agency = company.sii_tax_agency_id
+        agency_key = (self.env.cr.dbname, agency.id)
+        company_key = (self.env.cr.dbname, company.id)
+        capacity = agency.max_concurrency or SII_DEFAULT_CONCURRENCY
+        try:
+            with sii_rate_limiter.slot(
+                agency_key, capacity, company_key if send else None,
+            ):
+                res = operation(header, records)
+        except Exception as error:
+            if is_sii_throttling_error(error):
+                delay = sii_rate_limiter.throttled(company_key)
+                _logger.warning(
+                    "SII call of company %s throttled (%r). Next calls "
+                    "delayed %.1f seconds.", company.name, error, delay,
+                )
+            raise
+        sii_rate_limiter.accepted(company_key)
+        wait = _get_sii_value(res, 'TiempoEsperaEnvio')
+        if wait:
+            sii_rate_limiter.wait_before(company_key, int(wait))
+        return res
+
+    @api.multi
+    def _postpone_sii_send(self, seconds, cancel=False):
+        """Reschedule the communication of the invoices after the waiting
+        time requested by the SII, instead of blocking until then. The sends
+        are collected by the batch scheduler and the cancellations by the
+        retry one.
+
+        :param seconds: Seconds to wait.
+        :param cancel: It indicates if it's a cancellation.
+        """
+        date = fields.Datetime.now() + timedelta(seconds=seconds)
+        _logger.info(
+            "SII communication of %s invoices postponed %.1f seconds",
+            len(self), seconds,
+        )
+        if cancel:
+            self.sudo().write({
+                'sii_send_failed': True,
+                'sii_next_retry_date': date,
+            })
         else:
-            public_crt = self.env['ir.config_parameter'].sudo().get_param(
-                'l10n_es_aeat_sii.publicCrt', False)
-            private_key = self.env['ir.config_parameter'].sudo().get_param(
-                'l10n_es_aeat_sii.privateKey', False)
-        session = Session()
-        session.cert = (public_crt, private_key)
-        transport = Transport(session=session)
-        history = HistoryPlugin()
-        client = Client(
-            wsdl=params['wsdl'], transport=transport, plugins=[history],
+            self.sudo().write({'sii_send_date': date})
+
+    @api.model
+    def _get_sii_transport(self, session):
+        """Get the zeep transport for the SII connection. WSDL and XSD files
+        are resolved from the local directory set on the system parameter
+        'l10n_es_aeat_sii.wsdl_local_path' (if any), and optionally cached on
+        the SQLite file set on 'l10n_es_aeat_sii.zeep_cache_path'.
+        """
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        cache_path = get_param('l10n_es_aeat_sii.zeep_cache_path', False)
+        cache = None
+        if cache_path:
+            # Published WSDL files don't change, so they don't expire
+            cache = SqliteCache(path=cache_path, timeout=None)
+        return SiiTransport(
+            wsdl_path=get_param('l10n_es_aeat_sii.wsdl_local_path', False),
+            session=session, cache=cache,
         )
-        return self._bind_sii(client, params['port_name'], params['address'])
 
     @api.multi
     def _bind_sii(self, client, port_name, address=None):
@@ -950,6 +1200,13 @@ class AccountInvoice(models.Model):
             company = invoice.company_id
             if not company.use_connector:
                 invoice._send_invoice_to_sii()
+            elif company.sii_send_in_batch:
+                # The scheduler will send it with the rest of due invoices
+                eta = company._get_sii_eta()
+                invoice.sudo().sii_send_date = (
+                    eta if eta and not invoice.sii_send_failed
+                    else fields.Datetime.now()
+                )
             else:
                 eta = company._get_sii_eta()
                 new_delay = invoice.sudo().with_context(
@@ -965,7 +1222,12 @@ class AccountInvoice(models.Model):
     @api.multi
     def _send_invoice_to_sii(self):
         for invoice in self.filtered(lambda i: i.state in ['open', 'paid']):
-            serv = invoice._connect_sii(invoice.type)
+            operation = invoice._get_sii_batch_operation()
+            submission = self.env['aeat.sii.submission']._new_submission(
+                operation,
+            )
+            with sii_stage_timer(submission, 'connect_duration'):
+                serv = invoice._connect_sii(invoice.type)
             if invoice.sii_state == 'not_sent':
                 tipo_comunicacion = 'A0'
             else:
@@ -975,49 +1237,29 @@ class AccountInvoice(models.Model):
                 'sii_header_sent': json.dumps(header, indent=4),
             }
             try:
-                inv_dict = invoice._get_sii_invoice_dict()
-                inv_vals['sii_content_sent'] = json.dumps(inv_dict, indent=4)
-                if invoice.type in ['out_invoice', 'out_refund']:
-                    res = serv.SuministroLRFacturasEmitidas(
-                        header, inv_dict)
-                elif invoice.type in ['in_invoice', 'in_refund']:
-                    res = serv.SuministroLRFacturasRecibidas(
-                        header, inv_dict)
+                with sii_stage_timer(submission, 'build_duration'):
+                    inv_dict = invoice._get_sii_invoice_dict()
+                inv_vals.update({
+                    'sii_content_sent': json.dumps(inv_dict, indent=4),
+                    'sii_content_hash': _get_sii_content_digest(inv_dict),
+                })
+                with sii_stage_timer(submission, 'duration'):
+                    res = invoice._call_sii_service(
+                        getattr(serv, operation), header, inv_dict,
+                    )
                 # TODO Facturas intracomunitarias 66 RIVA
                 # elif invoice.fiscal_position_id.id == self.env.ref(
                 #     'account.fp_intra').id:
                 #     res = serv.SuministroLRDetOperacionIntracomunitaria(
                 #         header, invoices)
                 res_line = res['RespuestaLinea'][0]
-                if res['EstadoEnvio'] == 'Correcto':
-                    inv_vals.update({
-                        'sii_state': 'sent',
-                        'sii_csv': res['CSV'],
-                        'sii_send_failed': False,
-                    })
-                elif res['EstadoEnvio'] == 'ParcialmenteCorrecto' and \
-                        res_line['EstadoRegistro'] == 'AceptadoConErrores':
-                    inv_vals.update({
-                        'sii_state': 'sent_w_errors',
-                        'sii_csv': res['CSV'],
-                        'sii_send_failed': True,
-                    })
-                else:
-                    inv_vals['sii_send_failed'] = True
-                if ('sii_state' in inv_vals and
-                        not invoice.sii_account_registration_date and
-                        invoice.type[:2] == 'in'):
-                    inv_vals['sii_account_registration_date'] = (
-                        self._get_account_registration_date()
-                    )
+                inv_vals.update(
+                    invoice._get_sii_send_result_vals(res, res_line),
+                )
                 inv_vals['sii_return'] = res
-                send_error = False
-                if res_line['CodigoErrorRegistro']:
-                    send_error = "{} | {}".format(
-                        str(res_line['CodigoErrorRegistro']),
-                        str(res_line['DescripcionErrorRegistro'])[:60])
-                inv_vals['sii_send_error'] = send_error
-                invoice.write(inv_vals)
+                invoice._write_sii_result(inv_vals, submission)
+            except SiiWaitRequired as wait:
+                invoice._postpone_sii_send(wait.seconds)
             except Exception as fault:
                 new_cr = Registry(self.env.cr.dbname).cursor()
                 env = api.Environment(new_cr, self.env.uid, self.env.context)
@@ -1027,24 +1269,443 @@ class AccountInvoice(models.Model):
                     'sii_send_error': repr(fault)[:60],
                     'sii_return': repr(fault),
                 })
-                invoice.write(inv_vals)
+                invoice._write_sii_result(inv_vals, submission)
                 new_cr.commit()
                 new_cr.close()
                 raise
 
+    @api.multi
+    def _get_sii_send_result_vals(self, res, res_line):
+        """Get the values to write on the invoice from its response line.
+
+        The state is taken from the record line, as on a batch communication
+        the global 'EstadoEnvio' doesn't tell the result of each invoice.
+
+        :param self: Single invoice record.
+        :param res: Full response of the SII call.
+        :param res_line: 'RespuestaLinea' that corresponds to this invoice.
+        :return: Dictionary with the values to write on the invoice.
+        """
+        self.ensure_one()
+        vals = {}
+        if res_line['EstadoRegistro'] == 'Correcto':
+            vals.update({
+                'sii_state': 'sent',
+                'sii_csv': res['CSV'],
+                'sii_send_failed': False,
+            })
+        elif res_line['EstadoRegistro'] == 'AceptadoConErrores':
+            vals.update({
+                'sii_state': 'sent_w_errors',
+                'sii_csv': res['CSV'],
+                'sii_send_failed': True,
+            })
+        else:
+            vals['sii_send_failed'] = True
+        if ('sii_state' in vals and
+                not self.sii_account_registration_date and
+                self.type[:2] == 'in'):
+            vals['sii_account_registration_date'] = (
+                self._get_account_registration_date()
+            )
+        send_error = False
+        if res_line['CodigoErrorRegistro']:
+            send_error = "{} | {}".format(
+                str(res_line['CodigoErrorRegistro']),
+                str(res_line['DescripcionErrorRegistro'])[:60])
+        vals['sii_send_error'] = send_error
+        return vals
+
+    @api.multi
+    def _get_sii_cancel_result_vals(self, res, res_line):
+        """Get the values to write on the invoice from its response line of
+        a cancellation.
+
+        :param self: Single invoice record.
+        :param res: Full response of the SII call.
+        :param res_line: 'RespuestaLinea' that corresponds to this invoice.
+        :return: Dictionary with the values to write on the invoice.
+        """
+        self.ensure_one()
+        vals = {
+            'sii_send_failed': True,
+            'sii_send_error': False,
+        }
+        if res_line['EstadoRegistro'] == 'Correcto':
+            vals.update({
+                'sii_state': 'cancelled',
+                'sii_csv': res['CSV'],
+                'sii_send_failed': False,
+            })
+        if res_line['CodigoErrorRegistro']:
+            vals['sii_send_error'] = u"{} | {}".format(
+                str(res_line['CodigoErrorRegistro']),
+                str(res_line['DescripcionErrorRegistro'])[:60],
+            )
+        return vals
+
+    @api.multi
+    def _get_sii_batch_key(self, cancel=False):
+        """Key for grouping the invoices that can be communicated in the same
+        SII call: same company (header), same type (service operation) and
+        same communication type.
+
+        :param self: Single invoice record.
+        :param cancel: It indicates if the key is for a cancellation.
+        :return: Tuple (company, 'out' or 'in', communication type).
+        """
+        self.ensure_one()
+        if cancel:
+            tipo_comunicacion = False
+        elif self.sii_state == 'not_sent':
+            tipo_comunicacion = 'A0'
+        else:
+            tipo_comunicacion = 'A1'
+        return self.company_id, self.type[:2], tipo_comunicacion
+
+    @api.multi
+    def _split_sii_batches(self, cancel=False, limit=SII_BATCH_LIMIT):
+        """Split the invoices in chunks that can be sent in one SII call.
+
+        :param cancel: It indicates if the batches are for a cancellation.
+        :param limit: Maximum number of invoices per chunk.
+        :return: Generator of tuples (batch key, invoices recordset).
+        """
+        groups = OrderedDict()
+        for invoice in self:
+            key = invoice._get_sii_batch_key(cancel=cancel)
+            groups.setdefault(key, []).append(invoice.id)
+        for key, invoice_ids in groups.items():
+            for i in range(0, len(invoice_ids), limit):
+                yield key, self.browse(invoice_ids[i:i + limit])
+
+    @api.multi
+    def _send_invoices_to_sii_batch(self):
+        """Send the invoices to the SII using as few calls as possible.
+
+        Contrary to ``_send_invoice_to_sii``, errors are registered on each
+        invoice instead of being raised, so one wrong invoice doesn't abort
+        the rest of the batch.
+        """
+        invoices = self.filtered(lambda i: i.state in ['open', 'paid'])
+        for key, batch in invoices._split_sii_batches():
+            batch._send_invoice_batch_to_sii(tipo_comunicacion=key[2])
+
+    @api.multi
+    def _send_invoice_batch_to_sii(self, tipo_comunicacion):
+        """Send a chunk of invoices of the same company, type and
+        communication type in a single SII call, and write on each invoice
+        the result of its response line.
+
+        :param tipo_comunicacion: String 'A0': new reg, 'A1': modification.
+        """
+        self._communicate_sii_batch(tipo_comunicacion=tipo_comunicacion)
+
+    @api.multi
+    def _cancel_invoice_batch_to_sii(self):
+        """Send the cancellation of a chunk of invoices of the same company
+        and type in a single SII call, and write on each invoice the result
+        of its response line."""
+        self._communicate_sii_batch(cancel=True)
+
+    @api.multi
+    def _get_sii_batch_operation(self, cancel=False):
+        """Name of the SII service operation for communicating the invoices.
+
+        :param self: Single invoice record.
+        :param cancel: It indicates if it's a cancellation.
+        """
+        self.ensure_one()
+        if self.type in ['out_invoice', 'out_refund']:
+            if cancel:
+                return 'AnulacionLRFacturasEmitidas'
+            return 'SuministroLRFacturasEmitidas'
+        if cancel:
+            return 'AnulacionLRFacturasRecibidas'
+        return 'SuministroLRFacturasRecibidas'
+
+    @api.multi
+    def _communicate_sii_batch(self, tipo_comunicacion=False, cancel=False):
+        """Communicate a chunk of invoices (of the same batch key) in a
+        single SII call and write on each one the result of its line.
+
+        :param tipo_comunicacion: String 'A0': new reg, 'A1': modification.
+        :param cancel: It indicates if it's a cancellation.
+        """
+        if not self:
+            return
+        first = self[0]
+        operation = first._get_sii_batch_operation(cancel=cancel)
+        submission = self.env['aeat.sii.submission']._new_submission(
+            operation, cancel=cancel, batch_size=len(self),
+        )
+        header = first._get_sii_header(tipo_comunicacion, cancellation=cancel)
+        header_sent = json.dumps(header, indent=4)
+        with sii_stage_timer(submission, 'build_duration'):
+            inv_dicts, errors = self._get_sii_invoice_dicts(cancel=cancel)
+        for invoice, error in errors.items():
+            inv_vals = {
+                'sii_send_failed': True,
+                'sii_send_error': error[:60],
+                'sii_return': error,
+            }
+            if not cancel:
+                inv_vals['sii_header_sent'] = header_sent
+            invoice._write_sii_result(inv_vals, submission)
+        records = OrderedDict()
+        for invoice, inv_dict in inv_dicts.items():
+            request = None
+            if cancel:
+                inv_vals = {}
+                # The cancellation isn't written on the invoice, only logged
+                request = {
+                    'header': header_sent,
+                    'content': json.dumps(inv_dict, indent=4),
+                }
+            else:
+                inv_vals = {
+                    'sii_header_sent': header_sent,
+                    'sii_content_sent': json.dumps(inv_dict, indent=4),
+                    'sii_content_hash': _get_sii_content_digest(inv_dict),
+                }
+            key = _get_sii_id_factura_key(inv_dict['IDFactura'])
+            if key in records:
+                # The response lines are matched by this key, so an invoice
+                # with the same one can't be communicated on the same call
+                error = _(
+                    "Another invoice with the same number and date is "
+                    "communicated in this batch: %s") % (
+                    records[key][0].number)
+                inv_vals.update({
+                    'sii_send_failed': True,
+                    'sii_send_error': error[:60],
+                    'sii_return': error,
+                })
+                invoice._write_sii_result(inv_vals, submission, request)
+                continue
+            records[key] = (invoice, inv_dict, inv_vals, request)
+        if not records:
+            return
+        inv_dicts = [x[1] for x in records.values()]
+        try:
+            # Connection errors are recorded as a failed attempt of the chunk
+            with sii_stage_timer(submission, 'connect_duration'):
+                serv = first._connect_sii(first.type)
+            with sii_stage_timer(submission, 'duration'):
+                res = first._call_sii_service(
+                    getattr(serv, operation), header, inv_dicts,
+                )
+        except SiiWaitRequired as wait:
+            self.browse().union(
+                *[x[0] for x in records.values()]
+            )._postpone_sii_send(wait.seconds, cancel=cancel)
+            return
+        except Exception as fault:
+            _logger.exception(
+                "Error on SII %s with a batch of %s invoices",
+                operation, len(inv_dicts),
+            )
+            for invoice, inv_dict, inv_vals, request in records.values():
+                inv_vals.update({
+                    'sii_send_failed': True,
+                    'sii_send_error': repr(fault)[:60],
+                    'sii_return': repr(fault),
+                })
+                invoice._write_sii_result(inv_vals, submission, request)
+            return
+        for res_line in res['RespuestaLinea']:
+            key = _get_sii_id_factura_key(res_line['IDFactura'])
+            if key not in records:
+                _logger.warning(
+                    "SII response line %s doesn't match any sent invoice",
+                    key,
+                )
+                continue
+            invoice, inv_dict, inv_vals, request = records.pop(key)
+            if cancel:
+                inv_vals.update(
+                    invoice._get_sii_cancel_result_vals(res, res_line),
+                )
+            else:
+                inv_vals.update(
+                    invoice._get_sii_send_result_vals(res, res_line),
+                )
+            inv_vals['sii_return'] = {
+                'CSV': res['CSV'],
+                'EstadoEnvio': res['EstadoEnvio'],
+                'RespuestaLinea': [res_line],
+            }
+            invoice._write_sii_result(inv_vals, submission, request)
+        # Invoices without response line can't be considered as sent
+        for invoice, inv_dict, inv_vals, request in records.values():
+            inv_vals.update({
+                'sii_send_failed': True,
+                'sii_send_error': _("No response received for this invoice"),
+                'sii_return': res,
+            })
+            invoice._write_sii_result(inv_vals, submission, request)
+
+    @api.multi
+    def _write_sii_result(self, vals, submission=None, request=None):
+        """Write the result of an SII communication on the invoice, and log
+        it on the SII submissions.
+
+        If the company stores the payloads as attachments, the header,
+        content and return are saved on a gzip compressed JSON file instead
+        of the invoice fields, so the invoice table doesn't grow with them.
+        If they are only stored on the submissions log, they are not written
+        on the invoice at all.
+
+        :param self: Single invoice record.
+        :param vals: Values to write, including the payloads.
+        :param submission: Data of the SII call, as returned by
+          ``aeat.sii.submission._new_submission``.
+        :param request: Dictionary with the 'header' and 'content' texts
+          sent, for logging the requests not written on the invoice (as the
+          cancellations).
+        """
+        self.ensure_one()
+        log_vals = vals
+        if 'sii_send_failed' in vals:
+            vals = dict(vals, **self._get_sii_retry_vals(
+                vals['sii_send_failed'] and
+                vals.get('sii_state') != 'sent_w_errors'
+            ))
+        timings = {}
+        payload_fields = ['sii_header_sent', 'sii_content_sent', 'sii_return']
+        storage = self.company_id.sii_payload_storage
+        with sii_stage_timer(timings, 'write_duration'):
+            if (storage in ['attachment', 'submission'] and
+                    any(x in vals for x in payload_fields)):
+                vals = dict(vals)
+                payloads = {
+                    x: vals[x] and str(vals[x]) for x in payload_fields
+                    if x in vals
+                }
+                vals.update(dict.fromkeys(payloads, False))
+                if storage == 'attachment':
+                    vals['sii_payload_attachment_id'] = (
+                        self._save_sii_payload_attachment(payloads).id
+                    )
+            res = self.write(vals)
+        if submission is not None:
+            submission_obj = self.env['aeat.sii.submission'].sudo()
+            submission_vals = submission_obj._prepare_submission_vals(
+                self, log_vals, dict(submission, **timings), request=request,
+            )
+            submission_obj.create(submission_vals)
+        return res
+
+    @api.multi
+    def _get_sii_retry_vals(self, failed):
+        """Values of the retry queue after an SII communication. Failed
+        communications are scheduled to be retried with an exponential
+        backoff, until the maximum number of attempts set on the system
+        parameter 'l10n_es_aeat_sii.retry_max_attempts' is reached.
+
+        :param self: Single invoice record.
+        :param failed: It indicates if the communication has failed.
+        :return: Dictionary with the values to write on the invoice.
+        """
+        self.ensure_one()
+        if not failed:
+            return {'sii_send_attempts': 0, 'sii_next_retry_date': False}
+        attempts = self.sii_send_attempts + 1
+        return {
+            'sii_send_attempts': attempts,
+            'sii_next_retry_date': self._get_sii_retry_date(attempts),
+        }
+
+    @api.model
+    def _get_sii_retry_date(self, attempts):
+        """Date of the next retry of a failed SII communication.
+
+        :param attempts: Failed attempts, including the last one.
+        :return: Datetime, or False if there are no more retries.
+        """
+        max_attempts = int(self.env['ir.config_parameter'].sudo().get_param(
+            'l10n_es_aeat_sii.retry_max_attempts', SII_RETRY_MAX_ATTEMPTS))
+        if attempts > max_attempts:
+            return False
+        return fields.Datetime.now() + timedelta(
+            seconds=get_sii_backoff_delay(
+                attempts - 1, base=SII_RETRY_BASE_DELAY,
+                maximum=SII_RETRY_MAX_DELAY,
+            ),
+        )
+
+    @api.model
+    def _cron_sii_retry_failed(self):
+        """Retry in batches the failed SII communications whose retry date
+        has arrived. Only the cancelled invoices registered on the SII are
+        cancelled on it."""
+        invoices = self.sudo().search([
+            ('sii_next_retry_date', '<=', fields.Datetime.now()),
+            ('sii_send_failed', '=', True),
+        ], order='company_id, id').filtered('sii_enabled')
+        invoices.filtered(
+            lambda x: x.state == 'cancel' and x.sii_state in [
+                'sent', 'sent_w_errors', 'sent_modified',
+            ]
+        )._cancel_invoices_to_sii_batch()
+        invoices.filtered(
+            lambda x: x.state in ['open', 'paid']
+        )._dispatch_sii_batches()
+
+    @api.multi
+    def _save_sii_payload_attachment(self, payloads):
+        """Save the SII payloads on the compressed attachment of the invoice.
+
+        :param self: Single invoice record.
+        :param payloads: Dictionary {field name: text}. Payloads not included
+          are kept from the previous attachment.
+        :return: Attachment record.
+        """
+        self.ensure_one()
+        attachment = self.sudo().sii_payload_attachment_id
+        if attachment:
+            content = json.loads(
+                gzip.decompress(base64.b64decode(attachment.datas)).decode()
+            )
+            content.update(payloads)
+        else:
+            content = payloads
+        datas = base64.b64encode(
+            gzip.compress(json.dumps(content, indent=4).encode('utf-8'))
+        )
+        if attachment:
+            attachment.write({'datas': datas})
+            return attachment
+        return self.env['ir.attachment'].sudo().create({
+            'name': 'sii_payloads.json.gz',
+            'datas_fname': 'sii_payloads.json.gz',
+            'datas': datas,
+            'mimetype': 'application/gzip',
+            'res_model': self._name,
+            'res_id': self.id,
+        })
+
     @api.multi
     def _sii_invoice_dict_modified(self):
+        """Check if the SII dictionary of the invoice is the same that the
+        last one sent, comparing their digests.
+
+        :return: True if the content hasn't changed.
+        """
         self.ensure_one()
         inv_dict = self._get_sii_invoice_dict()
-        sii_content_sent = json.dumps(inv_dict, indent=4)
-        return sii_content_sent == self.sii_content_sent
+        if self.sii_content_hash:
+            return _get_sii_content_digest(inv_dict) == self.sii_content_hash
+        # Invoices sent before the digest was stored
+        return json.dumps(inv_dict, indent=4) == self.sii_content_sent
 
     @api.multi
     def invoice_validate(self):
         res = super(AccountInvoice, self).invoice_validate()
+        self._refresh_sii_description()
         for invoice in self.filtered('sii_enabled'):
             if invoice.sii_state in ['sent_modified', 'sent'] and \
-                    self._sii_invoice_dict_modified():
+                    invoice._sii_invoice_dict_modified():
                 if invoice.sii_state == 'sent_modified':
                     invoice.sii_state = 'sent'
                 continue
@@ -1072,40 +1733,179 @@ class AccountInvoice(models.Model):
                 'because there is a job running!'))
         invoices._process_invoice_for_sii_send()
 
+    @api.multi
+    def send_sii_batch(self):
+        """Send the selected invoices to the SII grouping them in batches.
+        If the company uses connector, a job is queued for each batch."""
+        invoices = self.filtered(
+            lambda i: (
+                i.sii_enabled and i.state in ['open', 'paid'] and
+                i.sii_state not in ['sent', 'cancelled']
+            )
+        )
+        if not invoices._cancel_invoice_jobs():
+            raise exceptions.Warning(_(
+                'You can not communicate these invoices at this moment '
+                'because there is a job running!'))
+        for company in invoices.mapped('company_id'):
+            company_invoices = invoices.filtered(
+                lambda x: x.company_id == company
+            )
+            batches = company_invoices._split_sii_batches(
+                limit=company._get_sii_batch_size(),
+            )
+            for key, batch in batches:
+                if company.use_connector:
+                    batch._enqueue_sii_batch()
+                else:
+                    batch._send_invoice_batch_to_sii(tipo_comunicacion=key[2])
+
+    @api.multi
+    def _enqueue_sii_batch(self, cancel=False):
+        """Queue a job for sending the invoices in batch, linking it to them.
+
+        :param self: Invoices of the same batch.
+        :param cancel: It indicates if the job is for a cancellation.
+        """
+        company = self[:1].company_id
+        delayed = self.sudo().with_context(
+            company_id=company.id,
+        ).with_delay()
+        if cancel:
+            new_delay = delayed.cancel_invoice_batch()
+        else:
+            new_delay = delayed.confirm_invoice_batch()
+        job = self.env['queue.job'].sudo().search([
+            ('uuid', '=', new_delay.uuid)
+        ], limit=1)
+        self.sudo().write({
+            'invoice_jobs_ids': [(4, job.id)],
+            'sii_send_date': False,
+        })
+
+    @api.model
+    def _cron_sii_send_batches(self):
+        """Collect the invoices whose scheduled SII send date has arrived and
+        queue a job for each batch, instead of a job per invoice."""
+        invoices = self.sudo().search([
+            ('sii_send_date', '<=', fields.Datetime.now()),
+            ('state', 'in', ['open', 'paid']),
+        ], order='company_id, id')
+        dispatched = invoices.filtered(
+            lambda x: x.company_id.sii_parallel_dispatch
+        )
+        for company in (invoices - dispatched).mapped('company_id'):
+            company_invoices = invoices.filtered(
+                lambda x: x.company_id == company
+            )
+            batches = company_invoices._split_sii_batches(
+                limit=company._get_sii_batch_size(),
+            )
+            for key, batch in batches:
+                batch._enqueue_sii_batch()
+        dispatched._dispatch_sii_batches()
+
+    @api.multi
+    def _dispatch_sii_batches(self):
+        """Send the invoices in batches, processing the companies in
+        parallel threads, each one with its own cursor, so the total time is
+        bounded by the slowest company instead of being the sum of all of
+        them. The batches of each company are sent one after another.
+
+        The number of threads is set by the system parameter
+        'l10n_es_aeat_sii.dispatch_workers' (8 by default), while the
+        concurrent calls to each tax agency are limited by its
+        'max_concurrency'.
+        """
+        company_invoice_ids = OrderedDict()
+        for invoice in self:
+            company_invoice_ids.setdefault(
+                invoice.company_id.id, [],
+            ).append(invoice.id)
+        if not company_invoice_ids:
+            return
+        if (len(company_invoice_ids) == 1 or
+                getattr(threading.currentThread(), 'testing', False)):
+            # Tests can't see their data from other cursors
+            for invoice_ids in company_invoice_ids.values():
+                self.browse(invoice_ids)._send_sii_company_batches()
+            return
+        workers = int(self.env['ir.config_parameter'].sudo().get_param(
+            'l10n_es_aeat_sii.dispatch_workers', 8))
+        args = (self.env.cr.dbname, self.env.uid, self.env.context)
+        with ThreadPoolExecutor(
+            max_workers=max(1, min(workers, len(company_invoice_ids))),
+        ) as executor:
+            futures = {
+                executor.submit(
+                    _dispatch_sii_company_batches, *args,
+                    invoice_ids=invoice_ids,
+                ): company_id
+                for company_id, invoice_ids in company_invoice_ids.items()
+            }
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception:
+                    _logger.exception(
+                        "Error dispatching the SII batches of company %s",
+                        futures[future],
+                    )
+
+    @api.multi
+    def _send_sii_company_batches(self, commit=False):
+        """Send in batches the invoices of a single company.
+
+        :param commit: Commit the transaction after each batch, so the
+          results of the batches already communicated are kept.
+        """
+        company = self[:1].company_id
+        invoices = self.filtered(lambda i: i.state in ['open', 'paid'])
+        batches = invoices._split_sii_batches(
+            limit=company._get_sii_batch_size(),
+        )
+        for key, batch in batches:
+            batch.write({'sii_send_date': False})
+            batch._send_invoice_batch_to_sii(tipo_comunicacion=key[2])
+            if commit:
+                self.env.cr.commit()  # pylint: disable=invalid-commit
+
     @api.multi
     def _cancel_invoice_to_sii(self):
         for invoice in self.filtered(lambda i: i.state in ['cancel']):
-            serv = invoice._connect_sii(invoice.type)
+            operation = invoice._get_sii_batch_operation(cancel=True)
+            submission = self.env['aeat.sii.submission']._new_submission(
+                operation, cancel=True,
+            )
+            with sii_stage_timer(submission, 'connect_duration'):
+                serv = invoice._connect_sii(invoice.type)
             header = invoice._get_sii_header(cancellation=True)
             inv_vals = {
                 'sii_send_failed': True,
                 'sii_send_error': False,
             }
+            request = {'header': json.dumps(header, indent=4)}
             try:
-                inv_dict = invoice._get_cancel_sii_invoice_dict()
-                if invoice.type in ['out_invoice', 'out_refund']:
-                    res = serv.AnulacionLRFacturasEmitidas(header, inv_dict)
-                else:
-                    res = serv.AnulacionLRFacturasRecibidas(header, inv_dict)
+                with sii_stage_timer(submission, 'build_duration'):
+                    inv_dict = invoice._get_cancel_sii_invoice_dict()
+                request['content'] = json.dumps(inv_dict, indent=4)
+                with sii_stage_timer(submission, 'duration'):
+                    res = invoice._call_sii_service(
+                        getattr(serv, operation), header, inv_dict,
+                    )
                 # TODO Facturas intracomunitarias 66 RIVA
                 # elif invoice.fiscal_position_id.id == self.env.ref(
                 #     'account.fp_intra').id:
                 #     res = serv.AnulacionLRDetOperacionIntracomunitaria(
                 #         header, invoices)
                 inv_vals['sii_return'] = res
-                if res['EstadoEnvio'] == 'Correcto':
-                    inv_vals.update({
-                        'sii_state': 'cancelled',
-                        'sii_csv': res['CSV'],
-                        'sii_send_failed': False,
-                    })
                 res_line = res['RespuestaLinea'][0]
-                if res_line['CodigoErrorRegistro']:
-                    inv_vals['sii_send_error'] = u"{} | {}".format(
-                        str(res_line['CodigoErrorRegistro']),
-                        str(res_line['DescripcionErrorRegistro'])[:60],
-                    )
-                invoice.write(inv_vals)
+                inv_vals.update(
+                    invoice._get_sii_cancel_result_vals(res, res_line),
+                )
+                invoice._write_sii_result(inv_vals, submission, request)
+            except SiiWaitRequired as wait:
+                invoice._postpone_sii_send(wait.seconds, cancel=True)
             except Exception as fault:
                 new_cr = Registry(self.env.cr.dbname).cursor()
                 env = api.Environment(new_cr, self.env.uid, self.env.context)
@@ -1115,7 +1915,7 @@ class AccountInvoice(models.Model):
                     'sii_send_error': repr(fault)[:60],
                     'sii_return': repr(fault),
                 })
-                invoice.write(inv_vals)
+                invoice._write_sii_result(inv_vals, submission, request)
                 new_cr.commit()
                 new_cr.close()
                 raise
@@ -1146,13 +1946,47 @@ class AccountInvoice(models.Model):
                 ], limit=1)
                 invoice.sudo().invoice_jobs_ids |= job
 
+    @api.multi
+    def cancel_sii_batch(self):
+        """Send the cancellation of the selected invoices to the SII grouping
+        them in batches. If the company uses connector, a job is queued for
+        each batch."""
+        invoices = self.filtered(
+            lambda i: (i.sii_enabled and i.state in ['cancel'] and
+                       i.sii_state in ['sent', 'sent_w_errors',
+                                       'sent_modified'])
+        )
+        if not invoices._cancel_invoice_jobs():
+            raise exceptions.Warning(_(
+                'You can not communicate the cancellation of these invoices '
+                'at this moment because there is a job running!'))
+        for company in invoices.mapped('company_id'):
+            company_invoices = invoices.filtered(
+                lambda x: x.company_id == company
+            )
+            batches = company_invoices._split_sii_batches(
+                cancel=True, limit=company._get_sii_batch_size(),
+            )
+            for key, batch in batches:
+                if company.use_connector:
+                    batch._enqueue_sii_batch(cancel=True)
+                else:
+                    batch._cancel_invoice_batch_to_sii()
+
     @api.multi
     def _cancel_invoice_jobs(self):
-        for queue in self.sudo().mapped('invoice_jobs_ids'):
-            if queue.state == 'started':
-                return False
-            elif queue.state in ('pending', 'enqueued', 'failed'):
-                queue.unlink()
+        for invoice in self.sudo():
+            for queue in invoice.invoice_jobs_ids:
+                if queue.state == 'started':
+                    return False
+                elif queue.state not in ('pending', 'enqueued', 'failed'):
+                    continue
+                if queue.method_name in SII_BATCH_JOB_METHODS:
+                    # The job is shared with the rest of the batch, so only
+                    # the invoice is detached and the job skips it
+                    invoice.write({'invoice_jobs_ids': [(3, queue.id)]})
+                else:
+                    queue.unlink()
         return True
 
     @api.multi
@@ -1162,6 +1996,11 @@ class AccountInvoice(models.Model):
                 'You can not cancel this invoice because'
                 ' there is a job running!'))
         res = super(AccountInvoice, self).action_cancel()
+        # Pending retries of the previous communications no longer apply
+        self.filtered('sii_next_retry_date').write({
+            'sii_send_attempts': 0,
+            'sii_next_retry_date': False,
+        })
         for invoice in self:
             if invoice.sii_state == 'sent':
                 invoice.sii_state = 'sent_modified'
@@ -1310,9 +2149,49 @@ class AccountInvoice(models.Model):
         ).upper()
         return SII_COUNTRY_CODE_MAPPING.get(country_code, country_code)
 
-    @api.depends('invoice_line_ids', 'invoice_line_ids.name', 'company_id',
-                 'sii_manual_description')
+    @api.multi
+    def _get_sii_description_line_names(self):
+        """Get the names of the lines of the invoices with the automatic
+        description method, reading all of them in a single query.
+
+        Only the first lines that can fit on the description are read, as
+        each one takes at least a character and the separator.
+
+        :return: Dictionary {invoice ID: list of line names}.
+        """
+        invoices = self.filtered(
+            lambda x: x.company_id.sii_description_method == 'auto'
+        )
+        res = defaultdict(list)
+        # New records (onchange) don't have their lines on the database
+        for invoice in invoices.filtered(lambda x: not isinstance(x.id, int)):
+            res[invoice.id] = invoice.mapped('invoice_line_ids.name')
+        invoice_ids = tuple(x for x in invoices.ids if isinstance(x, int))
+        if not invoice_ids:
+            return res
+        self.env.cr.execute("""
+            SELECT invoice_id, name FROM (
+                SELECT invoice_id, LEFT(name, %s) AS name, sequence, id,
+                    ROW_NUMBER() OVER (
+                        PARTITION BY invoice_id ORDER BY sequence, id
+                    ) AS position
+                FROM account_invoice_line
+                WHERE invoice_id IN %s AND name IS NOT NULL
+            ) lines
+            WHERE position <= %s
+            ORDER BY invoice_id, sequence, id""", (
+            SII_DESCRIPTION_LIMIT, invoice_ids, SII_DESCRIPTION_LIMIT // 4 + 1,
+        ))
+        for invoice_id, name in self.env.cr.fetchall():
+            res[invoice_id].append(name)
+        return res
+
+    @api.depends('company_id', 'sii_manual_description')
     def _compute_sii_description(self):
+        """The automatic description doesn't depend on the invoice lines, so
+        it's not recomputed on each line change. It's refreshed when the
+        invoice is validated instead (see ``_refresh_sii_description``)."""
+        line_names = self._get_sii_description_line_names()
         for invoice in self:
             if invoice.type in ['out_invoice', 'out_refund']:
                 description = invoice.company_id.sii_header_customer or ''
@@ -1326,13 +2205,33 @@ class AccountInvoice(models.Model):
                     invoice.sii_manual_description or description or '/'
                 )
             else:  # auto method
-                if invoice.invoice_line_ids:
-                    if description:
-                        description += ' | '
-                    description += ' - '.join(
-                        invoice.mapped('invoice_line_ids.name')
-                    )
-            invoice.sii_description = description[:500] or '/'
+                names = line_names.get(invoice.id)
+                if names:
+                    parts = [description, ' | '] if description else []
+                    length = len(description) + len(' | ') * bool(description)
+                    for index, name in enumerate(names):
+                        # Stop as soon as the limit is reached
+                        if length >= SII_DESCRIPTION_LIMIT:
+                            break
+                        if index:
+                            parts.append(' - ')
+                            length += len(' - ')
+                        parts.append(name)
+                        length += len(name)
+                    description = ''.join(parts)
+            invoice.sii_description = (
+                description[:SII_DESCRIPTION_LIMIT] or '/'
+            )
+
+    @api.multi
+    def _refresh_sii_description(self):
+        """Recompute the automatic SII description from the current lines."""
+        invoices = self.filtered(
+            lambda x: x.company_id.sii_description_method == 'auto'
+        )
+        if invoices:
+            self.env.add_todo(self._fields['sii_description'], invoices)
+            self.recompute()
 
     @api.multi
     def _inverse_sii_description(self):
@@ -1387,3 +2286,32 @@ class AccountInvoice(models.Model):
     @api.multi
     def cancel_one_invoice(self):
         self._cancel_invoice_to_sii()
+
+    @job(default_channel='root.invoice_validate_sii')
+    @api.multi
+    def confirm_invoice_batch(self):
+        self._filter_sii_batch_job_invoices()._send_invoices_to_sii_batch()
+
+    @api.multi
+    def _cancel_invoices_to_sii_batch(self):
+        """Send the cancellation of the invoices to the SII using as few
+        calls as possible, registering the errors on each invoice."""
+        invoices = self.filtered(lambda i: i.state in ['cancel'])
+        for key, batch in invoices._split_sii_batches(cancel=True):
+            batch._cancel_invoice_batch_to_sii()
+
+    @job(default_channel='root.invoice_validate_sii')
+    @api.multi
+    def cancel_invoice_batch(self):
+        self._filter_sii_batch_job_invoices()._cancel_invoices_to_sii_batch()
+
+    @api.multi
+    def _filter_sii_batch_job_invoices(self):
+        """Invoices still linked to the running batch job, as the ones
+        cancelled, set to draft or sent again meanwhile are detached from it.
+        """
+        job_uuid = self.env.context.get('job_uuid')
+        if not job_uuid:
+            return self
+        return self.filtered(lambda i: job_uuid in i.sudo().mapped(
+            'invoice_jobs_ids.uuid'))
@@ -0,0 +1,41 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from odoo import api, models
+
+
+class AccountTax(models.Model):
+    _inherit = 'account.tax'
+
+    # The SII tax index (see ``aeat.sii.map._get_sii_tax_index``) depends on
+    # the name, description and company of the taxes
+
+    @api.model
+    def _clear_sii_tax_caches(self, companies):
+        """Invalidate the SII tax indexes if any of the companies uses the
+        SII, so the taxes created on the chart installations of the rest
+        don't flush the cache.
+
+        :param companies: Companies of the modified taxes.
+        """
+        if any(companies.mapped('sii_enabled')):
+            self.env['aeat.sii.map']._clear_sii_tax_caches()
+
+    @api.model
+    def create(self, vals):
+        tax = super(AccountTax, self).create(vals)
+        self._clear_sii_tax_caches(tax.company_id)
+        return tax
+
+    @api.multi
+    def write(self, vals):
+        if {'name', 'description', 'company_id'} & set(vals):
+            companies = self.mapped('company_id')
+            if vals.get('company_id'):
+                companies |= companies.browse(vals['company_id'])
+            self._clear_sii_tax_caches(companies)
+        return super(AccountTax, self).write(vals)
+
+    @api.multi
+    def unlink(self):
+        self._clear_sii_tax_caches(self.mapped('company_id'))
+        return super(AccountTax, self).unlink()
@@ -0,0 +1,31 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from odoo import api, models
+
+
+class AccountTaxTemplate(models.Model):
+    _inherit = 'account.tax.template'
+
+    # The SII tax index (see ``aeat.sii.map._get_sii_tax_index``) maps the
+    # templates of the SII map lines to the taxes by their name and
+    # description
+
+    @api.multi
+    def _clear_sii_tax_caches(self):
+        """Invalidate the SII tax indexes if any of the templates is used on
+        the SII maps."""
+        if self.env['aeat.sii.map.lines'].sudo().search_count([
+            ('taxes', 'in', self.ids),
+        ]):
+            self.env['aeat.sii.map']._clear_sii_tax_caches()
+
+    @api.multi
+    def write(self, vals):
+        if {'name', 'description'} & set(vals):
+            self._clear_sii_tax_caches()
+        return super(AccountTaxTemplate, self).write(vals)
+
+    @api.multi
+    def unlink(self):
+        self._clear_sii_tax_caches()
+        return super(AccountTaxTemplate, self).unlink()
@@ -2,7 +2,15 @@
 # (c) 2017 Consultoría Informática Studio 73 S.L.
 # License AGPL-3 - See http://www.gnu.org/licenses/agpl-3.0.html
 
-from odoo import api, models, fields, _
+from odoo import api, models, fields, tools, _
+
+from ..sii_client import sii_service_cache, sii_ssl_context_cache
+
+# Fields whose change implies a different certificate for the connection
+CERTIFICATE_FIELDS = [
+    'state', 'date_start', 'date_end', 'public_key', 'private_key',
+    'company_id',
+]
 
 
 class L10nEsAeatSii(models.Model):
@@ -26,6 +34,70 @@ class L10nEsAeatSii(models.Model):
         default=lambda self: self.env.user.company_id.id
     )
 
+    @api.model
+    @tools.ormcache('company_id', 'date')
+    def _get_sii_certificate(self, company_id, date):
+        """Certificate to use on the SII connections of a company, kept on
+        the ORM cache, so it's read once per process until a certificate is
+        changed.
+
+        :param company_id: ID of the company.
+        :param date: Date string when the certificate must be valid.
+        :return: Tuple (certificate ID, write date string, public certificate
+          path, private key path). If there's no certificate for the company,
+          the paths of the system parameters are returned, with ID False.
+        """
+        sii_config = self.sudo().search([
+            ('company_id', '=', company_id),
+            ('public_key', '!=', False),
+            ('private_key', '!=', False),
+            '|',
+            ('date_start', '=', False),
+            ('date_start', '<=', date),
+            '|',
+            ('date_end', '=', False),
+            ('date_end', '>=', date),
+            ('state', '=', 'active'),
+        ], limit=1)
+        if sii_config:
+            return (
+                sii_config.id,
+                fields.Datetime.to_string(sii_config.write_date),
+                sii_config.public_key,
+                sii_config.private_key,
+            )
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        return (
+            False,
+            False,
+            get_param('l10n_es_aeat_sii.publicCrt', False),
+            get_param('l10n_es_aeat_sii.privateKey', False),
+        )
+
+    @api.model
+    def _invalidate_sii_certificates(self, company_id=None):
+        """Drop the cached certificates and services. Clearing the ORM cache
+        is signaled to the rest of the server processes, which then read the
+        new certificate on their next connection."""
+        self.clear_caches()
+        sii_service_cache.invalidate(
+            dbname=self.env.cr.dbname, company_id=company_id,
+        )
+        sii_ssl_context_cache.invalidate(dbname=self.env.cr.dbname)
+
+    @api.multi
+    def write(self, vals):
+        res = super(L10nEsAeatSii, self).write(vals)
+        if any(x in vals for x in CERTIFICATE_FIELDS):
+            self._invalidate_sii_certificates()
+        return res
+
+    @api.multi
+    def unlink(self):
+        res = super(L10nEsAeatSii, self).unlink()
+        self._invalidate_sii_certificates()
+        return res
+
     @api.multi
     def load_password_wizard(self):
         self.ensure_one()
@@ -47,3 +119,4 @@ class L10nEsAeatSii(models.Model):
             ('company_id', '=', self.company_id.id),
         ]).write({'state': 'draft'})
         self.state = 'active'
+        self._invalidate_sii_certificates(company_id=self.company_id.id)
@@ -1,7 +1,7 @@
 # Copyright 2017 Ignacio Ibeas <ignacio@acysos.com>
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
-from odoo import api, models, fields, _
+from odoo import api, models, fields, tools, _
 from odoo import exceptions
 
 
@@ -46,6 +46,106 @@ class AeatSiiMap(models.Model):
         inverse_name='sii_map_id',
         string='Lines')
 
+    @api.model
+    def create(self, vals):
+        self._clear_sii_tax_caches()
+        return super(AeatSiiMap, self).create(vals)
+
+    @api.multi
+    def write(self, vals):
+        if {'date_from', 'date_to', 'map_lines'} & set(vals):
+            self._clear_sii_tax_caches()
+        return super(AeatSiiMap, self).write(vals)
+
+    @api.multi
+    def unlink(self):
+        self._clear_sii_tax_caches()
+        return super(AeatSiiMap, self).unlink()
+
+    @api.model
+    def _clear_sii_tax_caches(self):
+        """Invalidate the cached SII maps and tax indexes."""
+        self._get_sii_map_id.clear_cache(self)
+        self._get_sii_tax_index.clear_cache(self)
+
+    @api.model
+    @tools.ormcache('date')
+    def _get_sii_map_id(self, date):
+        """Get the SII map that applies on the given date.
+
+        :param date: Date of the invoice.
+        :return: ID of the SII map (False if there's no map).
+        """
+        return self.search(
+            ['|',
+             ('date_from', '<=', date),
+             ('date_from', '=', False),
+             '|',
+             ('date_to', '>=', date),
+             ('date_to', '=', False)], limit=1).id
+
+    @api.model
+    def _map_sii_tax_template(self, tax_template, company, mapping_taxes):
+        """Adds a tax template -> tax id to the mapping.
+        Adapted from account_chart_update module.
+
+        :param tax_template: Tax template record.
+        :param company: Company record of the taxes.
+        :param mapping_taxes: Dictionary with all the tax templates mapping.
+        :return: Tax template current mapping
+        """
+        if not tax_template:
+            return self.env['account.tax']
+        if mapping_taxes.get(tax_template):
+            return mapping_taxes[tax_template]
+        # search inactive taxes too, to avoid re-creating
+        # taxes that have been deactivated before
+        tax_obj = self.env['account.tax'].with_context(active_test=False)
+        criteria = ['|',
+                    ('name', '=', tax_template.name),
+                    ('description', '=', tax_template.name)]
+        if tax_template.description:
+            criteria = ['|'] + criteria
+            criteria += [
+                '|',
+                ('description', '=', tax_template.description),
+                ('name', '=', tax_template.description),
+            ]
+        criteria += [('company_id', '=', company.id)]
+        mapping_taxes[tax_template] = tax_obj.search(criteria)
+        return mapping_taxes[tax_template]
+
+    @api.model
+    @tools.ormcache('company_id', 'map_id')
+    def _get_sii_tax_index(self, company_id, map_id):
+        """Get the taxes of the company for each code of the SII map. The
+        result is cached, and invalidated when the SII maps, their lines,
+        the tax templates or the taxes are modified.
+
+        The tax templates are mapped with ``map_sii_tax_template`` of the
+        invoices, so its overrides are applied. It's called on an invoice
+        with only the company set, as the index is shared by all the
+        invoices of the company.
+
+        :param company_id: ID of the company of the taxes.
+        :param map_id: ID of the SII map.
+        :return: Dictionary {code: frozenset(tax_ids)}.
+        """
+        sii_map = self.sudo().browse(map_id)
+        invoice = self.env['account.invoice'].sudo().new({
+            'company_id': company_id,
+        })
+        mapping_taxes = {}
+        index = {}
+        for line in sii_map.map_lines:
+            tax_ids = set(index.get(line.code, ()))
+            for tax_template in line.taxes:
+                tax_ids.update(invoice.map_sii_tax_template(
+                    tax_template, mapping_taxes,
+                ).ids)
+            index[line.code] = frozenset(tax_ids)
+        return index
+
 
 class AeatSiiMapLines(models.Model):
     _name = 'aeat.sii.map.lines'
@@ -59,3 +159,19 @@ class AeatSiiMapLines(models.Model):
         comodel_name='aeat.sii.map',
         string='Aeat SII Map',
         ondelete='cascade')
+
+    @api.model
+    def create(self, vals):
+        self.env['aeat.sii.map']._clear_sii_tax_caches()
+        return super(AeatSiiMapLines, self).create(vals)
+
+    @api.multi
+    def write(self, vals):
+        if {'code', 'taxes', 'sii_map_id'} & set(vals):
+            self.env['aeat.sii.map']._clear_sii_tax_caches()
+        return super(AeatSiiMapLines, self).write(vals)
+
+    @api.multi
+    def unlink(self):
+        self.env['aeat.sii.map']._clear_sii_tax_caches()
+        return super(AeatSiiMapLines, self).unlink()
@@ -0,0 +1,341 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import json
+import logging
+from collections import OrderedDict
+from datetime import timedelta
+
+from odoo import _, api, fields, models
+
+from ..sii_client import SiiWaitRequired
+from .account_invoice import _get_sii_id_factura_key
+
+_logger = logging.getLogger(__name__)
+
+# Invoice states at the SII that allow to communicate their payments
+SII_PAYMENT_INVOICE_STATES = [
+    'sent', 'sent_w_errors', 'sent_modified', 'cancelled_modified',
+]
+# Reconciliations younger than this are left for the next run, as a
+# concurrent transaction may still commit one with a lower ID
+SII_PAYMENT_SAFETY_DELAY = timedelta(minutes=10)
+
+
+class AeatSiiPayment(models.Model):
+    _name = 'aeat.sii.payment'
+    _description = 'SII collection/payment of cash-basis invoices'
+    _order = 'date desc, id desc'
+
+    invoice_id = fields.Many2one(
+        comodel_name='account.invoice', string="Invoice", required=True,
+        ondelete='cascade', index=True, readonly=True,
+    )
+    company_id = fields.Many2one(
+        comodel_name='res.company', related='invoice_id.company_id',
+        store=True, readonly=True, index=True,
+    )
+    partial_reconcile_id = fields.Many2one(
+        comodel_name='account.partial.reconcile', string="Reconciliation",
+        ondelete='set null', index=True, readonly=True,
+    )
+    payment_type = fields.Selection(
+        selection=[('out', 'Collection'), ('in', 'Payment')],
+        string="Type", required=True, readonly=True,
+    )
+    date = fields.Date(string="Date", required=True, readonly=True)
+    amount = fields.Float(string="Amount", readonly=True)
+    payment_mean = fields.Selection(
+        selection=[
+            ('01', '[01] Transfer'),
+            ('02', '[02] Cheque'),
+            ('03', '[03] Not collected/paid'),
+            ('04', '[04] Other means'),
+            ('05', '[05] Direct debit'),
+        ], string="Payment mean", required=True, default='04',
+    )
+    account_or_mean = fields.Char(string="Account or mean", size=34)
+    state = fields.Selection(
+        selection=[
+            ('pending', 'Pending'),
+            ('sent', 'Sent'),
+            ('error', 'Error'),
+        ], string="State", default='pending', required=True, index=True,
+        readonly=True, copy=False,
+    )
+    sii_csv = fields.Char(string="SII CSV", readonly=True, copy=False)
+    sii_send_error = fields.Text(
+        string="SII send error", readonly=True, copy=False,
+    )
+    sii_return = fields.Text(string="SII return", readonly=True, copy=False)
+    send_date = fields.Datetime(string="Send date", readonly=True, copy=False)
+    sii_send_attempts = fields.Integer(
+        string="SII send attempts", readonly=True, copy=False,
+        help="Consecutive failed sends to the SII.",
+    )
+    sii_next_retry_date = fields.Datetime(
+        string="SII next retry date", readonly=True, copy=False, index=True,
+        help="Date when the failed send will be retried automatically.",
+    )
+
+    _sql_constraints = [
+        ('partial_reconcile_invoice_unique',
+         'unique(partial_reconcile_id, invoice_id)',
+         'The reconciliation is already registered for this invoice.'),
+    ]
+
+    @api.model
+    def _get_sii_payment_mean(self, move_line):
+        """Payment mean and account to communicate for a payment.
+
+        :param move_line: Counterpart move line of the invoice reconciliation.
+        :return: Tuple (payment mean code, account or mean).
+        """
+        journal = move_line.journal_id
+        if journal.type == 'bank' and journal.bank_account_id:
+            return '01', journal.bank_account_id.acc_number[:34]
+        return '04', (journal.name or '')[:34]
+
+    @api.model
+    def _generate_sii_payments(self, date_until=None):
+        """Create the SII payments of the cash-basis invoices from the
+        reconciliations done since the previous run.
+
+        Only the new reconciliations are read, as the last processed ID is
+        kept on the system parameter 'l10n_es_aeat_sii.payment_last_partial'.
+
+        :param date_until: Only reconciliations created up to this moment are
+          processed. By default, a safety delay is applied from now.
+        :return: Created records.
+        """
+        config = self.env['ir.config_parameter'].sudo()
+        last_id = int(config.get_param(
+            'l10n_es_aeat_sii.payment_last_partial', 0))
+        if not date_until:
+            date_until = fields.Datetime.now() - SII_PAYMENT_SAFETY_DELAY
+        self.env.cr.execute("""
+            SELECT MAX(id) FROM account_partial_reconcile
+            WHERE id > %s AND create_date <= %s""", (last_id, date_until))
+        max_id = self.env.cr.fetchone()[0]
+        if not max_id:
+            return self.browse()
+        self.env.cr.execute("""
+            SELECT apr.id, ai.id, other.id, apr.amount
+            FROM account_partial_reconcile apr
+            JOIN account_move_line aml
+                ON aml.id IN (apr.debit_move_id, apr.credit_move_id)
+            JOIN account_move_line other
+                ON other.id IN (apr.debit_move_id, apr.credit_move_id)
+                AND other.id != aml.id
+            JOIN account_invoice ai ON ai.id = aml.invoice_id
+            JOIN res_company rc ON rc.id = ai.company_id
+            JOIN aeat_sii_mapping_registration_keys rk
+                ON rk.id = ai.sii_registration_key
+            WHERE apr.id > %s AND apr.id <= %s
+                AND rc.sii_enabled
+                AND rk.code = '07'
+                AND ai.type IN ('out_invoice', 'in_invoice')
+                AND other.invoice_id IS NULL
+            ORDER BY apr.id""", (last_id, max_id))
+        rows = self.env.cr.fetchall()
+        move_lines = self.env['account.move.line'].browse(
+            [x[2] for x in rows])
+        invoices = self.env['account.invoice'].browse([x[1] for x in rows])
+        vals_list = []
+        for partial_id, invoice_id, line_id, amount in rows:
+            invoice = invoices.browse(invoice_id)
+            move_line = move_lines.browse(line_id)
+            payment_mean, account_or_mean = self._get_sii_payment_mean(
+                move_line)
+            vals_list.append({
+                'invoice_id': invoice.id,
+                'partial_reconcile_id': partial_id,
+                'payment_type': (
+                    'out' if invoice.type == 'out_invoice' else 'in'),
+                'date': move_line.date,
+                'amount': amount,
+                'payment_mean': payment_mean,
+                'account_or_mean': account_or_mean,
+            })
+        payments = self.create(vals_list)
+        config.set_param('l10n_es_aeat_sii.payment_last_partial', max_id)
+        return payments
+
+    @api.multi
+    def _get_sii_payment_record(self):
+        """Build the record to communicate for the payments of an invoice.
+
+        :param self: Payments of the same invoice.
+        :return: Dictionary with the 'IDFactura' and the payments.
+        """
+        invoice = self[:1].invoice_id
+        payments = [{
+            'Fecha': invoice._change_date_format(payment.date),
+            'Importe': round(payment.amount, 2),
+            'Medio': payment.payment_mean,
+            'Cuenta_O_Medio': payment.account_or_mean or '-',
+        } for payment in self]
+        if invoice.type == 'out_invoice':
+            return {
+                'IDFactura': invoice._get_sii_id_factura(),
+                'Cobros': {'Cobro': payments},
+            }
+        return {
+            'IDFactura': invoice._get_sii_id_factura(),
+            'Pagos': {'Pago': payments},
+        }
+
+    @api.multi
+    def _get_sii_retry_vals(self, failed):
+        """Values of the retry queue after an SII communication, with the
+        same backoff than the invoices.
+
+        :param self: Single payment record.
+        :param failed: It indicates if the communication has failed.
+        :return: Dictionary with the values to write on the payment.
+        """
+        self.ensure_one()
+        if not failed:
+            return {'sii_send_attempts': 0, 'sii_next_retry_date': False}
+        attempts = self.sii_send_attempts + 1
+        return {
+            'sii_send_attempts': attempts,
+            'sii_next_retry_date': self.env[
+                'account.invoice']._get_sii_retry_date(attempts),
+        }
+
+    @api.multi
+    def _write_sii_result(self, vals):
+        """Write the result of an SII communication on the payments,
+        scheduling the retry of the failed ones.
+
+        :param vals: Values to write, including the state.
+        """
+        failed = vals['state'] == 'error'
+        for payment in self:
+            payment.write(dict(vals, **payment._get_sii_retry_vals(failed)))
+
+    @api.multi
+    def _split_sii_batches(self):
+        """Split the payments in chunks of the same company and type, with up
+        to the batch size of the company of invoices on each chunk.
+
+        :return: Generator of payment recordsets.
+        """
+        groups = OrderedDict()
+        for payment in self:
+            key = (payment.company_id, payment.payment_type)
+            groups.setdefault(key, OrderedDict()).setdefault(
+                payment.invoice_id, self.browse(),
+            )
+            groups[key][payment.invoice_id] |= payment
+        for (company, payment_type), by_invoice in groups.items():
+            limit = company._get_sii_batch_size()
+            chunks = list(by_invoice.values())
+            for i in range(0, len(chunks), limit):
+                yield self.browse().union(*chunks[i:i + limit])
+
+    @api.multi
+    def _send_sii_batch(self):
+        """Communicate a chunk of payments of the same company and type in a
+        single SII call, writing on each payment the result of the line of
+        its invoice."""
+        first = self[:1]
+        if not first:
+            return
+        invoice = first.invoice_id
+        mapping_key = '%s_payment' % first.payment_type
+        header = invoice._get_sii_header(cancellation=True)
+        records = OrderedDict()
+        for inv in self.mapped('invoice_id'):
+            inv_payments = self.filtered(lambda x: x.invoice_id == inv)
+            record = inv_payments._get_sii_payment_record()
+            key = _get_sii_id_factura_key(record['IDFactura'])
+            records[key] = (inv_payments, record)
+        now = fields.Datetime.now()
+        try:
+            serv = invoice._connect_sii(mapping_key)
+            if first.payment_type == 'out':
+                operation = serv.SuministroLRCobrosEmitidas
+            else:
+                operation = serv.SuministroLRPagosRecibidas
+            res = invoice._call_sii_service(
+                operation, header, [x[1] for x in records.values()],
+            )
+        except SiiWaitRequired as wait:
+            # They are sent on the next execution of the scheduler
+            _logger.info(
+                "SII send of %s payments postponed %.1f seconds",
+                len(self), wait.seconds,
+            )
+            return
+        except Exception as fault:
+            _logger.exception(
+                "Error sending a batch of %s SII payments", len(self),
+            )
+            self._write_sii_result({
+                'state': 'error',
+                'send_date': now,
+                'sii_send_error': repr(fault),
+            })
+            return
+        for res_line in res['RespuestaLinea']:
+            key = _get_sii_id_factura_key(res_line['IDFactura'])
+            if key not in records:
+                continue
+            payments = records.pop(key)[0]
+            state = res_line['EstadoRegistro']
+            error = False
+            if state not in ['Correcto', 'AceptadoConErrores']:
+                error = "%s | %s" % (
+                    res_line['CodigoErrorRegistro'],
+                    res_line['DescripcionErrorRegistro'],
+                )
+            payments._write_sii_result({
+                'state': 'error' if error else 'sent',
+                'send_date': now,
+                'sii_csv': res['CSV'],
+                'sii_send_error': error,
+                'sii_return': json.dumps({
+                    'CSV': res['CSV'],
+                    'EstadoEnvio': res['EstadoEnvio'],
+                    'EstadoRegistro': state,
+                }),
+            })
+        for payments, record in records.values():
+            payments._write_sii_result({
+                'state': 'error',
+                'send_date': now,
+                'sii_send_error': _("No response received for this invoice"),
+            })
+
+    @api.multi
+    def send_sii(self):
+        """Send the selected payments whose invoice is already registered at
+        the SII, grouped in batches."""
+        payments = self.filtered(
+            lambda x: (
+                x.state != 'sent' and
+                x.invoice_id.sii_state in SII_PAYMENT_INVOICE_STATES
+            )
+        )
+        for batch in payments._split_sii_batches():
+            batch._send_sii_batch()
+
+    @api.model
+    def _cron_sii_payments(self):
+        """Derive the payments of the new reconciliations and send in
+        batches the pending ones and the failed ones whose retry date has
+        arrived."""
+        payment_obj = self.sudo()
+        payment_obj._generate_sii_payments()
+        # Undone reconciliations lose their link and are not communicated
+        payment_obj.search([
+            ('state', '!=', 'sent'),
+            ('partial_reconcile_id', '=', False),
+        ]).unlink()
+        payment_obj.search([
+            '|', ('state', '=', 'pending'),
+            '&', ('state', '=', 'error'),
+            ('sii_next_retry_date', '<=', fields.Datetime.now()),
+            ('invoice_id.sii_state', 'in', SII_PAYMENT_INVOICE_STATES),
+        ], order='company_id, payment_type, invoice_id, id').send_sii()
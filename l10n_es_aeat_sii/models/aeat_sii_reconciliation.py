@@ -0,0 +1,319 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import logging
+
+from odoo import _, api, exceptions, fields, models
+from odoo.tools.float_utils import float_compare
+
+from .account_invoice import _get_sii_id_factura_key
+
+_logger = logging.getLogger(__name__)
+
+SII_PERIODS = [('%02d' % x, '%02d' % x) for x in range(1, 13)]
+# Number of invoices loaded at once when building the local index
+LOCAL_INDEX_CHUNK = 1000
+# Number of result lines kept in memory before writing them
+LINES_FLUSH_SIZE = 1000
+
+
+class AeatSiiReconciliation(models.Model):
+    _name = 'aeat.sii.reconciliation'
+    _description = 'AEAT SII reconciliation'
+    _order = 'fiscal_year desc, period_from desc, id desc'
+
+    name = fields.Char(compute='_compute_name')
+    company_id = fields.Many2one(
+        comodel_name='res.company', string='Company', required=True,
+        default=lambda self: self.env.user.company_id,
+    )
+    invoice_type = fields.Selection(
+        selection=[('out', 'Issued invoices'), ('in', 'Received invoices')],
+        string="Invoices", required=True, default='out',
+    )
+    fiscal_year = fields.Integer(
+        string="Fiscal year", required=True,
+        default=lambda self: fields.Date.today().year,
+    )
+    period_from = fields.Selection(
+        selection=SII_PERIODS, string="From period", required=True,
+        default='01',
+    )
+    period_to = fields.Selection(
+        selection=SII_PERIODS, string="To period", required=True,
+        default='12',
+    )
+    state = fields.Selection(
+        selection=[('draft', 'Draft'), ('done', 'Done')], string="State",
+        default='draft', readonly=True, copy=False,
+    )
+    date_done = fields.Datetime(string="Check date", readonly=True)
+    matched_count = fields.Integer(string="Matched", readonly=True)
+    mismatch_count = fields.Integer(string="Mismatched", readonly=True)
+    missing_count = fields.Integer(string="Missing in SII", readonly=True)
+    extra_count = fields.Integer(string="Only in SII", readonly=True)
+    line_ids = fields.One2many(
+        comodel_name='aeat.sii.reconciliation.line',
+        inverse_name='reconciliation_id', string="Differences",
+        readonly=True,
+    )
+
+    @api.multi
+    @api.depends('invoice_type', 'fiscal_year', 'period_from', 'period_to')
+    def _compute_name(self):
+        types = dict(self._fields['invoice_type'].selection)
+        for rec in self:
+            rec.name = "%s %s/%s-%s" % (
+                types.get(rec.invoice_type, ''), rec.fiscal_year,
+                rec.period_from, rec.period_to,
+            )
+
+    @api.multi
+    @api.constrains('period_from', 'period_to')
+    def _check_periods(self):
+        for rec in self:
+            if rec.period_from > rec.period_to:
+                raise exceptions.ValidationError(
+                    _("The start period must be before the end period.")
+                )
+
+    @api.multi
+    def _get_sii_invoice_types(self):
+        self.ensure_one()
+        if self.invoice_type == 'out':
+            return ['out_invoice', 'out_refund']
+        return ['in_invoice', 'in_refund']
+
+    @api.multi
+    def _get_local_index(self, period):
+        """Build the index of the invoices registered at the SII for a
+        period, loading the invoices in chunks.
+
+        :param period: Period string ('01' to '12').
+        :return: Dictionary {(issuer, number, date): (invoice ID, total
+          amount, cancelled)}.
+        """
+        self.ensure_one()
+        date_from = fields.Date.to_date(
+            '%s-%s-01' % (self.fiscal_year, period))
+        date_to = fields.Date.end_of(date_from, 'month')
+        self.env.cr.execute("""
+            SELECT id FROM account_invoice
+            WHERE company_id = %s
+                AND type IN %s
+                AND date BETWEEN %s AND %s
+                AND sii_state != 'not_sent'
+            ORDER BY id""", (
+            self.company_id.id, tuple(self._get_sii_invoice_types()),
+            date_from, date_to,
+        ))
+        invoice_ids = [x[0] for x in self.env.cr.fetchall()]
+        invoice_obj = self.env['account.invoice']
+        index = {}
+        for i in range(0, len(invoice_ids), LOCAL_INDEX_CHUNK):
+            invoices = invoice_obj.browse(
+                invoice_ids[i:i + LOCAL_INDEX_CHUNK])
+            invoices._prefetch_sii_invoice_data()
+            for invoice in invoices:
+                key = _get_sii_id_factura_key(invoice._get_sii_id_factura())
+                index[key] = (
+                    invoice.id,
+                    abs(round(invoice.amount_total_company_signed, 2)) *
+                    invoice._get_sii_sign(),
+                    invoice.sii_state in ['cancelled', 'cancelled_modified'],
+                )
+            invoices.invalidate_cache()
+        return index
+
+    @api.multi
+    def _iter_sii_registered(self, period):
+        """Iterate over the invoices registered at the SII for a period,
+        requesting the pages one by one with the 'ClavePaginacion' cursor.
+
+        :param period: Period string ('01' to '12').
+        :return: Generator of zeep records of the consultation.
+        """
+        self.ensure_one()
+        invoice = self.env['account.invoice'].new({
+            'company_id': self.company_id.id,
+            'type': self._get_sii_invoice_types()[0],
+        })
+        serv = invoice._connect_sii(invoice.type)
+        header = invoice._get_sii_header(cancellation=True)
+        if self.invoice_type == 'out':
+            operation = serv.ConsultaLRFacturasEmitidas
+            records_key = 'RegistroRespuestaConsultaLRFacturasEmitidas'
+        else:
+            operation = serv.ConsultaLRFacturasRecibidas
+            records_key = 'RegistroRespuestaConsultaLRFacturasRecibidas'
+        query = {
+            'PeriodoLiquidacion': {
+                'Ejercicio': self.fiscal_year,
+                'Periodo': period,
+            },
+        }
+        while True:
+            res = invoice._call_sii_service(
+                operation, header, query, send=False,
+            )
+            records = (
+                res[records_key] if res['ResultadoConsulta'] == 'ConDatos'
+                else []
+            ) or []
+            for record in records:
+                yield record
+            if res['IndicadorPaginacion'] != 'S' or not records:
+                break
+            id_factura = records[-1]['IDFactura']
+            query['ClavePaginacion'] = {
+                'IDEmisorFactura': id_factura['IDEmisorFactura'],
+                'NumSerieFacturaEmisor': (
+                    id_factura['NumSerieFacturaEmisor']),
+                'FechaExpedicionFacturaEmisor': (
+                    id_factura['FechaExpedicionFacturaEmisor']),
+            }
+
+    @api.multi
+    def _reconcile_period(self, period):
+        """Compare the local invoices of a period with the ones registered
+        at the SII, writing the differences.
+
+        :param period: Period string ('01' to '12').
+        :return: Dictionary with the counters of the period.
+        """
+        self.ensure_one()
+        line_obj = self.env['aeat.sii.reconciliation.line']
+        counters = dict.fromkeys(
+            ['matched', 'mismatch', 'missing', 'extra'], 0)
+        index = self._get_local_index(period)
+        lines = []
+
+        def _flush():
+            if lines:
+                line_obj.create(lines)
+                del lines[:]
+                self.invalidate_cache()
+
+        if self.invoice_type == 'out':
+            data_key = 'DatosFacturaEmitida'
+        else:
+            data_key = 'DatosFacturaRecibida'
+        for record in self._iter_sii_registered(period):
+            key = _get_sii_id_factura_key(record['IDFactura'])
+            state = record['EstadoFactura']
+            aeat_state = state['EstadoRegistro']
+            aeat_amount = float(record[data_key]['ImporteTotal'] or 0.0)
+            vals = {
+                'reconciliation_id': self.id,
+                'period': period,
+                'issuer': key[0],
+                'number': key[1],
+                'invoice_date': key[2],
+                'aeat_state': aeat_state,
+                'aeat_amount': aeat_amount,
+                'aeat_csv': state['CSV'],
+            }
+            local = index.pop(key, None)
+            if not local:
+                counters['extra'] += 1
+                vals['result'] = 'extra'
+                lines.append(vals)
+            else:
+                invoice_id, amount, cancelled = local
+                if (cancelled == (aeat_state == 'Anulada') and
+                        not float_compare(amount, aeat_amount, 2)):
+                    counters['matched'] += 1
+                    continue
+                counters['mismatch'] += 1
+                vals.update({
+                    'result': 'mismatch',
+                    'invoice_id': invoice_id,
+                    'local_amount': amount,
+                })
+                lines.append(vals)
+            if len(lines) >= LINES_FLUSH_SIZE:
+                _flush()
+        for key, (invoice_id, amount, cancelled) in index.items():
+            counters['missing'] += 1
+            lines.append({
+                'reconciliation_id': self.id,
+                'result': 'missing',
+                'period': period,
+                'invoice_id': invoice_id,
+                'issuer': key[0],
+                'number': key[1],
+                'invoice_date': key[2],
+                'local_amount': amount,
+            })
+            if len(lines) >= LINES_FLUSH_SIZE:
+                _flush()
+        _flush()
+        return counters
+
+    @api.multi
+    def action_check(self):
+        """Page through the SII register of each period and flag the
+        mismatched, missing and extra invoices."""
+        for rec in self:
+            rec.line_ids.unlink()
+            totals = dict.fromkeys(
+                ['matched', 'mismatch', 'missing', 'extra'], 0)
+            for period, _name in SII_PERIODS:
+                if not rec.period_from <= period <= rec.period_to:
+                    continue
+                counters = rec._reconcile_period(period)
+                _logger.info(
+                    "SII reconciliation %s, period %s: %s",
+                    rec.name, period, counters,
+                )
+                for key, value in counters.items():
+                    totals[key] += value
+            rec.write({
+                'state': 'done',
+                'date_done': fields.Datetime.now(),
+                'matched_count': totals['matched'],
+                'mismatch_count': totals['mismatch'],
+                'missing_count': totals['missing'],
+                'extra_count': totals['extra'],
+            })
+
+    @api.multi
+    def action_draft(self):
+        self.mapped('line_ids').unlink()
+        self.write({
+            'state': 'draft',
+            'date_done': False,
+            'matched_count': 0,
+            'mismatch_count': 0,
+            'missing_count': 0,
+            'extra_count': 0,
+        })
+
+
+class AeatSiiReconciliationLine(models.Model):
+    _name = 'aeat.sii.reconciliation.line'
+    _description = 'AEAT SII reconciliation difference'
+    _order = 'reconciliation_id, period, id'
+
+    reconciliation_id = fields.Many2one(
+        comodel_name='aeat.sii.reconciliation', required=True,
+        ondelete='cascade', index=True,
+    )
+    result = fields.Selection(
+        selection=[
+            ('mismatch', 'Mismatched'),
+            ('missing', 'Missing in SII'),
+            ('extra', 'Only in SII'),
+        ], string="Result", required=True, index=True,
+    )
+    period = fields.Char(string="Period")
+    invoice_id = fields.Many2one(
+        comodel_name='account.invoice', string="Invoice",
+        ondelete='set null',
+    )
+    issuer = fields.Char(string="Issuer")
+    number = fields.Char(string="Number")
+    invoice_date = fields.Char(string="Invoice date")
+    local_amount = fields.Float(string="Local amount")
+    aeat_amount = fields.Float(string="SII amount")
+    aeat_state = fields.Char(string="SII state")
+    aeat_csv = fields.Char(string="SII CSV")
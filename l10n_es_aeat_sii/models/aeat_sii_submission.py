@@ -0,0 +1,284 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import base64
+import gzip
+import hashlib
+import json
+import uuid
+from datetime import timedelta
+
+from odoo import SUPERUSER_ID, _, api, exceptions, fields, models
+
+
+def _get_digest(content):
+    if not content:
+        return False
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+class AeatSiiSubmission(models.Model):
+    """Append-only log of the SII communications. A record is created for
+    each invoice included on each SII call, sharing the batch UID, so the
+    payloads don't have to be kept on the invoice table."""
+    _name = 'aeat.sii.submission'
+    _description = 'SII submission'
+    _order = 'date desc, id desc'
+    _rec_name = 'batch_uid'
+
+    batch_uid = fields.Char(
+        string="Batch", required=True, index=True, readonly=True,
+    )
+    invoice_id = fields.Many2one(
+        comodel_name='account.invoice', string="Invoice", required=True,
+        index=True, readonly=True, ondelete='cascade',
+    )
+    company_id = fields.Many2one(
+        comodel_name='res.company', string="Company", required=True,
+        index=True, readonly=True,
+    )
+    operation = fields.Char(string="Operation", readonly=True)
+    operation_type = fields.Selection(
+        selection=[('send', 'Send'), ('cancel', 'Cancellation')],
+        string="Type", required=True, readonly=True,
+    )
+    date = fields.Datetime(
+        string="Date", required=True, index=True, readonly=True,
+    )
+    agency_id = fields.Many2one(
+        comodel_name='aeat.sii.tax.agency', string="Tax agency",
+        index=True, readonly=True, ondelete='set null',
+    )
+    connect_duration = fields.Float(
+        string="Connection (s)", readonly=True, digits=(16, 3),
+        help="Seconds spent getting the SII service.",
+    )
+    build_duration = fields.Float(
+        string="Build (s)", readonly=True, digits=(16, 3),
+        help="Seconds spent building the dictionaries of the call.",
+    )
+    duration = fields.Float(
+        string="Duration (s)", readonly=True, digits=(16, 3),
+        help="Seconds spent on the SII call.",
+    )
+    write_duration = fields.Float(
+        string="Write (s)", readonly=True, digits=(16, 3),
+        help="Seconds spent writing the result on the invoice.",
+    )
+    batch_size = fields.Integer(string="Batch size", readonly=True)
+    state = fields.Selection(
+        selection=[
+            ('sent', 'Sent'),
+            ('sent_w_errors', 'Accepted with errors'),
+            ('cancelled', 'Cancelled'),
+            ('error', 'Error'),
+        ], string="State", required=True, index=True, readonly=True,
+    )
+    csv = fields.Char(string="CSV", readonly=True)
+    error = fields.Char(string="Error", readonly=True)
+    request_digest = fields.Char(
+        string="Request digest", size=64, readonly=True,
+    )
+    response_digest = fields.Char(
+        string="Response digest", size=64, readonly=True,
+    )
+    payload = fields.Binary(
+        string="Payload", attachment=False, readonly=True,
+        help="Gzip compressed JSON with the header, content and return.",
+    )
+
+    @api.model_cr
+    def init(self):
+        # Dashboard queries filter by company and state on the last hours
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS aeat_sii_submission_company_state_date
+            ON aeat_sii_submission (company_id, state, date DESC)
+        """)
+
+    @api.multi
+    def write(self, vals):
+        raise exceptions.UserError(
+            _("The SII submissions can't be modified."))
+
+    @api.multi
+    def unlink(self):
+        if self.env.uid != SUPERUSER_ID:
+            raise exceptions.UserError(
+                _("The SII submissions can't be deleted."))
+        return super(AeatSiiSubmission, self).unlink()
+
+    @api.model
+    def _new_submission(self, operation, cancel=False, batch_size=1):
+        """Data of a new SII call, shared by the submissions of all the
+        invoices included on it.
+
+        The caller adds to it the seconds spent on each stage of the
+        communication: 'connect_duration', 'build_duration' and 'duration'
+        (the SII call itself). The time spent writing the result is added
+        when the submission is logged.
+
+        :param operation: Name of the SII service operation.
+        :param cancel: It indicates if it's a cancellation.
+        :param batch_size: Number of invoices sent on the call.
+        :return: Dictionary with the data of the call.
+        """
+        return {
+            'batch_uid': uuid.uuid4().hex,
+            'operation': operation,
+            'operation_type': 'cancel' if cancel else 'send',
+            'date': fields.Datetime.now(),
+            'batch_size': batch_size,
+        }
+
+    @api.model
+    def _prepare_submission_vals(self, invoice, vals, submission,
+                                 request=None):
+        """Values of the submission of an invoice.
+
+        :param invoice: Invoice record.
+        :param vals: Values written on the invoice with the result.
+        :param submission: Dictionary with the data of the SII call, as
+          returned by ``_new_submission``.
+        :param request: Dictionary with the 'header' and 'content' texts
+          sent, when they are not included in ``vals`` (cancellations).
+        :return: Dictionary of values for creating the submission.
+        """
+        request = request or {}
+        header = vals.get('sii_header_sent') or request.get('header') or ''
+        content = (
+            vals.get('sii_content_sent') or request.get('content') or ''
+        )
+        response = vals.get('sii_return') and str(vals['sii_return']) or ''
+        if vals.get('sii_state') in ['sent', 'sent_w_errors', 'cancelled']:
+            state = vals['sii_state']
+        elif vals.get('sii_send_failed'):
+            state = 'error'
+        else:
+            state = 'sent'
+        payload = json.dumps({
+            'header': header,
+            'content': content,
+            'return': response,
+        }).encode('utf-8')
+        res = dict(submission)
+        res.update({
+            'invoice_id': invoice.id,
+            'company_id': invoice.company_id.id,
+            'agency_id': invoice.company_id.sii_tax_agency_id.id,
+            'state': state,
+            'csv': vals.get('sii_csv') or False,
+            'error': (vals.get('sii_send_error') or '')[:255] or False,
+            'request_digest': (
+                vals.get('sii_content_hash') or _get_digest(header + content)
+            ),
+            'response_digest': _get_digest(response),
+            'payload': base64.b64encode(gzip.compress(payload)),
+        })
+        return res
+
+    @api.multi
+    def get_payload(self):
+        """Decompressed payload of the submission.
+
+        :return: Dictionary with the 'header', 'content' and 'return' texts.
+        """
+        self.ensure_one()
+        if not self.payload:
+            return {}
+        return json.loads(gzip.decompress(
+            base64.b64decode(self.payload)).decode('utf-8'))
+
+    @api.model
+    def get_sii_stats(self, hours=24):
+        """Latency, throughput and error statistics of the SII
+        communications of the last hours, per company and tax agency.
+
+        The connection, build and call latencies are computed per SII call,
+        while the write latency and the error rate are computed per invoice.
+        The queue lag is the delay between the expected start (ETA) of the
+        SII jobs and their actual start.
+
+        :param hours: Number of hours to look back.
+        :return: Dictionary with the list of 'submissions' and 'queue'
+          statistics.
+        """
+        since = fields.Datetime.now() - timedelta(hours=hours)
+        company_ids = tuple(
+            self.env['res.company'].search([]).ids or [0]
+        )
+        self.env.cr.execute("""
+            WITH calls AS (
+                SELECT DISTINCT ON (batch_uid)
+                    company_id, agency_id, batch_size, connect_duration,
+                    build_duration, duration
+                FROM aeat_sii_submission
+                WHERE date >= %(since)s AND company_id IN %(company_ids)s
+                ORDER BY batch_uid
+            ), calls_stats AS (
+                SELECT company_id, agency_id,
+                    COUNT(*) AS calls,
+                    AVG(batch_size)::float AS batch_size_avg,
+                    MAX(batch_size) AS batch_size_max,
+                    PERCENTILE_CONT(0.5) WITHIN GROUP (
+                        ORDER BY connect_duration) AS connect_p50,
+                    PERCENTILE_CONT(0.95) WITHIN GROUP (
+                        ORDER BY connect_duration) AS connect_p95,
+                    PERCENTILE_CONT(0.5) WITHIN GROUP (
+                        ORDER BY build_duration) AS build_p50,
+                    PERCENTILE_CONT(0.95) WITHIN GROUP (
+                        ORDER BY build_duration) AS build_p95,
+                    PERCENTILE_CONT(0.5) WITHIN GROUP (
+                        ORDER BY duration) AS call_p50,
+                    PERCENTILE_CONT(0.95) WITHIN GROUP (
+                        ORDER BY duration) AS call_p95
+                FROM calls
+                GROUP BY company_id, agency_id
+            ), invoice_stats AS (
+                SELECT company_id, agency_id,
+                    COUNT(*) AS invoices,
+                    COUNT(*) FILTER (WHERE state = 'error') AS errors,
+                    PERCENTILE_CONT(0.5) WITHIN GROUP (
+                        ORDER BY write_duration) AS write_p50,
+                    PERCENTILE_CONT(0.95) WITHIN GROUP (
+                        ORDER BY write_duration) AS write_p95
+                FROM aeat_sii_submission
+                WHERE date >= %(since)s AND company_id IN %(company_ids)s
+                GROUP BY company_id, agency_id
+            )
+            SELECT cs.*, ist.invoices, ist.errors,
+                ist.errors::float / NULLIF(ist.invoices, 0) AS error_rate,
+                ist.write_p50, ist.write_p95
+            FROM calls_stats cs
+            JOIN invoice_stats ist
+                ON ist.company_id = cs.company_id
+                AND ist.agency_id IS NOT DISTINCT FROM cs.agency_id
+            ORDER BY cs.company_id, cs.agency_id""", {
+            'since': since,
+            'company_ids': company_ids,
+        })
+        submissions = self.env.cr.dictfetchall()
+        self.env.cr.execute("""
+            SELECT company_id, method_name,
+                COUNT(*) AS jobs,
+                PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY lag) AS lag_p50,
+                PERCENTILE_CONT(0.95) WITHIN GROUP (ORDER BY lag) AS lag_p95,
+                MAX(lag) AS lag_max
+            FROM (
+                SELECT company_id, method_name,
+                    EXTRACT(EPOCH FROM date_started - GREATEST(
+                        COALESCE(eta, date_created), date_created))::float
+                        AS lag
+                FROM queue_job
+                WHERE channel = 'root.invoice_validate_sii'
+                    AND date_started >= %(since)s
+                    AND company_id IN %(company_ids)s
+            ) jobs
+            GROUP BY company_id, method_name
+            ORDER BY company_id, method_name""", {
+            'since': since,
+            'company_ids': company_ids,
+        })
+        return {
+            'since': fields.Datetime.to_string(since),
+            'submissions': submissions,
+            'queue': self.env.cr.dictfetchall(),
+        }
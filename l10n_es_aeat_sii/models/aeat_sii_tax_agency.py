@@ -2,7 +2,18 @@
 # Copyright 2018 Javi Melendez <javimelex@gmail.com>
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
-from odoo import api, models, fields
+import logging
+
+from odoo import _, api, exceptions, models, fields
+
+from ..sii_client import SII_DEFAULT_CONCURRENCY, SiiTransport
+
+_logger = logging.getLogger(__name__)
+
+try:
+    from zeep import Client
+except (ImportError, IOError) as err:
+    _logger.debug(err)
 
 
 class AeatSiiTaxAgency(models.Model):
@@ -38,6 +49,11 @@ class AeatSiiTaxAgency(models.Model):
         string='SuministroPagosRecibidas WSDL', required=True)
     wsdl_ps_test_address = fields.Char(
         string='SuministroPagosRecibidas Test Address')
+    max_concurrency = fields.Integer(
+        string='Maximum concurrent calls', default=SII_DEFAULT_CONCURRENCY,
+        help="Maximum number of SII calls sent at the same time to this tax "
+             "agency by each server process when dispatching the batches "
+             "of several companies in parallel.")
 
     @api.multi
     def _connect_params_sii(self, mapping_key, company):
@@ -52,3 +68,24 @@ class AeatSiiTaxAgency(models.Model):
                 else False
             ),
         }
+
+    @api.multi
+    def action_download_wsdl(self):
+        """Download the WSDL files of the agencies, with all the schemas they
+        import, to the local directory used for resolving them offline."""
+        path = self.env['ir.config_parameter'].sudo().get_param(
+            'l10n_es_aeat_sii.wsdl_local_path', False)
+        if not path:
+            raise exceptions.UserError(_(
+                "You have to set the system parameter "
+                "'l10n_es_aeat_sii.wsdl_local_path' with the directory where "
+                "the WSDL files will be stored."))
+        transport = SiiTransport(wsdl_path=path, store=True)
+        wsdl_fields = [
+            name for name in self._fields
+            if name.startswith('wsdl_') and not name.endswith('_address')
+        ]
+        for agency in self:
+            for wsdl_field in wsdl_fields:
+                if agency[wsdl_field]:
+                    Client(wsdl=agency[wsdl_field], transport=transport)
@@ -5,9 +5,11 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
 from datetime import datetime, timedelta
-from odoo import fields, models
+from odoo import api, fields, models
 import pytz
 
+from ..sii_client import SII_BATCH_LIMIT
+
 
 class ResCompany(models.Model):
     _inherit = 'res.company'
@@ -60,8 +62,46 @@ class ResCompany(models.Model):
     )
     sent_time = fields.Float(string="Sent time")
     delay_time = fields.Float(string="Delay time")
+    sii_send_in_batch = fields.Boolean(
+        string="Send in batches",
+        help="Check it to group the invoices to send in a few jobs, each one "
+             "sending up to 'Batch size' invoices in a single call, instead "
+             "of queuing a job per invoice. Due invoices are collected "
+             "periodically by a scheduled action.")
+    sii_batch_size = fields.Integer(
+        string="Batch size", default=1000,
+        help="Maximum number of invoices sent on each SII call. The AEAT "
+             "limit is 10000.")
+    sii_parallel_dispatch = fields.Boolean(
+        string="Parallel dispatch",
+        help="Check it to send the due batches directly from the scheduled "
+             "action, in parallel with the batches of other companies, "
+             "instead of queuing a job for each batch.")
     sii_tax_agency_id = fields.Many2one(
         'aeat.sii.tax.agency', string='Tax Agency')
+    sii_payload_storage = fields.Selection(
+        string="SII payloads storage",
+        selection=[
+            ('field', 'Invoice fields'),
+            ('attachment', 'Compressed attachment'),
+            ('submission', 'Submission log only'),
+        ], default='field',
+        help="Where to store the header, content and return of the last SII "
+             "communication of each invoice:\n"
+             "- Invoice fields: as JSON text on the invoice.\n"
+             "- Compressed attachment: as a gzip compressed JSON file "
+             "attached to the invoice, keeping the invoice table small.\n"
+             "- Submission log only: not stored on the invoice, as every "
+             "communication is already kept compressed on the SII "
+             "submissions log.")
+
+    @api.multi
+    def write(self, vals):
+        if 'sii_enabled' in vals:
+            # The SII tax indexes aren't invalidated for the taxes of the
+            # companies without SII
+            self.env['aeat.sii.map']._clear_sii_tax_caches()
+        return super(ResCompany, self).write(vals)
 
     def _get_sii_eta(self):
         if self.send_mode == 'fixed':
@@ -81,3 +121,10 @@ class ResCompany(models.Model):
             return datetime.now() + timedelta(seconds=self.delay_time * 3600)
         else:
             return None
+
+    def _get_sii_batch_size(self):
+        """Number of invoices to send on each SII call, within the limits
+        accepted by the AEAT."""
+        return max(1, min(
+            self.sii_batch_size or SII_BATCH_LIMIT, SII_BATCH_LIMIT,
+        ))
@@ -0,0 +1,313 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import logging
+import os
+import random
+import ssl
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+from requests import certs
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout
+
+_logger = logging.getLogger(__name__)
+
+try:
+    from zeep.exceptions import TransportError
+    from zeep.transports import Transport
+except (ImportError, IOError) as err:
+    _logger.debug(err)
+    Transport = object
+    TransportError = None
+
+# Maximum number of records allowed by AEAT on each SuministroLR* call
+SII_BATCH_LIMIT = 10000
+# HTTP status codes returned by the SII servers when they are overloaded
+SII_THROTTLING_STATUS = (429, 502, 503, 504)
+# Concurrent SII calls per tax agency when it has no specific limit
+SII_DEFAULT_CONCURRENCY = 4
+# Seconds to wait before the first automatic retry of a failed send, doubled
+# on each attempt up to the maximum
+SII_RETRY_BASE_DELAY = 300.0
+SII_RETRY_MAX_DELAY = 86400.0
+# Automatic retries of a failed send before leaving it to the user
+SII_RETRY_MAX_ATTEMPTS = 8
+
+SiiServiceKey = namedtuple('SiiServiceKey', [
+    'dbname', 'company_id', 'wsdl', 'port_name', 'address', 'test',
+    'certificate',
+])
+
+
+class SiiServiceCache(object):
+    """Process-level LRU cache of the bound SII services.
+
+    Building a zeep client implies downloading and parsing the whole WSDL and
+    XSD tree, and each new ``requests`` session makes a new TLS handshake, so
+    the services are kept alive between calls. The session of each transport
+    is preserved too, so HTTP keep-alive connections are reused.
+    """
+
+    def __init__(self, size=64):
+        self.size = size
+        self._lock = threading.RLock()
+        self._services = OrderedDict()
+
+    def get(self, key, factory):
+        """Return the service for the given key, building it through
+        ``factory`` if it's not cached yet.
+
+        :param key: ``SiiServiceKey`` instance.
+        :param factory: Callable without arguments returning the service.
+        """
+        with self._lock:
+            service = self._services.get(key)
+            if service is not None:
+                self._services.move_to_end(key)
+                return service
+        # The build is done outside the lock, as it may take some seconds
+        service = factory()
+        with self._lock:
+            self._services[key] = service
+            while len(self._services) > self.size:
+                self._services.popitem(last=False)
+        return service
+
+    def invalidate(self, dbname=None, company_id=None):
+        """Remove the cached services. Without arguments, all the services
+        are removed.
+
+        :param dbname: Only remove the services of this database.
+        :param company_id: Only remove the services of this company.
+        """
+        with self._lock:
+            for key in list(self._services):
+                if dbname and key.dbname != dbname:
+                    continue
+                if company_id and key.company_id != company_id:
+                    continue
+                del self._services[key]
+
+    def __len__(self):
+        return len(self._services)
+
+
+SiiCertificateKey = namedtuple('SiiCertificateKey', [
+    'dbname', 'certificate_id', 'write_date', 'public_crt', 'private_key',
+])
+
+
+class SiiSslContextCache(object):
+    """Process-level cache of the SSL contexts with the loaded certificates.
+
+    Loading the certificate chain reads and parses the PEM files, so it's
+    done once per certificate version, and the same context is shared by all
+    the sessions that use it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._contexts = {}
+
+    def get(self, key):
+        """Return the SSL context for the given certificate, loading it if
+        it's not cached yet.
+
+        :param key: ``SiiCertificateKey`` instance.
+        """
+        with self._lock:
+            context = self._contexts.get(key)
+            if context is None:
+                context = ssl.create_default_context(cafile=certs.where())
+                context.load_cert_chain(key.public_crt, key.private_key)
+                self._contexts[key] = context
+            return context
+
+    def invalidate(self, dbname=None):
+        """Remove the cached contexts. Without arguments, all the contexts
+        are removed.
+
+        :param dbname: Only remove the contexts of this database.
+        """
+        with self._lock:
+            for key in list(self._contexts):
+                if not dbname or key.dbname == dbname:
+                    del self._contexts[key]
+
+    def __len__(self):
+        return len(self._contexts)
+
+
+class SiiSslAdapter(HTTPAdapter):
+    """HTTP adapter that opens the connections with an already loaded SSL
+    context, instead of loading the client certificate on each one."""
+
+    def __init__(self, ssl_context, **kwargs):
+        self.ssl_context = ssl_context
+        super(SiiSslAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['ssl_context'] = self.ssl_context
+        return super(SiiSslAdapter, self).init_poolmanager(*args, **kwargs)
+
+    def proxy_manager_for(self, *args, **kwargs):
+        kwargs['ssl_context'] = self.ssl_context
+        return super(SiiSslAdapter, self).proxy_manager_for(*args, **kwargs)
+
+
+class SiiTransport(Transport):
+    """Zeep transport that resolves the WSDL and XSD files from a local
+    directory before going to the network.
+
+    The files are looked up mirroring the URL, this is
+    ``<wsdl_path>/<host>/<path>``, as the different tax agencies publish
+    files with the same name. With ``store=True`` the downloaded files are
+    saved on that directory, which allows to prepare the bundle once and
+    copy it to servers without internet access.
+    """
+
+    def __init__(self, wsdl_path=None, store=False, **kwargs):
+        self.wsdl_path = wsdl_path and os.path.abspath(wsdl_path)
+        self.store = store
+        super(SiiTransport, self).__init__(**kwargs)
+
+    def _get_local_path(self, url):
+        parsed = urlparse(url)
+        if not self.wsdl_path or parsed.scheme not in ('http', 'https'):
+            return False
+        path = os.path.normpath(os.path.join(
+            self.wsdl_path, parsed.netloc, parsed.path.lstrip('/'),
+        ))
+        if not path.startswith(self.wsdl_path + os.sep):
+            return False
+        return path
+
+    def load(self, url):
+        path = self._get_local_path(url)
+        if path and not self.store and os.path.isfile(path):
+            with open(path, 'rb') as local_file:
+                return local_file.read()
+        if path and not self.store:
+            _logger.info("SII file %s not found locally. Downloading it.", url)
+        content = super(SiiTransport, self).load(url)
+        if path and self.store:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as local_file:
+                local_file.write(content)
+        return content
+
+
+@contextmanager
+def sii_stage_timer(timings, stage):
+    """Context manager that adds to ``timings[stage]`` the seconds spent
+    inside it, even if an exception is raised."""
+    start = time.time()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.time() - start
+
+
+def is_sii_throttling_error(error):
+    """Tell if an exception raised by an SII call is a temporary rejection
+    of the server, so the call can be retried later."""
+    if isinstance(error, (ConnectionError, Timeout)):
+        return True
+    return bool(
+        TransportError and isinstance(error, TransportError) and
+        error.status_code in SII_THROTTLING_STATUS
+    )
+
+
+def get_sii_backoff_delay(attempt, base=2.0, maximum=120.0):
+    """Seconds to wait before retrying a throttled SII call: exponential
+    on the attempt number, with jitter so that the parallel senders don't
+    retry all at the same time."""
+    delay = min(maximum, base * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class SiiWaitRequired(Exception):
+    """Raised when the company has to wait the time requested by the AEAT
+    before its next send, so the caller can reschedule the communication
+    instead of blocking until then."""
+
+    def __init__(self, seconds):
+        super(SiiWaitRequired, self).__init__(seconds)
+        self.seconds = seconds
+
+
+class SiiRateLimiter(object):
+    """Process-level limiter of the SII calls.
+
+    It caps the number of concurrent calls to each tax agency and keeps the
+    waiting time that the AEAT requests on each response
+    ('TiempoEsperaEnvio') before the next send of the same company.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._semaphores = {}
+        self._not_before = {}
+        self._throttled = {}
+
+    def _get_semaphore(self, agency_key, capacity):
+        with self._lock:
+            semaphore, current = self._semaphores.get(agency_key, (None, 0))
+            if current != capacity:
+                # Calls in progress keep the previous semaphore
+                semaphore = threading.BoundedSemaphore(capacity)
+                self._semaphores[agency_key] = (semaphore, capacity)
+            return semaphore
+
+    @contextmanager
+    def slot(self, agency_key, capacity, company_key):
+        """Context manager that waits for a free slot on the tax agency.
+        If the company isn't allowed to send yet, ``SiiWaitRequired`` is
+        raised with the remaining seconds.
+
+        :param agency_key: Hashable identifier of the tax agency.
+        :param capacity: Maximum concurrent calls to the tax agency.
+        :param company_key: Hashable identifier of the sending company, or
+          None for the calls that aren't sends (as the consultations).
+        """
+        wait = self._not_before.get(company_key, 0) - time.time()
+        if company_key is not None and wait > 0:
+            raise SiiWaitRequired(wait)
+        with self._get_semaphore(agency_key, max(1, capacity)):
+            yield
+
+    def wait_before(self, company_key, seconds):
+        """Delay the next call of the company the given seconds."""
+        with self._lock:
+            self._not_before[company_key] = max(
+                self._not_before.get(company_key, 0), time.time() + seconds,
+            )
+
+    def throttled(self, company_key):
+        """Register a call of the company rejected because the server is
+        overloaded, delaying its next call with an exponential backoff on
+        the consecutive rejections.
+
+        :return: Seconds of delay.
+        """
+        with self._lock:
+            attempt = self._throttled.get(company_key, 0)
+            self._throttled[company_key] = attempt + 1
+        delay = get_sii_backoff_delay(attempt)
+        self.wait_before(company_key, delay)
+        return delay
+
+    def accepted(self, company_key):
+        """Register a call of the company accepted by the server."""
+        with self._lock:
+            self._throttled.pop(company_key, None)
+
+
+sii_service_cache = SiiServiceCache()
+sii_ssl_context_cache = SiiSslContextCache()
+sii_rate_limiter = SiiRateLimiter()
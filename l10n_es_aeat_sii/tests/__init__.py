@@ -1 +1,2 @@
 from . import test_l10n_es_aeat_sii
+from . import test_sii_benchmark
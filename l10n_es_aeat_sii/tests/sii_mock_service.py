@@ -0,0 +1,113 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+import time
+
+try:
+    from zeep.exceptions import Fault
+except (ImportError, IOError):
+    Fault = Exception
+
+
+class SiiServiceMock(object):
+    """Local stand-in of the bound ``siiService`` port, with the same
+    operations and response structure as the zeep service proxy, so the real
+    SII communication code can be exercised without the AEAT servers.
+
+    :param errors: Dictionary {invoice number: (error code, description)}
+      of the records to reject.
+    :param error_rate: Fraction (0 to 1) of the records of each call that are
+      rejected, besides the ones in ``errors``.
+    :param latency: Seconds that each call takes.
+    :param fault_calls: Numbers (starting on 1) of the calls that raise a
+      SOAP fault instead of answering.
+    :param registered: Records returned by the consultation operations.
+    :param page_size: Records returned on each consultation page.
+    :param wait: Seconds returned as 'TiempoEsperaEnvio' on the sends.
+    """
+
+    def __init__(self, errors=None, error_rate=0.0, latency=0.0,
+                 fault_calls=None, registered=None, page_size=10000,
+                 wait=None):
+        self.calls = []
+        self.errors = errors or {}
+        self.error_rate = error_rate
+        self.latency = latency
+        self.fault_calls = set(fault_calls or [])
+        self.registered = registered or []
+        self.page_size = page_size
+        self.wait = wait
+
+    def _call(self, request):
+        self.calls.append(request)
+        if self.latency:
+            time.sleep(self.latency)
+        if len(self.calls) in self.fault_calls:
+            raise Fault("Codigo[4102].El XML no cumple el esquema.")
+
+    def _get_error(self, number, index):
+        error = self.errors.get(number)
+        if not error and self.error_rate:
+            period = max(1, int(round(1 / self.error_rate)))
+            if index % period == period - 1:
+                error = ('1100', 'Valor o tipo incorrecto del campo')
+        return error
+
+    def _answer(self, header, records):
+        # The single invoice communications send the record alone
+        if isinstance(records, dict):
+            records = [records]
+        self._call(records)
+        lines = []
+        for index, record in enumerate(records):
+            number = record['IDFactura']['NumSerieFacturaEmisor']
+            error = self._get_error(number, index)
+            lines.append({
+                'IDFactura': record['IDFactura'],
+                'EstadoRegistro': 'Incorrecto' if error else 'Correcto',
+                'CodigoErrorRegistro': error and error[0],
+                'DescripcionErrorRegistro': error and error[1],
+            })
+        wrong = len([x for x in lines if x['EstadoRegistro'] != 'Correcto'])
+        if not wrong:
+            state = 'Correcto'
+        elif wrong < len(lines):
+            state = 'ParcialmenteCorrecto'
+        else:
+            state = 'Incorrecto'
+        return {
+            'CSV': 'TESTCSV',
+            'EstadoEnvio': state,
+            'RespuestaLinea': lines,
+            'TiempoEsperaEnvio': self.wait,
+        }
+
+    SuministroLRFacturasEmitidas = _answer
+    SuministroLRFacturasRecibidas = _answer
+    AnulacionLRFacturasEmitidas = _answer
+    AnulacionLRFacturasRecibidas = _answer
+    SuministroLRCobrosEmitidas = _answer
+    SuministroLRPagosRecibidas = _answer
+
+    def _query(self, header, query):
+        self._call(query)
+        start = 0
+        if query.get('ClavePaginacion'):
+            numbers = [
+                x['IDFactura']['NumSerieFacturaEmisor']
+                for x in self.registered
+            ]
+            start = numbers.index(
+                query['ClavePaginacion']['NumSerieFacturaEmisor']) + 1
+        records = self.registered[start:start + self.page_size]
+        return {
+            'ResultadoConsulta': 'ConDatos' if records else 'SinDatos',
+            'IndicadorPaginacion': (
+                'S' if start + self.page_size < len(self.registered)
+                else 'N'
+            ),
+            'RegistroRespuestaConsultaLRFacturasEmitidas': records,
+            'RegistroRespuestaConsultaLRFacturasRecibidas': records,
+        }
+
+    ConsultaLRFacturasEmitidas = _query
+    ConsultaLRFacturasRecibidas = _query
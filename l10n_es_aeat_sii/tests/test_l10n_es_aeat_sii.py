@@ -4,10 +4,15 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
 
 import base64
+from unittest import mock
 
 from odoo import exceptions, fields
 from odoo.tests import common
 from odoo.modules.module import get_resource_path
+from requests.exceptions import ConnectionError
+
+from ..sii_client import SiiSslAdapter, sii_rate_limiter
+from .sii_mock_service import SiiServiceMock
 
 try:
     from zeep.client import ServiceProxy
@@ -266,6 +271,25 @@ class TestL10nEsAeatSii(TestL10nEsAeatSiiBase):
         self.assertEqual(
             invoice_temp.sii_description, 'Test customer header | Test line',
         )
+        # Line changes are taken when the invoice is validated
+        invoice_temp.invoice_line_ids.name = 'Other line'
+        self.assertEqual(
+            invoice_temp.sii_description, 'Test customer header | Test line',
+        )
+        invoice_temp.write({
+            'invoice_line_ids': [(0, 0, {
+                'product_id': self.product.id,
+                'account_id': self.account_expense.id,
+                'name': 'Long line %03d' % i,
+                'price_unit': 1,
+                'quantity': 1,
+            }) for i in range(60)],
+        })
+        invoice_temp.action_invoice_open()
+        self.assertEqual(len(invoice_temp.sii_description), 500)
+        self.assertTrue(invoice_temp.sii_description.startswith(
+            'Test customer header | Other line - Long line 000 - ',
+        ))
 
     def test_permissions(self):
         """This should work without errors"""
@@ -293,8 +317,23 @@ class TestL10nEsAeatSii(TestL10nEsAeatSiiBase):
         )
         self._activate_certificate(CERTIFICATE_PASSWD)
         self.assertEqual(self.sii_cert.state, 'active')
+        certificate = self.sii_cert._get_sii_certificate(
+            self.sii_cert.company_id.id,
+            fields.Date.to_string(fields.Date.today()),
+        )
+        self.assertEqual(certificate[0], self.sii_cert.id)
+        self.assertEqual(certificate[2], self.sii_cert.public_key)
         proxy = self.invoice._connect_sii(self.invoice.type)
+        session = proxy._client.transport.session
+        adapter = session.get_adapter(proxy._binding_options['address'])
+        self.assertIsInstance(adapter, SiiSslAdapter)
         self.assertIsInstance(proxy, ServiceProxy)
+        # The service is reused while the certificate doesn't change
+        self.assertIs(self.invoice._connect_sii(self.invoice.type), proxy)
+        self.sii_cert.action_activate()
+        self.assertIsNot(
+            self.invoice._connect_sii(self.invoice.type), proxy,
+        )
 
     def _test_binding_address(self, invoice):
         company = invoice.company_id
@@ -329,3 +368,490 @@ class TestL10nEsAeatSii(TestL10nEsAeatSiiBase):
         for inv_type in ['out_invoice', 'in_invoice']:
             self.invoice.type = inv_type
             self._test_tax_agencies(self.invoice)
+
+    def test_send_invoices_batch(self):
+        invoices = self.invoice
+        for number in ('INV002', 'INV003'):
+            invoice = self.invoice.copy()
+            invoice.action_invoice_open()
+            invoice.number = number
+            invoices |= invoice
+        service = SiiServiceMock(errors={'INV003': (1100, 'Wrong value')})
+        with mock.patch.object(
+            type(self.env['account.invoice']), '_connect_sii',
+            return_value=service,
+        ):
+            invoices._send_invoices_to_sii_batch()
+        self.assertEqual(len(service.calls), 1)
+        self.assertEqual(len(service.calls[0]), 3)
+        sent = invoices.filtered(lambda x: x.number != 'INV003')
+        self.assertEqual(set(sent.mapped('sii_state')), {'sent'})
+        self.assertEqual(set(sent.mapped('sii_csv')), {'TESTCSV'})
+        self.assertFalse(any(sent.mapped('sii_send_failed')))
+        failed = invoices - sent
+        self.assertEqual(failed.sii_state, 'not_sent')
+        self.assertTrue(failed.sii_send_failed)
+        self.assertEqual(failed.sii_send_error, '1100 | Wrong value')
+
+    def test_sii_taxes_map_cache(self):
+        # The test tax is mapped by its description P_IVA10_BC
+        self.assertIn(self.tax, self.invoice._get_sii_taxes_map(['SFRS']))
+        self.assertNotIn(self.tax, self.invoice._get_sii_taxes_map(['SFESB']))
+        # Changing the tax invalidates the cached index
+        self.tax.description = 'Test tax 10%'
+        self.assertNotIn(self.tax, self.invoice._get_sii_taxes_map(['SFRS']))
+        # The index is built through the mapping hook of the invoices
+        map_obj = self.env['aeat.sii.map']
+        map_obj._clear_sii_tax_caches()
+        with mock.patch.object(
+            type(self.invoice), 'map_sii_tax_template', autospec=True,
+            return_value=self.tax,
+        ) as hook:
+            self.assertIn(self.tax, self.invoice._get_sii_taxes_map(['SFRS']))
+        self.assertTrue(hook.called)
+        map_obj._clear_sii_tax_caches()
+        # Only the changes that affect the SII mapping invalidate it
+        template = self.env['aeat.sii.map.lines'].search([
+            ('taxes', '!=', False),
+        ], limit=1).taxes[:1]
+        company = self.env['res.company'].create({'name': 'No SII company'})
+        with mock.patch.object(
+            type(map_obj), '_clear_sii_tax_caches',
+        ) as clear:
+            template.description = template.description
+            self.assertEqual(clear.call_count, 1)
+            self.tax.amount = 12
+            self.env['account.tax'].create({
+                'name': 'Test tax without SII',
+                'amount': 10,
+                'company_id': company.id,
+            })
+            self.assertEqual(clear.call_count, 1)
+
+    def test_sii_payload_attachment(self):
+        self.invoice.company_id.sii_payload_storage = 'attachment'
+        with mock.patch.object(
+            type(self.env['account.invoice']), '_connect_sii',
+            return_value=SiiServiceMock(),
+        ):
+            self.invoice._send_invoice_to_sii()
+        self.assertEqual(self.invoice.sii_state, 'sent')
+        self.assertFalse(self.invoice.sii_content_sent)
+        self.assertFalse(self.invoice.sii_return)
+        self.assertTrue(self.invoice.sii_payload_attachment_id)
+        self.assertTrue(self.invoice.sii_content_hash)
+        # Same content as the one sent
+        self.assertTrue(self.invoice._sii_invoice_dict_modified())
+        self.invoice.sii_manual_description = 'Other description'
+        self.assertFalse(self.invoice._sii_invoice_dict_modified())
+
+    def test_sii_submission_log(self):
+        self.invoice.company_id.sii_payload_storage = 'submission'
+        invoice = self.invoice.copy()
+        invoice.action_invoice_open()
+        invoices = self.invoice | invoice
+        with mock.patch.object(
+            type(self.env['account.invoice']), '_connect_sii',
+            return_value=SiiServiceMock(errors={
+                invoice.number: ('1100', 'Error'),
+            }),
+        ):
+            invoices._send_invoices_to_sii_batch()
+        self.assertFalse(self.invoice.sii_content_sent)
+        self.assertFalse(self.invoice.sii_return)
+        submissions = invoices.mapped('sii_submission_ids')
+        self.assertEqual(len(submissions), 2)
+        self.assertEqual(len(set(submissions.mapped('batch_uid'))), 1)
+        self.assertEqual(set(submissions.mapped('batch_size')), {2})
+        self.assertEqual(self.invoice.sii_submission_ids.state, 'sent')
+        self.assertEqual(invoice.sii_submission_ids.state, 'error')
+        submission = self.invoice.sii_submission_ids
+        self.assertEqual(
+            submission.request_digest, self.invoice.sii_content_hash,
+        )
+        self.assertTrue(submission.build_duration)
+        self.assertTrue(submission.write_duration)
+        payload = submission.get_payload()
+        self.assertIn('INV001', payload['content'])
+        self.assertIn('TESTCSV', payload['return'])
+        with self.assertRaises(exceptions.UserError):
+            submission.write({'state': 'error'})
+        with self.assertRaises(exceptions.UserError):
+            submission.sudo(self.user).unlink()
+        stats = self.env['aeat.sii.submission'].get_sii_stats()
+        company_stats = [
+            x for x in stats['submissions']
+            if x['company_id'] == self.invoice.company_id.id
+        ]
+        self.assertEqual(len(company_stats), 1)
+        self.assertEqual(company_stats[0]['calls'], 1)
+        self.assertEqual(company_stats[0]['invoices'], 2)
+        self.assertEqual(company_stats[0]['errors'], 1)
+        self.assertAlmostEqual(company_stats[0]['error_rate'], 0.5)
+        self.assertTrue(company_stats[0]['call_p95'] is not None)
+
+    def test_send_batch_scheduler(self):
+        company = self.invoice.company_id
+        company.write({
+            'sii_send_in_batch': True,
+            'sii_batch_size': 2,
+        })
+        invoices = self.env['account.invoice']
+        for _i in range(3):
+            invoice = self.invoice.copy()
+            invoice.action_invoice_open()
+            invoices |= invoice
+        self.assertTrue(all(invoices.mapped('sii_send_date')))
+        self.assertFalse(invoices.mapped('invoice_jobs_ids'))
+        invoices.write({'sii_send_date': fields.Datetime.now()})
+        self.env['account.invoice']._cron_sii_send_batches()
+        self.assertFalse(any(invoices.mapped('sii_send_date')))
+        self.assertEqual(len(invoices.mapped('invoice_jobs_ids')), 2)
+
+    def test_send_batch_job_invoice_cancelled(self):
+        company = self.invoice.company_id
+        company.write({
+            'sii_send_in_batch': True,
+            'sii_batch_size': 2,
+        })
+        invoices = self.env['account.invoice']
+        for _i in range(2):
+            invoice = self.invoice.copy()
+            invoice.action_invoice_open()
+            invoices |= invoice
+        invoices.write({'sii_send_date': fields.Datetime.now()})
+        self.env['account.invoice']._cron_sii_send_batches()
+        job = invoices.mapped('invoice_jobs_ids')
+        self.assertEqual(len(job), 1)
+        cancelled, pending = invoices
+        cancelled.journal_id.update_posted = True
+        cancelled.action_cancel()
+        # The batch job is kept for the rest of the invoices
+        self.assertTrue(job.exists())
+        self.assertFalse(cancelled.invoice_jobs_ids)
+        self.assertEqual(pending.invoice_jobs_ids, job)
+        service = SiiServiceMock()
+        with mock.patch.object(
+            type(self.env['account.invoice']), '_connect_sii',
+            return_value=service,
+        ):
+            invoices.with_context(
+                job_uuid=job.uuid,
+            ).confirm_invoice_batch()
+        self.assertEqual(len(service.calls), 1)
+        self.assertEqual(len(service.calls[0]), 1)
+        self.assertEqual(pending.sii_state, 'sent')
+        self.assertEqual(cancelled.sii_state, 'not_sent')
+
+    def test_send_invoices_batch_duplicated(self):
+        invoice = self.invoice.copy()
+        invoice.action_invoice_open()
+        invoices = self.invoice | invoice
+        service = SiiServiceMock()
+        with mock.patch.object(
+            type(self.env['account.invoice']), '_connect_sii',
+            return_value=service,
+        ), mock.patch(
+            'odoo.addons.l10n_es_aeat_sii.models.account_invoice.'
+            '_get_sii_id_factura_key', return_value=('A', '1', '01-01-2018'),
+        ):
+            invoices._send_invoices_to_sii_batch()
+        # Only the first invoice of the same key is sent
+        self.assertEqual(len(service.calls[0]), 1)
+        self.assertEqual(self.invoice.sii_state, 'sent')
+        self.assertEqual(invoice.sii_state, 'not_sent')
+        self.assertTrue(invoice.sii_send_failed)
+        self.assertIn(self.invoice.number, invoice.sii_return)
+
+    def test_send_invoices_batch_fault(self):
+        invoice = self.invoice.copy()
+        invoice.action_invoice_open()
+        invoices = self.invoice | invoice
+        service = SiiServiceMock(fault_calls=[1])
+        with mock.patch.object(
+            type(self.env['account.invoice']), '_connect_sii',
+            return_value=service,
+        ):
+            invoices._send_invoices_to_sii_batch()
+            self.assertTrue(all(invoices.mapped('sii_send_failed')))
+            self.assertEqual(set(invoices.mapped('sii_state')), {'not_sent'})
+            invoices._send_invoices_to_sii_batch()
+        self.assertEqual(len(service.calls), 2)
+        self.assertEqual(set(invoices.mapped('sii_state')), {'sent'})
+
+    def test_send_invoice_single(self):
+        # Same path than the "one by one" leg of the send benchmark
+        service = SiiServiceMock(errors={
+            self.invoice.number: ('1100', 'Wrong value'),
+        })
+        with mock.patch.object(
+            type(self.env['account.invoice']), '_connect_sii',
+            return_value=service,
+        ):
+            self.invoice._send_invoice_to_sii()
+        self.assertEqual(len(service.calls), 1)
+        self.assertEqual(len(service.calls[0]), 1)
+        self.assertEqual(self.invoice.sii_state, 'not_sent')
+        self.assertTrue(self.invoice.sii_send_failed)
+        self.assertEqual(self.invoice.sii_send_error, '1100 | Wrong value')
+
+    def test_send_failed_retry_queue(self):
+        service = SiiServiceMock(fault_calls=[1])
+        with mock.patch.object(
+            type(self.env['account.invoice']), '_connect_sii',
+            return_value=service,
+        ):
+            self.invoice._send_invoices_to_sii_batch()
+            self.assertTrue(self.invoice.sii_send_failed)
+            self.assertEqual(self.invoice.sii_send_attempts, 1)
+            self.assertTrue(self.invoice.sii_next_retry_date)
+            # Not due yet
+            self.env['account.invoice']._cron_sii_retry_failed()
+            self.assertEqual(len(service.calls), 1)
+            self.invoice.sii_next_retry_date = '2000-01-01 00:00:00'
+            self.env['account.invoice']._cron_sii_retry_failed()
+        self.assertEqual(len(service.calls), 2)
+        self.assertEqual(self.invoice.sii_state, 'sent')
+        self.assertEqual(self.invoice.sii_send_attempts, 0)
+        self.assertFalse(self.invoice.sii_next_retry_date)
+
+    def test_send_failed_retry_connection(self):
+        with mock.patch.object(
+            type(self.env['account.invoice']), '_connect_sii',
+            side_effect=Exception('WSDL not available'),
+        ):
+            self.invoice._send_invoices_to_sii_batch()
+        self.assertTrue(self.invoice.sii_send_failed)
+        self.assertEqual(self.invoice.sii_send_attempts, 1)
+        self.assertTrue(self.invoice.sii_next_retry_date)
+
+    def test_send_failed_retry_cancelled(self):
+        # A failed invoice cancelled before being registered isn't annulled
+        self.invoice.write({
+            'sii_send_failed': True,
+            'sii_next_retry_date': '2000-01-01 00:00:00',
+        })
+        self.invoice.journal_id.update_posted = True
+        self.invoice.action_cancel()
+        self.assertFalse(self.invoice.sii_next_retry_date)
+        self.invoice.sii_next_retry_date = '2000-01-01 00:00:00'
+        service = SiiServiceMock()
+        with mock.patch.object(
+            type(self.env['account.invoice']), '_connect_sii',
+            return_value=service,
+        ):
+            self.env['account.invoice']._cron_sii_retry_failed()
+        self.assertFalse(service.calls)
+
+    def test_send_batch_parallel_dispatch(self):
+        company = self.invoice.company_id
+        company.write({
+            'sii_send_in_batch': True,
+            'sii_parallel_dispatch': True,
+            'sii_batch_size': 2,
+        })
+        invoices = self.env['account.invoice']
+        for _i in range(3):
+            invoice = self.invoice.copy()
+            invoice.action_invoice_open()
+            invoices |= invoice
+        invoices.write({'sii_send_date': fields.Datetime.now()})
+        service = SiiServiceMock()
+        with mock.patch.object(
+            type(self.env['account.invoice']), '_connect_sii',
+            return_value=service,
+        ):
+            self.env['account.invoice']._cron_sii_send_batches()
+        self.assertEqual(len(service.calls), 2)
+        self.assertFalse(invoices.mapped('invoice_jobs_ids'))
+        self.assertFalse(any(invoices.mapped('sii_send_date')))
+        self.assertEqual(set(invoices.mapped('sii_state')), {'sent'})
+
+    def test_sii_call_throttling_backoff(self):
+        service = SiiServiceMock()
+
+        def _throttled(header, records):
+            service.calls.append(records)
+            raise ConnectionError()
+
+        service.SuministroLRFacturasEmitidas = _throttled
+        invoice = self.invoice.copy()
+        invoice.action_invoice_open()
+        with mock.patch.object(
+            type(self.env['account.invoice']), '_connect_sii',
+            return_value=service,
+        ), mock.patch.dict(sii_rate_limiter._not_before), mock.patch.dict(
+            sii_rate_limiter._throttled,
+        ), mock.patch('time.sleep') as sleep:
+            self.invoice._send_invoices_to_sii_batch()
+            # The next calls of the company are delayed, not retried
+            invoice._send_invoices_to_sii_batch()
+        self.assertFalse(sleep.called)
+        self.assertEqual(len(service.calls), 1)
+        self.assertTrue(self.invoice.sii_send_failed)
+        self.assertTrue(self.invoice.sii_next_retry_date)
+        self.assertFalse(invoice.sii_send_failed)
+        self.assertTrue(invoice.sii_send_date)
+        self.assertEqual(invoice.sii_state, 'not_sent')
+
+    def test_sii_call_wait_postponed(self):
+        invoice = self.invoice.copy()
+        invoice.action_invoice_open()
+        service = SiiServiceMock(wait=60)
+        with mock.patch.object(
+            type(self.env['account.invoice']), '_connect_sii',
+            return_value=service,
+        ), mock.patch.dict(sii_rate_limiter._not_before), mock.patch(
+            'time.sleep',
+        ) as sleep:
+            self.invoice._send_invoice_to_sii()
+            invoice._send_invoice_to_sii()
+        self.assertFalse(sleep.called)
+        self.assertEqual(len(service.calls), 1)
+        self.assertEqual(self.invoice.sii_state, 'sent')
+        # Sent by the batch scheduler after the waiting time
+        self.assertEqual(invoice.sii_state, 'not_sent')
+        self.assertFalse(invoice.sii_send_failed)
+        self.assertGreater(invoice.sii_send_date, fields.Datetime.now())
+
+    def test_cancel_invoices_batch(self):
+        invoice = self.invoice.copy()
+        invoice.action_invoice_open()
+        invoices = self.invoice | invoice
+        invoices.write({'sii_state': 'sent'})
+        invoices.mapped('journal_id').write({'update_posted': True})
+        invoices.action_cancel()
+        self.assertEqual(set(invoices.mapped('sii_state')), {'sent_modified'})
+        service = SiiServiceMock()
+        with mock.patch.object(
+            type(self.env['account.invoice']), '_connect_sii',
+            return_value=service,
+        ):
+            invoices._cancel_invoices_to_sii_batch()
+        self.assertEqual(len(service.calls), 1)
+        self.assertEqual(set(invoices.mapped('sii_state')), {'cancelled'})
+        self.assertFalse(any(invoices.mapped('sii_send_failed')))
+        # The cancellation request is logged, not written on the invoice
+        submission = self.invoice.sii_submission_ids.filtered(
+            lambda x: x.operation_type == 'cancel')
+        self.assertEqual(len(submission), 1)
+        payload = submission.get_payload()
+        self.assertIn('NumSerieFacturaEmisor', payload['content'])
+        self.assertIn('IDVersionSii', payload['header'])
+        self.assertNotEqual(payload['content'], self.invoice.sii_content_sent)
+
+    def test_sii_reconciliation(self):
+        self.invoice.sii_state = 'sent'
+        id_factura = self.invoice._get_sii_id_factura()
+        extra_id_factura = dict(id_factura, NumSerieFacturaEmisor='EXTRA')
+        registered = [{
+            'IDFactura': x,
+            'DatosFacturaEmitida': {'ImporteTotal': amount},
+            'EstadoFactura': {'EstadoRegistro': 'Correcta', 'CSV': 'CSV'},
+        } for x, amount in [
+            (id_factura, self.invoice.amount_total_company_signed),
+            (extra_id_factura, 10.0),
+        ]]
+        service = SiiServiceMock(registered=registered, page_size=1)
+        period = '%02d' % fields.Date.from_string(self.invoice.date).month
+        reconciliation = self.env['aeat.sii.reconciliation'].create({
+            'company_id': self.invoice.company_id.id,
+            'invoice_type': 'out',
+            'fiscal_year': fields.Date.from_string(self.invoice.date).year,
+            'period_from': period,
+            'period_to': period,
+        })
+        invoice_class = type(self.env['account.invoice'])
+        with mock.patch.object(
+            invoice_class, '_connect_sii', return_value=service,
+        ), mock.patch.object(
+            invoice_class, '_call_sii_service', autospec=True,
+            side_effect=invoice_class._call_sii_service,
+        ) as call_sii_service:
+            reconciliation.action_check()
+        self.assertEqual(len(service.calls), 2)
+        # The pages are requested within the limits of the SII calls
+        self.assertEqual(call_sii_service.call_count, 2)
+        self.assertEqual(reconciliation.state, 'done')
+        self.assertEqual(reconciliation.matched_count, 1)
+        self.assertEqual(reconciliation.extra_count, 1)
+        self.assertEqual(reconciliation.missing_count, 0)
+        self.assertEqual(reconciliation.line_ids.number, 'EXTRA')
+        self.invoice.sii_state = 'cancelled'
+        reconciliation.action_draft()
+        with mock.patch.object(
+            type(self.env['account.invoice']), '_connect_sii',
+            return_value=service,
+        ):
+            reconciliation.action_check()
+        self.assertEqual(reconciliation.mismatch_count, 1)
+        self.assertEqual(
+            reconciliation.line_ids.filtered(
+                lambda x: x.result == 'mismatch').invoice_id,
+            self.invoice,
+        )
+
+    def test_sii_cash_basis_payments(self):
+        self.invoice.write({
+            'sii_registration_key': self.env.ref(
+                'l10n_es_aeat_sii.aeat_sii_mapping_registration_keys_07').id,
+            'sii_state': 'sent',
+        })
+        journal = self.env['account.journal'].search([
+            ('type', '=', 'bank'),
+            ('company_id', '=', self.invoice.company_id.id),
+        ], limit=1)
+        self.invoice.pay_and_reconcile(journal, pay_amount=50)
+        payment_obj = self.env['aeat.sii.payment']
+        payments = payment_obj._generate_sii_payments(
+            date_until=fields.Datetime.now(),
+        )
+        self.assertEqual(len(payments), 1)
+        self.assertEqual(payments.invoice_id, self.invoice)
+        self.assertEqual(payments.payment_type, 'out')
+        self.assertAlmostEqual(payments.amount, 50)
+        # Already processed reconciliations are not read again
+        self.assertFalse(payment_obj._generate_sii_payments(
+            date_until=fields.Datetime.now(),
+        ))
+        service = SiiServiceMock(fault_calls=[1])
+        with mock.patch.object(
+            type(self.env['account.invoice']), '_connect_sii',
+            return_value=service,
+        ):
+            payments.send_sii()
+            self.assertEqual(payments.state, 'error')
+            self.assertEqual(payments.sii_send_attempts, 1)
+            self.assertTrue(payments.sii_next_retry_date)
+            # Failed payments are retried once their retry date arrives
+            payment_obj._cron_sii_payments()
+            self.assertEqual(len(service.calls), 1)
+            payments.sii_next_retry_date = fields.Datetime.now()
+            payment_obj._cron_sii_payments()
+        self.assertEqual(len(service.calls), 2)
+        self.assertEqual(payments.sii_send_attempts, 0)
+        self.assertFalse(payments.sii_next_retry_date)
+        record = service.calls[1][0]
+        self.assertEqual(record['IDFactura']['NumSerieFacturaEmisor'],
+                         'INV001')
+        self.assertEqual(record['Cobros']['Cobro'][0]['Importe'], 50)
+        self.assertEqual(payments.state, 'sent')
+        self.assertEqual(payments.sii_csv, 'TESTCSV')
+
+    def test_sii_payment_connect_params(self):
+        self.invoice.company_id.sii_tax_agency_id = False
+        # Without tax agency, the WSDL comes from the system parameters
+        for mapping_key, param in [
+            ('out_payment', 'l10n_es_aeat_sii.wsdl_pr'),
+            ('in_payment', 'l10n_es_aeat_sii.wsdl_ps'),
+        ]:
+            params = self.invoice._connect_params_sii(mapping_key)
+            self.assertTrue(params['wsdl'])
+            self.assertEqual(
+                params['wsdl'],
+                self.env['ir.config_parameter'].sudo().get_param(param),
+            )
+        self.env['ir.config_parameter'].sudo().set_param(
+            'l10n_es_aeat_sii.wsdl_pr', False)
+        with self.assertRaises(exceptions.UserError):
+            self.invoice._connect_params_sii('out_payment')
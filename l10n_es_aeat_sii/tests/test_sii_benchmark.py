@@ -0,0 +1,117 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+import logging
+import os
+import time
+from unittest import mock
+
+from odoo.tests import tagged
+
+from .sii_mock_service import SiiServiceMock
+from .test_l10n_es_aeat_sii import TestL10nEsAeatSiiBase
+
+_logger = logging.getLogger(__name__)
+
+BENCHMARK_SIZES = [
+    int(x) for x in os.environ.get(
+        'SII_BENCHMARK_SIZES', '1000,10000').split(',')
+]
+# Seconds of each call to the SII stand-in service
+BENCHMARK_LATENCY = float(os.environ.get('SII_BENCHMARK_LATENCY', '0'))
+# Fraction of records rejected by the SII stand-in service
+BENCHMARK_ERROR_RATE = float(
+    os.environ.get('SII_BENCHMARK_ERROR_RATE', '0.01'))
+
+
+@tagged('-standard', 'sii_benchmark')
+class TestL10nEsAeatSiiBenchmark(TestL10nEsAeatSiiBase):
+    """Benchmarks of the SII communication. They are not executed by default:
+    launch them with ``--test-tags sii_benchmark``. The number of invoices
+    can be changed with the environment variable ``SII_BENCHMARK_SIZES``
+    (comma separated, up to 100000 is sensible), and the behaviour of the SII
+    stand-in service with ``SII_BENCHMARK_LATENCY`` (seconds per call) and
+    ``SII_BENCHMARK_ERROR_RATE`` (fraction of rejected records)."""
+
+    def _create_invoices(self, size):
+        vals = self.invoice.copy_data({'date': self.invoice.date_invoice})[0]
+        invoice_ids = []
+        for i in range(size):
+            vals['move_name'] = 'BENCH%06d' % i
+            invoice_ids.append(self.env['account.invoice'].create(vals).id)
+        invoices = self.env['account.invoice'].browse(invoice_ids)
+        invoices.compute_taxes()
+        return invoices
+
+    def _open_invoices(self, invoices):
+        """Put the invoices ready to be sent to the SII. The validation is
+        skipped, as it's not part of what is measured."""
+        self.env.cr.execute("""
+            UPDATE account_invoice
+            SET state = 'open', sii_state = 'not_sent',
+                sii_send_failed = FALSE
+            WHERE id IN %s""", (tuple(invoices.ids), ))
+        invoices.invalidate_cache()
+
+    def _measure(self, func):
+        """Execute the function with an empty cache.
+
+        :return: Tuple (elapsed seconds, number of SQL queries).
+        """
+        self.env.invalidate_all()
+        queries = self.env.cr.sql_log_count
+        start = time.time()
+        func()
+        return time.time() - start, self.env.cr.sql_log_count - queries
+
+    def test_benchmark_invoice_dicts(self):
+        invoice_obj = self.env['account.invoice']
+        for size in BENCHMARK_SIZES:
+            invoices = self._create_invoices(size)
+            one_time, one_queries = self._measure(lambda: [
+                invoice_obj.browse(x)._get_sii_invoice_dict()
+                for x in invoices.ids
+            ])
+            batch_time, batch_queries = self._measure(
+                invoice_obj.browse(invoices.ids)._get_sii_invoice_dicts,
+            )
+            _logger.info(
+                "SII dicts for %s invoices: one by one %.2fs (%s queries), "
+                "batch %.2fs (%s queries)",
+                size, one_time, one_queries, batch_time, batch_queries,
+            )
+            self.assertLess(batch_queries, one_queries)
+
+    def test_benchmark_send(self):
+        invoice_obj = self.env['account.invoice']
+        for size in BENCHMARK_SIZES:
+            invoices = self._create_invoices(size)
+            results = []
+            for name, method in [
+                ('one by one', '_send_invoice_to_sii'),
+                ('batch', '_send_invoices_to_sii_batch'),
+            ]:
+                self._open_invoices(invoices)
+                service = SiiServiceMock(
+                    latency=BENCHMARK_LATENCY,
+                    error_rate=0.0 if method == '_send_invoice_to_sii'
+                    else BENCHMARK_ERROR_RATE,
+                )
+                with mock.patch.object(
+                    type(invoice_obj), '_connect_sii', return_value=service,
+                ):
+                    elapsed, queries = self._measure(
+                        getattr(invoice_obj.browse(invoices.ids), method),
+                    )
+                results.append(elapsed)
+                _logger.info(
+                    "SII send of %s invoices %s: %.2fs, %.1f invoices/s, "
+                    "%s calls, %s queries",
+                    size, name, elapsed, size / (elapsed or 1),
+                    len(service.calls), queries,
+                )
+                # Every invoice has got its result
+                self.assertFalse(invoices.filtered(
+                    lambda x: x.sii_state == 'not_sent' and
+                    not x.sii_send_failed
+                ))
+            self.assertLess(results[1], results[0])